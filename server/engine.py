@@ -0,0 +1,1269 @@
+# 
+# Tablet desk clock web server
+# 
+# Copyright (c) Project Nayuki
+# All rights reserved. Contact Nayuki for licensing.
+# https://www.nayuki.io/page/tablet-desk-clock
+# 
+
+
+# ---- Prelude ----
+
+import asyncio, collections, concurrent.futures, contextvars, email.utils, io, os, selectors, signal, socket, sys, threading, time, traceback, types, urllib.parse, wsgiref.simple_server, wsgiref.util
+import bottle
+
+if __name__ == "__main__":
+	raise AssertionError()
+
+
+
+# ---- Sendfile ----
+
+# The wsgi.file_wrapper provided by this server. Wrapped files are sent to the socket with
+# socket.sendfile(), which uses the zero-copy os.sendfile() where the platform supports it.
+class SendfileWrapper(wsgiref.util.FileWrapper):
+	pass
+
+
+class ServerHandler(wsgiref.simple_server.ServerHandler):
+	
+	wsgi_file_wrapper = SendfileWrapper
+	
+	
+	# The wrapped object is either a binary file (sent from its current position to the end),
+	# or a staticfiles.FileRange (sent from its offset for its length).
+	def sendfile(self):
+		filelike = self.result.filelike
+		file = getattr(filelike, "file", filelike)
+		try:
+			file.fileno()
+		except (AttributeError, OSError, io.UnsupportedOperation):
+			return False
+		offset = getattr(filelike, "offset", None)
+		count = getattr(filelike, "length", None)
+		if offset is None:
+			offset = file.tell()
+		if not self.headers_sent:
+			self.send_headers()
+		self._flush()
+		self.bytes_sent = self.request_handler.connection.sendfile(file, offset, count)
+		return True
+	
+	
+	# On a persistent connection, the end of the response body must be delimited by Content-Length.
+	# Responses without one (and without an implied empty body) end by closing the connection.
+	def cleanup_headers(self):
+		super().cleanup_headers()
+		reqhandler = self.request_handler
+		if self.http_version == "1.0":
+			return
+		status = int(self.status[ : 3])
+		if "Content-Length" not in self.headers and status >= 200 and status not in (204, 304) \
+				and self.environ["REQUEST_METHOD"] != "HEAD":
+			reqhandler.close_connection = True
+		if reqhandler.close_connection:
+			self.headers["Connection"] = "close"
+		elif reqhandler.request_version == "HTTP/1.0":
+			self.headers["Connection"] = "keep-alive"
+	
+	
+	def handle_error(self):
+		if self.headers_sent:
+			self.request_handler.close_connection = True  # Response is truncated
+		super().handle_error()
+
+
+
+# ---- Request handlers ----
+
+# Same as the standard request handler, which serves one request per connection
+# over HTTP/1.0, but uses the sendfile-capable ServerHandler.
+class WSGIRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+	
+	# Reads the part of the input that the server already received (see _IdleConnections) before the socket.
+	def setup(self):
+		super().setup()
+		head = getattr(self.server, "received_head", lambda: b"")()
+		if len(head) > 0:
+			self.rfile = io.BufferedReader(_PrefixedReader(head, self.rfile.detach()))
+	
+	
+	def handle(self):
+		self.close_connection = True
+		self.handle_one_request()
+	
+	
+	def handle_one_request(self):
+		try:
+			self.raw_requestline = self.rfile.readline(65537)
+		except (ConnectionError, socket.timeout):
+			self.close_connection = True
+			return
+		if len(self.raw_requestline) == 0:
+			self.close_connection = True
+			return
+		if len(self.raw_requestline) > 65536:
+			self.requestline = ""
+			self.request_version = ""
+			self.command = ""
+			self.send_error(414)
+			return
+		if not self.parse_request():
+			return
+		
+		environ = self.get_environ()
+		body = _RequestBody(self.rfile, environ)
+		environ["wsgi.input"] = body
+		handler = ServerHandler(self.rfile, self.wfile, self.get_stderr(), environ, multithread=False)
+		handler.http_version = self.protocol_version.partition("/")[2]
+		handler.request_handler = self
+		handler.run(self.server.get_app())
+		if not self.close_connection and not body.drain():
+			self.close_connection = True
+
+
+# Serves any number of requests on each connection over HTTP/1.1, including pipelined ones
+# (which are simply read from the buffered input in order), until the client asks to close
+# or the connection has been idle for the server's keepalive_timeout. When no part of the next request
+# has arrived yet, the handler ends with 'parked' set, and the server waits for it without holding a worker.
+class KeepAliveRequestHandler(WSGIRequestHandler):
+	
+	protocol_version = "HTTP/1.1"
+	
+	
+	def setup(self):
+		self.timeout = self.server.keepalive_timeout
+		self.parked = False
+		super().setup()
+	
+	
+	def handle(self):
+		self.close_connection = False
+		while not self.close_connection:
+			self.handle_one_request()
+			if not self.close_connection and not self._input_ready():
+				self.parked = True
+				break
+	
+	
+	# Tests whether input is buffered or waiting on the socket, without blocking.
+	def _input_ready(self):
+		self.connection.settimeout(0)
+		try:
+			return len(self.rfile.peek(1)) > 0
+		except OSError:
+			return False  # The connection is broken, which the next read will find out
+		finally:
+			self.connection.settimeout(self.timeout)
+
+
+# A raw binary stream that yields the given bytes, then the rest of the given raw stream.
+class _PrefixedReader(io.RawIOBase):
+	
+	def __init__(self, prefix, raw):
+		self._prefix = memoryview(prefix)
+		self._raw = raw
+	
+	
+	def readable(self):
+		return True
+	
+	
+	def readinto(self, b):
+		if len(self._prefix) == 0:
+			return self._raw.readinto(b)
+		n = min(len(b), len(self._prefix))
+		b[ : n] = self._prefix[ : n]
+		self._prefix = self._prefix[n : ]
+		return n
+	
+	
+	def close(self):
+		if not self.closed:
+			self._raw.close()
+		super().close()
+
+
+# Limits reads of the request body to its Content-Length, so that the next request on the same connection
+# is not consumed, and discards any part of the body that the application did not read.
+class _RequestBody:
+	
+	MAX_DRAIN_BYTES = 2**20
+	
+	
+	def __init__(self, rfile, environ):
+		self._rfile = rfile
+		self.chunked = "chunked" in environ.get("HTTP_TRANSFER_ENCODING", "").lower()
+		try:
+			self._remaining = max(int(environ.get("CONTENT_LENGTH") or 0), 0)
+		except ValueError:
+			self._remaining = 0
+	
+	
+	def read(self, size=-1):
+		if self.chunked:
+			return self._rfile.read(size)
+		if size is None or size < 0 or size > self._remaining:
+			size = self._remaining
+		result = self._rfile.read(size)
+		self._remaining -= len(result)
+		return result
+	
+	
+	def readline(self, size=-1):
+		if self.chunked:
+			return self._rfile.readline(size)
+		if size is None or size < 0 or size > self._remaining:
+			size = self._remaining
+		result = self._rfile.readline(size)
+		self._remaining -= len(result)
+		return result
+	
+	
+	def readlines(self, hint=-1):
+		return list(iter(self.readline, b""))
+	
+	
+	def __iter__(self):
+		return iter(self.readline, b"")
+	
+	
+	# Returns whether the connection can be reused for another request.
+	def drain(self):
+		if self.chunked or self._remaining > self.MAX_DRAIN_BYTES:
+			return False
+		while self._remaining > 0:
+			if len(self.read(min(self._remaining, 65536))) == 0:
+				return False
+		return True
+
+
+
+# ---- Bulkheads ----
+
+# Every route belongs to one of these classes, which each get their own concurrency limit and wait queue,
+# so that slow upstream servers (for weather, network probes, and the proxy) cannot use up the capacity that
+# serves the clock itself. The defaults bound the non-critical classes to 11 connections, leaving some of the
+# default 16 workers for time and static requests. The "wallpaper" bulkhead is not a route class; it bounds
+# the requests that wait for new wallpaper derivatives to be made (see modules.get_wallpaper_derivative()).
+# The "bulkheads" configuration value overrides these.
+DEFAULT_BULKHEADS = {
+	"time"     : {"limit": 4, "queue": 16},
+	"static"   : {"limit": 8, "queue": 32},
+	"weather"  : {"limit": 1, "queue":  2},
+	"network"  : {"limit": 2, "queue":  2},
+	"proxy"    : {"limit": 2, "queue":  2},
+	"wallpaper": {"limit": 2, "queue":  2},
+}
+
+DEFAULT_ROUTE_CLASS = "static"
+CRITICAL_ROUTE_CLASSES = ("time", "static")  # Run first when requests are waiting for a worker
+
+ROUTE_CLASSES = {}  # Bottle route callback -> route class name
+BULKHEADS = {}  # Route class name -> Bulkhead
+
+
+# Decorator that puts the given route callback in the given route class. Undecorated routes are in DEFAULT_ROUTE_CLASS.
+def route_class(name):
+	def decorator(func):
+		ROUTE_CLASSES[func] = name
+		return func
+	return decorator
+
+
+def configure_bulkheads(config):
+	BULKHEADS.clear()
+	settings = dict(DEFAULT_BULKHEADS)
+	settings.update(config.get("bulkheads", {}))
+	for (name, setting) in settings.items():
+		BULKHEADS[name] = Bulkhead(name, setting["limit"], setting["queue"])
+
+
+def bulkhead_for(callback):
+	return BULKHEADS.get(ROUTE_CLASSES.get(callback, DEFAULT_ROUTE_CLASS))
+
+
+# Returns the priority for a worker queue (lower runs first) of a request for the given Bottle
+# application with the given method and target, without running the route.
+def request_priority(app, method, target):
+	try:
+		route, _ = app.match({"REQUEST_METHOD": method,
+			"PATH_INFO": urllib.parse.unquote(target.partition("?")[0], "ISO-8859-1")})
+		routeclass = ROUTE_CLASSES.get(route.callback, DEFAULT_ROUTE_CLASS)
+	except bottle.HTTPError:
+		routeclass = DEFAULT_ROUTE_CLASS
+	return 0 if (routeclass in CRITICAL_ROUTE_CLASSES) else 1
+
+
+# Limits how many requests of one route class run at once. Requests beyond the limit wait in arrival order,
+# up to 'queuesize' of them, and any more are rejected. Can be acquired from both threads and coroutines.
+class Bulkhead:
+	
+	def __init__(self, name, limit, queuesize):
+		self.name = name
+		self.limit = limit
+		self.queuesize = queuesize
+		self.active = 0
+		self.rejected = 0
+		self.waiters = collections.deque()  # Functions that hand a freed slot to a waiting request
+		self.lock = threading.Lock()
+	
+	
+	# Blocks the current thread until admitted, and returns True, or returns False if the queue is full.
+	def acquire(self):
+		event = threading.Event()
+		admitted = self._enter(event.set)
+		if admitted is None:
+			event.wait()
+			admitted = True
+		return admitted
+	
+	
+	# Waits until admitted, and returns True, or returns False if the queue is full.
+	async def acquire_async(self):
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		def resolve():
+			if future.cancelled():
+				self.release()
+			else:
+				future.set_result(None)
+		waker = lambda: loop.call_soon_threadsafe(resolve)
+		admitted = self._enter(waker)
+		if admitted is None:
+			try:
+				await future
+			except asyncio.CancelledError:
+				with self.lock:
+					if waker in self.waiters:
+						self.waiters.remove(waker)
+						raise
+				if future.done() and not future.cancelled():
+					self.release()
+				raise
+			admitted = True
+		return admitted
+	
+	
+	# Returns True if a slot was taken, False if rejected, or None if the waker was queued.
+	def _enter(self, waker):
+		with self.lock:
+			if self.active < self.limit:
+				self.active += 1
+				return True
+			if len(self.waiters) >= self.queuesize:
+				self.rejected += 1
+				return False
+			self.waiters.append(waker)
+			return None
+	
+	
+	def release(self):
+		with self.lock:
+			if len(self.waiters) == 0:
+				self.active -= 1
+				return
+			waker = self.waiters.popleft()  # The slot passes directly to the next request
+		waker()
+	
+	
+	def stats(self):
+		with self.lock:
+			return {
+				"limit": self.limit,
+				"active": self.active,
+				"queue-depth": len(self.waiters),
+				"queue-capacity": self.queuesize,
+				"rejected": self.rejected,
+			}
+
+
+# Bottle plugin that runs each route inside the bulkhead of its class. Answers 503 if the route class is being shed
+# or the bulkhead's queue is full. Requests that the asyncio engine already admitted pass straight through.
+class BulkheadPlugin:
+	
+	name = "bulkhead"
+	api = 2
+	
+	
+	def apply(self, callback, route):
+		def wrapper(*args, **kwargs):
+			if bottle.request.environ.get("engine.admitted", False):
+				return callback(*args, **kwargs)
+			error = shed_error(route.callback)
+			if error is not None:
+				raise error
+			bulkhead = bulkhead_for(route.callback)
+			if bulkhead is None:
+				return callback(*args, **kwargs)
+			if not bulkhead.acquire():
+				raise bulkhead_full_error(bulkhead)
+			try:
+				result = callback(*args, **kwargs)
+			except:
+				bulkhead.release()
+				raise
+			if isinstance(result, types.GeneratorType):
+				return _BulkheadBody(result, bulkhead.release)  # Streamed bodies keep the slot until they end
+			bulkhead.release()
+			return result
+		return wrapper
+
+
+# Wraps a streamed response body so that the bulkhead slot is released when the body is exhausted or closed,
+# not when the route returns it.
+class _BulkheadBody:
+	
+	def __init__(self, body, release):
+		self._body = body
+		self._release = release
+	
+	
+	def __iter__(self):
+		return self
+	
+	
+	def __next__(self):
+		try:
+			return next(self._body)
+		except:
+			self.close()
+			raise
+	
+	
+	def close(self):
+		try:
+			self._body.close()
+		finally:
+			if self._release is not None:
+				release, self._release = self._release, None
+				release()
+
+
+# The same for asynchronous iterators of bytes, as returned by routes on the asyncio engine.
+class _AsyncBulkheadBody:
+	
+	def __init__(self, body, release):
+		self._body = body
+		self._release = release
+	
+	
+	def __aiter__(self):
+		return self
+	
+	
+	async def __anext__(self):
+		try:
+			return await self._body.__anext__()
+		except:
+			await self.aclose()
+			raise
+	
+	
+	async def aclose(self):
+		try:
+			if hasattr(self._body, "aclose"):
+				await self._body.aclose()
+		finally:
+			if self._release is not None:
+				release, self._release = self._release, None
+				release()
+
+
+def bulkhead_full_error(bulkhead):
+	return bottle.HTTPError(503, f"Too many {bulkhead.name} requests", Retry_After=str(RETRY_AFTER_SECONDS))
+
+
+
+# ---- Load shedding ----
+
+SHED_ORDER = ("proxy", "network", "weather")  # Route classes to refuse, first to last, as queue latency grows
+RETRY_AFTER_SECONDS = 10
+
+
+# Tracks how long requests wait in the queue before a worker thread picks them up, as a moving average that
+# decays towards zero while nothing is being queued. The queue latency is the larger of that average and how long
+# the oldest request still in the queue has been waiting, so that it keeps growing while the workers are stalled.
+# Every whole multiple of the latency budget that the queue latency reaches sheds one more route class in SHED_ORDER.
+class LoadShedder:
+	
+	SMOOTHING = 0.2  # Weight of each new sample
+	DECAY_HALF_LIFE = 2.0  # In seconds
+	
+	
+	# 'oldestqueued' returns the time.monotonic() at which the oldest waiting request was queued, or None.
+	def __init__(self, budget, oldestqueued=lambda: None):
+		self.budget = budget
+		self.oldestqueued = oldestqueued
+		self.average = 0.0
+		self.updated = time.monotonic()
+		self.shed = collections.Counter()  # Route class name -> number of requests refused
+		self.lock = threading.Lock()
+	
+	
+	def record(self, delay):
+		with self.lock:
+			now = time.monotonic()
+			average = self._decayed(now)
+			self.average = average + (delay - average) * self.SMOOTHING
+			self.updated = now
+	
+	
+	# Returns the Retry-After value in seconds if a request of the given route class should be refused, otherwise None.
+	def check(self, routeclass):
+		if routeclass not in SHED_ORDER:
+			return None
+		latency = self._latency()
+		with self.lock:
+			level = int(latency / self.budget)
+			if SHED_ORDER.index(routeclass) >= level:
+				return None
+			self.shed[routeclass] += 1
+		return RETRY_AFTER_SECONDS * min(level, len(SHED_ORDER))
+	
+	
+	def _decayed(self, now):
+		return self.average * 0.5**((now - self.updated) / self.DECAY_HALF_LIFE)
+	
+	
+	def _latency(self):
+		oldest = self.oldestqueued()
+		now = time.monotonic()
+		with self.lock:
+			average = self._decayed(now)
+		return average if (oldest is None) else max(average, now - oldest)
+	
+	
+	def stats(self):
+		latency = self._latency()
+		with self.lock:
+			return {
+				"queue-latency": latency,
+				"queue-latency-budget": self.budget,
+				"shedding": list(SHED_ORDER[ : int(latency / self.budget)]),
+				"shed": dict(self.shed),
+			}
+
+
+load_shedder = LoadShedder(0.1)
+
+
+# Returns None if a request for the given route callback may go on to its bulkhead,
+# or the 503 error to answer with because its route class is being shed.
+def shed_error(callback):
+	routeclass = ROUTE_CLASSES.get(callback, DEFAULT_ROUTE_CLASS)
+	retryafter = load_shedder.check(routeclass)
+	if retryafter is None:
+		return None
+	return bottle.HTTPError(503, f"Server overloaded; not serving {routeclass} requests", Retry_After=str(retryafter))
+
+
+
+# ---- Server engines ----
+
+# Handles connections on a fixed number of worker threads. Accepted connections, and keep-alive connections
+# between requests, wait in _IdleConnections without holding a thread until a whole request head has arrived.
+# Then they wait in a bounded queue, where requests of critical route classes go first. Once 'maxconnections' are open,
+# the listening thread stops accepting, so further clients wait in the kernel's listen backlog.
+class PooledWSGIServer(wsgiref.simple_server.WSGIServer):
+	
+	def __init__(self, address, handler, workers, queuesize, maxconnections, reuseport=False):
+		self.reuse_port = reuseport
+		self.workers = workers
+		self.request_queue = _PriorityQueue(queuesize)
+		self.keepalive_timeout = 15.0
+		self.header_timeout = 10.0  # For the rest of a request head after its first bytes
+		self._worker_state = threading.local()
+		self.max_connections = maxconnections
+		self.connections = 0
+		self.connections_changed = threading.Condition()
+		self.busy_workers = 0
+		self.stats_lock = threading.Lock()
+		super().__init__(address, handler)
+		self.idle_connections = _IdleConnections(self)
+		for i in range(workers):
+			threading.Thread(target=self._work, name=f"http-worker-{i}", daemon=True).start()
+	
+	
+	def server_bind(self):
+		if self.reuse_port:
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		super().server_bind()
+	
+	
+	def process_request(self, request, client_address):
+		with self.connections_changed:
+			while self.connections >= self.max_connections:
+				self.connections_changed.wait()
+			self.connections += 1
+		self.idle_connections.park(request, client_address)
+	
+	
+	def shutdown_request(self, request):
+		super().shutdown_request(request)
+		with self.connections_changed:
+			self.connections -= 1
+			self.connections_changed.notify()
+	
+	
+	# Returns the request handler, so that the worker can see whether it parked the connection.
+	def finish_request(self, request, client_address):
+		return self.RequestHandlerClass(request, client_address, self)
+	
+	
+	# Returns the bytes of the current worker's connection that were already read, and forgets them.
+	def received_head(self):
+		head, self._worker_state.head = self._worker_state.head, b""
+		return head
+	
+	
+	def _work(self):
+		while True:
+			(request, client_address, head), waited = self.request_queue.get()
+			load_shedder.record(waited)
+			with self.stats_lock:
+				self.busy_workers += 1
+			handler = None
+			self._worker_state.head = head
+			try:
+				handler = self.finish_request(request, client_address)
+			except Exception:
+				self.handle_error(request, client_address)
+			finally:
+				if getattr(handler, "parked", False):
+					self.idle_connections.park(request, client_address)
+				else:
+					self.shutdown_request(request)
+				with self.stats_lock:
+					self.busy_workers -= 1
+	
+	
+	def queue_depth(self):
+		return self.request_queue.qsize()
+	
+	
+	def oldest_queued(self):
+		return self.request_queue.oldest()
+	
+	
+	def stats(self):
+		with self.stats_lock:
+			busy = self.busy_workers
+		return {
+			"workers": self.workers,
+			"busy-workers": busy,
+			"utilization": busy / self.workers,
+			"queue-depth": self.queue_depth(),
+			"queue-capacity": self.request_queue.maxsize,
+			"connections": self.connections,
+			"idle-connections": self.idle_connections.count(),
+		}
+
+
+# Holds the server's connections that are waiting for a request on one thread, which reads from them when the
+# selector finds them readable, until a whole request head (up to the blank line) has arrived. Then the connection and
+# the head go to the server's request queue, with a priority according to the route that the request line asks for.
+# So workers never wait for slow clients to send their heads. Connections that stay idle for longer than the server's
+# keepalive_timeout, or that take longer than its header_timeout to finish a head, are closed. The queue is never
+# waited on: while it is full, complete heads are held here, and the least urgent ones wait longest.
+class _IdleConnections:
+	
+	MAX_HEAD_BYTES = 2**17  # Longer heads are left to a worker, which rejects them
+	
+	
+	def __init__(self, server):
+		self.server = server
+		self.selector = selectors.DefaultSelector()
+		self.parked = collections.OrderedDict()  # Socket -> (client address, time.monotonic() when parked), oldest first
+		self.partial = collections.OrderedDict()  # Socket -> (client address, time.monotonic() when the head began, bytes so far), oldest first
+		self.ready = []  # (priority, time.monotonic() when complete, socket, client address, head) waiting for room in the queue
+		self.incoming = collections.deque()  # (socket, client address) from park() not yet registered with the selector
+		self.lock = threading.Lock()
+		self.wakeup, self.waker = socket.socketpair()
+		self.wakeup.setblocking(False)
+		self.waker.setblocking(False)
+		self.selector.register(self.wakeup, selectors.EVENT_READ)
+		threading.Thread(target=self._run, name="http-idle", daemon=True).start()
+	
+	
+	# Can be called from any thread.
+	def park(self, request, client_address):
+		with self.lock:
+			self.incoming.append((request, client_address))
+		try:
+			self.waker.send(b"\0")
+		except OSError:
+			pass  # The selector thread has enough wakeups pending
+	
+	
+	def count(self):
+		with self.lock:
+			return len(self.parked) + len(self.partial) + len(self.ready) + len(self.incoming)
+	
+	
+	def _run(self):
+		while True:
+			deadlines = []
+			if len(self.parked) > 0:
+				deadlines.append(next(iter(self.parked.values()))[1] + self.server.keepalive_timeout)
+			if len(self.partial) > 0:
+				deadlines.append(next(iter(self.partial.values()))[1] + self.server.header_timeout)
+			if len(self.ready) > 0:
+				deadlines.append(time.monotonic() + 0.01)  # Poll for room in the request queue
+			timeout = max(min(deadlines) - time.monotonic(), 0) if (len(deadlines) > 0) else None
+			for (key, _) in self.selector.select(timeout):
+				sock = key.fileobj
+				if sock is self.wakeup:
+					try:
+						while len(sock.recv(4096)) > 0:
+							pass
+					except OSError:
+						pass
+				else:
+					self._receive(sock)
+			self._dispatch()
+			
+			with self.lock:
+				incoming, self.incoming = self.incoming, collections.deque()
+			now = time.monotonic()
+			for (sock, client_address) in incoming:
+				try:
+					self.selector.register(sock, selectors.EVENT_READ)
+				except (OSError, ValueError):
+					self.server.shutdown_request(sock)
+					continue
+				with self.lock:
+					self.parked[sock] = (client_address, now)
+			
+			for (conns, limit) in ((self.parked, self.server.keepalive_timeout), (self.partial, self.server.header_timeout)):
+				while len(conns) > 0:
+					sock, (_, since, *_) = next(iter(conns.items()))
+					if now - since < limit:
+						break
+					self.selector.unregister(sock)
+					with self.lock:
+						del conns[sock]
+					self.server.shutdown_request(sock)
+	
+	
+	# Reads what has arrived on the given readable socket, which is either parked or has a partial head.
+	def _receive(self, sock):
+		try:
+			data = sock.recv(65536)
+		except (BlockingIOError, InterruptedError, socket.timeout):
+			return
+		except OSError:
+			data = b""
+		with self.lock:
+			parked = self.parked.pop(sock, None)
+			if parked is not None:
+				client_address, since, head = parked[0], time.monotonic(), b""
+			else:
+				client_address, since, head = self.partial[sock]
+			tail = head[-2 : ] + data  # Where the blank line that ends the head can be
+			head += data
+			if len(data) > 0 and b"\n\r\n" not in tail and b"\n\n" not in tail and len(head) < self.MAX_HEAD_BYTES:
+				self.partial[sock] = (client_address, since, head)  # Keeps its place in the order
+				return
+			self.partial.pop(sock, None)
+		self.selector.unregister(sock)
+		if len(data) == 0:
+			self.server.shutdown_request(sock)  # Closed by the client
+			return
+		self.ready.append((self._priority(head), time.monotonic(), sock, client_address, head))
+	
+	
+	# Moves complete requests into the server's queue, most urgent first, while it has room.
+	def _dispatch(self):
+		self.ready.sort(key=lambda item: item[ : 2])
+		while len(self.ready) > 0:
+			priority, arrived, sock, client_address, head = self.ready[0]
+			if not self.server.request_queue.put((sock, client_address, head), priority, block=False, arrived=arrived):
+				break
+			del self.ready[0]
+	
+	
+	# Returns the priority of the request with the given head.
+	def _priority(self, head):
+		line, sep, _ = head.partition(b"\n")
+		parts = line.decode("ISO-8859-1").rstrip("\r").split(" ")
+		if sep == b"" or len(parts) != 3:
+			return 0  # Malformed, which a worker answers quickly
+		return request_priority(self.server.get_app(), parts[0], parts[1])
+
+
+# Maps the "web-server-engine" configuration value to a request handler class.
+# The other possible value is "asyncio", for the AsyncioServer.
+REQUEST_HANDLERS = {
+	"wsgiref"  : WSGIRequestHandler,
+	"keepalive": KeepAliveRequestHandler,
+}
+
+
+# Returns a server for the given WSGI application, set up according to the given configuration dictionary.
+# With 'reuseport', other processes can listen on the same port at the same time.
+def make_server(host, port, app, config, reuseport=False):
+	name = config.get("web-server-engine", "wsgiref")
+	configure_bulkheads(config)
+	app.install(BulkheadPlugin())
+	if name == "asyncio":
+		server = AsyncioServer(host, port, app, config, reuseport)
+	else:
+		handler = REQUEST_HANDLERS[name]
+		server = PooledWSGIServer((host, port), handler, config.get("web-server-workers", 16),
+			config.get("web-server-queue-size", 64), config.get("web-server-max-connections", 256), reuseport)
+		server.set_app(app)
+		server.keepalive_timeout = config.get("web-server-keepalive-timeout", 15.0)
+		server.header_timeout = config.get("web-server-header-timeout", 10.0)
+	global load_shedder, _current_server
+	load_shedder = LoadShedder(config.get("shed-queue-latency-budget", 0.1), server.oldest_queued)
+	_current_server = server
+	return server
+
+
+_current_server = None
+
+# Returns a JSON-serializable dictionary of the running server's load, or None if there is no server.
+def server_stats():
+	if _current_server is None:
+		return None
+	result = _current_server.stats()
+	result["pid"] = os.getpid()
+	result["load-shedding"] = load_shedder.stats()
+	result["bulkheads"] = {name: bulkhead.stats() for (name, bulkhead) in BULKHEADS.items()}
+	return result
+
+
+
+# ---- Prefork supervisor ----
+
+# Runs the server described by the configuration until interrupted. If "web-server-processes" is above 1,
+# this forks that many worker processes, each running its own server on the same port with SO_REUSEPORT so that
+# the kernel spreads connections across them, and restarts any worker process that exits. Platforms without
+# fork() or SO_REUSEPORT (such as Windows) run a single process instead.
+def serve_forever(host, port, app, config):
+	processes = config.get("web-server-processes", 1)
+	if processes > 1 and not (hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")):
+		sys.stderr.write(f"web-server-processes is {processes}, but this platform cannot fork workers that share a port; running 1 process\n")
+		processes = 1
+	if processes <= 1:
+		make_server(host, port, app, config).serve_forever()
+	else:
+		_Supervisor(host, port, app, config, processes).run()
+
+
+class _Supervisor:
+	
+	MIN_UPTIME = 5.0  # Seconds; a worker that exits sooner is restarted only after RESTART_DELAY
+	RESTART_DELAY = 1.0
+	
+	
+	def __init__(self, host, port, app, config, processes):
+		self.host = host
+		self.port = port
+		self.app = app
+		self.config = config
+		self.processes = processes
+		self.children = {}  # Process ID -> time.monotonic() at start
+	
+	
+	def run(self):
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+		try:
+			for _ in range(self.processes):
+				self._spawn()
+			while True:
+				pid, status = os.wait()
+				started = self.children.pop(pid, None)
+				if started is None:
+					continue
+				sys.stderr.write(f"Worker process {pid} exited with status {status}, restarting\n")
+				if time.monotonic() - started < self.MIN_UPTIME:
+					time.sleep(self.RESTART_DELAY)
+				self._spawn()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			for pid in self.children:
+				try:
+					os.kill(pid, signal.SIGTERM)
+				except ProcessLookupError:
+					pass
+	
+	
+	def _spawn(self):
+		pid = os.fork()
+		if pid != 0:
+			self.children[pid] = time.monotonic()
+			return
+		status = 1
+		try:
+			signal.signal(signal.SIGTERM, signal.SIG_DFL)
+			make_server(self.host, self.port, self.app, self.config, True).serve_forever()
+			status = 0
+		except KeyboardInterrupt:
+			status = 0
+		except BaseException:
+			traceback.print_exc()
+		finally:
+			os._exit(status)
+
+
+
+# ---- Asyncio engine ----
+
+ASYNC_HANDLERS = {}  # Bottle route callback -> coroutine function taking the same arguments and returning a bottle.HTTPResponse
+request_environ = contextvars.ContextVar("request_environ")
+
+
+# Decorator that registers a coroutine function as the asyncio engine's version of the given route callback.
+# Such a function must not use Bottle's thread-local request and response objects, but can read the request's
+# WSGI environ dictionary from request_environ.get().
+def async_version(callback):
+	def decorator(func):
+		ASYNC_HANDLERS[callback] = func
+		return func
+	return decorator
+
+
+# Serves HTTP/1.1 with keep-alive on an asyncio event loop. Routes that have an async version run as coroutines
+# on the loop, so hundreds of requests waiting on upstream servers cost no threads. All other routes run the WSGI
+# application on a thread pool (critical route classes first), and file bodies are sent with the event loop's sendfile().
+# Requests wait for their bulkhead on the loop, so a full bulkhead does not hold any worker thread.
+class AsyncioServer:
+	
+	def __init__(self, host, port, app, config, reuseport=False):
+		self.reuse_port = reuseport
+		self.host = host
+		self.port = port
+		self.app = app
+		self.keepalive_timeout = config.get("web-server-keepalive-timeout", 15.0)
+		self.server_name = "localhost"
+		self.workers = config.get("web-server-workers", 16)
+		self.executor = _PriorityThreadPool(self.workers)
+		self.waiting_calls = 0  # Submitted to the executor but not started
+		self.busy_workers = 0
+		self.async_calls = 0
+		self.stats_lock = threading.Lock()
+	
+	
+	def serve_forever(self):
+		asyncio.run(self._serve())
+	
+	
+	async def _serve(self):
+		server = await asyncio.start_server(self._handle_connection, self.host, self.port, reuse_port=self.reuse_port)
+		self.server_name = socket.getfqdn(server.sockets[0].getsockname()[0])  # Once, because it can block on DNS
+		async with server:
+			await server.serve_forever()
+	
+	
+	async def _handle_connection(self, reader, writer):
+		try:
+			keepalive = True
+			while keepalive:
+				try:
+					head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keepalive_timeout)
+				except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+					break
+				keepalive = await self._handle_request(head, reader, writer)
+		except ConnectionError:
+			pass
+		finally:
+			writer.close()
+	
+	
+	# Returns whether the connection can be used for another request.
+	async def _handle_request(self, head, reader, writer):
+		lines = head.decode("ISO-8859-1").split("\r\n")
+		try:
+			method, target, version = lines[0].split(" ")
+		except ValueError:
+			await self._send_response(writer, "400 Bad Request", [], [b""], False, None)
+			return False
+		
+		peer = writer.get_extra_info("peername") or ("", 0)
+		sock = writer.get_extra_info("sockname") or ("", 0)
+		path, _, query = target.partition("?")
+		environ = {
+			"REQUEST_METHOD": method,
+			"SCRIPT_NAME": "",
+			"PATH_INFO": urllib.parse.unquote(path, "ISO-8859-1"),
+			"QUERY_STRING": query,
+			"SERVER_NAME": self.server_name,
+			"SERVER_PORT": str(sock[1]),
+			"SERVER_PROTOCOL": version,
+			"REMOTE_ADDR": peer[0],
+			"wsgi.version": (1, 0),
+			"wsgi.url_scheme": "http",
+			"wsgi.errors": sys.stderr,
+			"wsgi.multithread": True,
+			"wsgi.multiprocess": False,
+			"wsgi.run_once": False,
+			"wsgi.file_wrapper": SendfileWrapper,
+		}
+		for line in lines[1 : ]:
+			if line == "":
+				break
+			key, _, val = line.partition(":")
+			key = key.strip().upper().replace("-", "_")
+			val = val.strip()
+			if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+				environ[key] = val
+			elif "HTTP_" + key in environ:
+				environ["HTTP_" + key] += "," + val
+			else:
+				environ["HTTP_" + key] = val
+		
+		connection = environ.get("HTTP_CONNECTION", "").lower()
+		keepalive = (version == "HTTP/1.1" and connection != "close") or (version == "HTTP/1.0" and connection == "keep-alive")
+		if "chunked" in environ.get("HTTP_TRANSFER_ENCODING", "").lower():
+			await self._send_response(writer, "411 Length Required", [], [b""], False, environ)
+			return False
+		try:
+			length = int(environ.get("CONTENT_LENGTH") or 0)
+			body = await reader.readexactly(length) if (length > 0) else b""
+		except ValueError:
+			await self._send_response(writer, "400 Bad Request", [], [b""], False, environ)
+			return False
+		environ["wsgi.input"] = io.BytesIO(body)
+		
+		status, headers, body = await self._respond(environ)
+		return await self._send_response(writer, status, headers, body, keepalive, environ)
+	
+	
+	# Returns (status line, header list, body), where the body is a list of bytes,
+	# a SendfileWrapper, or an asynchronous iterator of bytes.
+	async def _respond(self, environ):
+		try:
+			route, args = self.app.match(environ)
+		except bottle.HTTPError:
+			return await self._run_wsgi(environ, DEFAULT_ROUTE_CLASS)  # Let the application render the error
+		error = shed_error(route.callback)
+		bulkhead = bulkhead_for(route.callback)
+		if error is None and bulkhead is None:
+			return await self._run_wsgi(environ, ROUTE_CLASSES.get(route.callback, DEFAULT_ROUTE_CLASS))
+		if error is None and not await bulkhead.acquire_async():
+			error = bulkhead_full_error(bulkhead)
+		if error is not None:
+			return (error.status_line, error.headerlist, [error.body.encode(error.charset)])
+		environ["engine.admitted"] = True
+		try:
+			status, headers, body = await self._run_route(route, args, environ)
+		except:
+			bulkhead.release()
+			raise
+		if hasattr(body, "__aiter__"):
+			return (status, headers, _AsyncBulkheadBody(body, bulkhead.release))  # Released by _send_response()
+		bulkhead.release()
+		return (status, headers, body)
+	
+	
+	async def _run_route(self, route, args, environ):
+		handler = ASYNC_HANDLERS.get(route.callback)
+		if handler is None:
+			return await self._run_wsgi(environ, ROUTE_CLASSES.get(route.callback, DEFAULT_ROUTE_CLASS))
+		
+		self.async_calls += 1
+		request_environ.set(environ)
+		try:
+			result = await handler(**args)
+		except bottle.HTTPResponse as e:
+			result = e
+		except Exception:
+			traceback.print_exc()
+			result = bottle.HTTPError(500, "Internal Server Error")
+		finally:
+			self.async_calls -= 1
+		body = result.body
+		if isinstance(body, str):
+			body = body.encode(result.charset)
+		if hasattr(body, "__aiter__"):
+			return (result.status_line, result.headerlist, body)  # Streamed as the chunks arrive
+		if hasattr(body, "read"):
+			return (result.status_line, result.headerlist, SendfileWrapper(body))
+		return (result.status_line, result.headerlist, [body])
+	
+	
+	async def _run_wsgi(self, environ, routeclass):
+		with self.stats_lock:
+			self.waiting_calls += 1
+		priority = 0 if (routeclass in CRITICAL_ROUTE_CLASSES) else 1
+		return await asyncio.wrap_future(self.executor.submit(priority, self._call_wsgi, environ))
+	
+	
+	# Runs on a worker thread.
+	def _call_wsgi(self, environ):
+		with self.stats_lock:
+			self.waiting_calls -= 1
+			self.busy_workers += 1
+		try:
+			response = []
+			def start_response(status, headers, exc_info=None):
+				response[ : ] = [status, headers]
+				return lambda data: None
+			result = self.app(environ, start_response)
+			if isinstance(result, SendfileWrapper):
+				return (response[0], response[1], result)
+			try:
+				body = [b"".join(result)]
+			finally:
+				if hasattr(result, "close"):
+					result.close()
+			return (response[0], response[1], body)
+		finally:
+			with self.stats_lock:
+				self.busy_workers -= 1
+	
+	
+	def oldest_queued(self):
+		return self.executor.queue.oldest()
+	
+	
+	def stats(self):
+		with self.stats_lock:
+			busy = self.busy_workers
+			waiting = self.waiting_calls
+		return {
+			"workers": self.workers,
+			"busy-workers": busy,
+			"utilization": busy / self.workers,
+			"queue-depth": waiting,
+			"async-requests": self.async_calls,
+		}
+	
+	
+	# Returns whether the connection can be used for another request.
+	async def _send_response(self, writer, status, headers, body, keepalive, environ):
+		names = {key.lower() for (key, _) in headers}
+		headers = list(headers)
+		if isinstance(body, list) and "content-length" not in names:
+			headers.append(("Content-Length", str(sum(map(len, body)))))
+			names.add("content-length")
+		if "content-length" not in names and int(status[ : 3]) not in (204, 304):
+			keepalive = False
+		headers.append(("Date", email.utils.formatdate(usegmt=True)))
+		headers.append(("Server", "AsyncioServer"))
+		if not keepalive:
+			headers.append(("Connection", "close"))
+		elif environ is not None and environ["SERVER_PROTOCOL"] == "HTTP/1.0":
+			headers.append(("Connection", "keep-alive"))
+		
+		head = f"HTTP/1.1 {status}\r\n" + "".join(f"{key}: {val}\r\n" for (key, val) in headers) + "\r\n"
+		writer.write(head.encode("ISO-8859-1"))
+		sent = 0
+		try:
+			if environ is not None and environ["REQUEST_METHOD"] == "HEAD":
+				pass
+			elif isinstance(body, SendfileWrapper):
+				await writer.drain()
+				filelike = body.filelike
+				file = getattr(filelike, "file", filelike)
+				offset = getattr(filelike, "offset", None)
+				if offset is None:
+					offset = file.tell()
+				sent = await asyncio.get_running_loop().sendfile(writer.transport, file, offset, getattr(filelike, "length", None))
+			elif hasattr(body, "__aiter__"):
+				try:
+					async for chunk in body:
+						writer.write(chunk)
+						sent += len(chunk)
+						await writer.drain()
+				except Exception:
+					traceback.print_exc()
+					keepalive = False  # The response is truncated
+			else:
+				for chunk in body:
+					writer.write(chunk)
+					sent += len(chunk)
+			await writer.drain()
+		finally:
+			if hasattr(body, "aclose"):
+				await body.aclose()
+			elif hasattr(body, "close"):
+				body.close()
+		
+		if environ is not None:
+			sys.stderr.write('%s - - [%s] "%s %s %s" %s %d\n' % (environ["REMOTE_ADDR"],
+				time.strftime("%d/%b/%Y %H:%M:%S"), environ["REQUEST_METHOD"], environ["PATH_INFO"],
+				environ["SERVER_PROTOCOL"], status.split(" ")[0], sent))
+		return keepalive
+
+
+# A thread pool whose waiting calls run in order of priority (lowest value first), then in order of submission.
+class _PriorityThreadPool:
+	
+	def __init__(self, workers):
+		self.queue = _PriorityQueue()
+		for i in range(workers):
+			threading.Thread(target=self._work, name=f"http-worker-{i}", daemon=True).start()
+	
+	
+	def submit(self, priority, func, *args):
+		future = concurrent.futures.Future()
+		self.queue.put((future, func, args), priority)
+		return future
+	
+	
+	def _work(self):
+		while True:
+			(future, func, args), waited = self.queue.get()
+			load_shedder.record(waited)
+			if not future.set_running_or_notify_cancel():
+				continue
+			try:
+				future.set_result(func(*args))
+			except BaseException as e:
+				future.set_exception(e)
+
+
+
+# ---- Queue ----
+
+# A blocking queue whose items are taken in order of priority (lowest value first), then in order of arrival.
+# It remembers when each item arrived, so that the wait of the oldest one is known at any time.
+class _PriorityQueue:
+	
+	def __init__(self, maxsize=0):
+		self.maxsize = maxsize  # Zero for unbounded; put() blocks while the queue is full
+		self._queues = {}  # Priority -> deque of (time.monotonic() at arrival, item)
+		self._size = 0
+		self._lock = threading.Lock()
+		self._not_empty = threading.Condition(self._lock)
+		self._not_full = threading.Condition(self._lock)
+	
+	
+	# Returns True when the item was added, or False if the queue is full and 'block' is false.
+	# The item's wait is counted from 'arrived' (a time.monotonic() value) if given.
+	def put(self, item, priority=0, block=True, arrived=None):
+		with self._not_full:
+			while 0 < self.maxsize <= self._size:
+				if not block:
+					return False
+				self._not_full.wait()
+			self._queues.setdefault(priority, collections.deque()).append((arrived if (arrived is not None) else time.monotonic(), item))
+			self._size += 1
+			self._not_empty.notify()
+			return True
+	
+	
+	# Blocks until an item is available, and returns (item, seconds it waited in the queue).
+	def get(self):
+		with self._not_empty:
+			while self._size == 0:
+				self._not_empty.wait()
+			priority = min(key for (key, items) in self._queues.items() if len(items) > 0)
+			queued, item = self._queues[priority].popleft()
+			self._size -= 1
+			self._not_full.notify()
+		return (item, time.monotonic() - queued)
+	
+	
+	def qsize(self):
+		return self._size
+	
+	
+	# Returns the time.monotonic() at which the longest-waiting item arrived, or None if the queue is empty.
+	def oldest(self):
+		with self._lock:
+			return min((items[0][0] for items in self._queues.values() if len(items) > 0), default=None)
@@ -0,0 +1,459 @@
+# 
+# Tablet desk clock web server
+# 
+# Copyright (c) Project Nayuki
+# All rights reserved. Contact Nayuki for licensing.
+# https://www.nayuki.io/page/tablet-desk-clock
+# 
+
+
+# ---- Prelude ----
+
+import asyncio, collections, email.message, http.client, select, ssl, threading, time, urllib.error, urllib.parse
+
+if __name__ == "__main__":
+	raise AssertionError()
+
+
+
+# ---- Common ----
+
+USER_AGENT = "Tablet-desk-clock"
+MAX_REDIRECTS = 5
+MAX_HEADER_BYTES = 65536
+
+
+# The result of an HTTP request. 'headers' is a list of (name, value) pairs.
+class Response:
+	
+	def __init__(self, url, status, reason, headers, body):
+		self.url = url
+		self.status = status
+		self.reason = reason
+		self.headers = headers
+		self.body = body
+	
+	
+	def getheader(self, name, default=None):
+		name = name.lower()
+		for (key, val) in self.headers:
+			if key.lower() == name:
+				return val
+		return default
+
+
+# Returns the URL to follow if the given response is a redirect, otherwise returns None after
+# raising urllib.error.HTTPError if the response is an error, like urllib.request.urlopen() does.
+def _check_response(url, response):
+	location = response.getheader("Location")
+	if response.status in (301, 302, 303, 307, 308) and location is not None:
+		return urllib.parse.urljoin(url, location)
+	if response.status >= 400:
+		msg = email.message.Message()
+		for (key, val) in response.headers:
+			msg[key] = val
+		raise urllib.error.HTTPError(url, response.status, response.reason, msg, None)
+	return None
+
+
+# Returns (pool key, request target) for the given URL, where the key is (scheme, host, port).
+def _split_url(url):
+	parts = urllib.parse.urlsplit(url)
+	if parts.scheme not in ("http", "https") or parts.hostname is None:
+		raise urllib.error.URLError(f"Unsupported URL: {url}")
+	port = parts.port or (443 if (parts.scheme == "https") else 80)
+	target = parts.path or "/"
+	if parts.query != "":
+		target += "?" + parts.query
+	return ((parts.scheme, parts.hostname, port), target)
+
+
+
+# ---- Connection pool ----
+
+# Keeps idle keep-alive connections to each upstream host for reuse by later requests, from threads
+# (with get() and open_stream()) and from coroutines (with fetch() and open_stream_async()). Idle connections are evicted
+# after 'idletimeout' seconds or when the server closes them, and at most 'maxperhost' requests to one host
+# run at a time. New connections made for threads resume the TLS session of an earlier one to the same host.
+class ConnectionPool:
+	
+	def __init__(self, maxperhost=6, idletimeout=30.0):
+		self.maxperhost = maxperhost
+		self.idletimeout = idletimeout
+		self.ssl_context = ssl.create_default_context()
+		self._idle = collections.defaultdict(list)  # Pool key -> list of (http.client.HTTPConnection, time.monotonic() when idle)
+		self._async_idle = collections.defaultdict(list)  # Pool key -> list of (StreamReader, StreamWriter, time.monotonic() when idle)
+		self._slots = {}  # Pool key -> threading.BoundedSemaphore
+		self._async_slots = {}  # Pool key -> asyncio.Semaphore
+		self._tls_sessions = {}  # (host, port) -> ssl.SSLSession
+		self._lock = threading.Lock()
+	
+	
+	def configure(self, config):
+		self.maxperhost = config.get("http-client-max-connections-per-host", self.maxperhost)
+		self.idletimeout = config.get("http-client-idle-timeout", self.idletimeout)
+	
+	
+	# Performs a GET request on the current thread and reads the whole body. See open_stream().
+	def get(self, url, timeout, headers=()):
+		stream = self.open_stream(url, timeout, headers)
+		try:
+			body = stream.read()
+		finally:
+			stream.close()
+		return Response(stream.url, stream.status, stream.reason, stream.headers, body)
+	
+	
+	# Performs a GET request on the current thread, following redirects and raising urllib.error.HTTPError
+	# for a final status of 400 or above, like urllib.request.urlopen(). Other failures raise urllib.error.URLError.
+	# The timeout in seconds applies to each blocking operation. Returns a StreamingResponse, which must be closed.
+	def open_stream(self, url, timeout, headers=()):
+		for _ in range(MAX_REDIRECTS + 1):
+			stream = self._open_once(url, timeout, headers)
+			try:
+				location = _check_response(url, stream)
+			except BaseException:
+				stream.close()
+				raise
+			if location is None:
+				return stream
+			try:
+				stream.read()  # So that the connection can be reused
+			finally:
+				stream.close()
+			url = location
+		raise urllib.error.URLError("Too many redirects")
+	
+	
+	def _open_once(self, url, timeout, extraheaders):
+		key, target = _split_url(url)
+		headers = {"User-Agent": USER_AGENT}
+		headers.update(extraheaders)
+		with self._lock:
+			slots = self._slots.get(key)
+			if slots is None:
+				slots = self._slots[key] = threading.BoundedSemaphore(self.maxperhost)
+		if not slots.acquire(timeout=timeout):
+			raise urllib.error.URLError(f"Too many connections to {key[1]}")
+		try:
+			while True:
+				conn, reused = self._checkout(key, timeout)
+				try:
+					conn.request("GET", target, headers=headers)
+					resp = conn.getresponse()
+				except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+					conn.close()
+					if reused:
+						continue  # The server closed the idle connection just as it was reused
+					raise urllib.error.URLError(e)
+				except (OSError, http.client.HTTPException) as e:
+					conn.close()
+					raise urllib.error.URLError(e)
+				return StreamingResponse(url, resp, lambda: self._release(key, conn, resp, slots))
+		except BaseException:
+			slots.release()
+			raise
+	
+	
+	def _release(self, key, conn, resp, slots):
+		try:
+			if resp.isclosed() and not resp.will_close:
+				self._checkin(key, conn)
+			else:
+				conn.close()  # The rest of the body was not read, or the server will close
+		finally:
+			slots.release()
+	
+	
+	# Returns (connection, whether it was used before).
+	def _checkout(self, key, timeout):
+		now = time.monotonic()
+		with self._lock:
+			self._evict(now)
+			idle = self._idle.get(key)
+			while idle:
+				conn, _ = idle.pop()
+				if select.select([conn.sock], [], [], 0)[0]:
+					conn.close()  # Closed by the server, or sent something unexpected
+					continue
+				conn.sock.settimeout(timeout)
+				conn.timeout = timeout
+				return (conn, True)
+		scheme, host, port = key
+		if scheme == "https":
+			return (_PooledHTTPSConnection(self, host, port, timeout), False)
+		return (http.client.HTTPConnection(host, port, timeout=timeout), False)
+	
+	
+	def _checkin(self, key, conn):
+		now = time.monotonic()
+		with self._lock:
+			if isinstance(conn.sock, ssl.SSLSocket) and conn.sock.session is not None:
+				self._tls_sessions[key[1 : ]] = conn.sock.session
+			self._idle[key].append((conn, now))
+			self._evict(now)
+	
+	
+	# Closes thread connections that have been idle for too long. Must hold the lock.
+	def _evict(self, now):
+		for (key, idle) in list(self._idle.items()):
+			for item in [item for item in idle if now - item[1] >= self.idletimeout]:
+				idle.remove(item)
+				item[0].close()
+			if len(idle) == 0:
+				del self._idle[key]
+	
+	
+	# Performs a GET request without blocking the event loop and reads the whole body, following redirects
+	# like get(). Raises asyncio.TimeoutError if the whole exchange takes longer than the timeout in seconds.
+	async def fetch(self, url, timeout, headers=()):
+		async def fetch_all():
+			stream = await self.open_stream_async(url, timeout, headers)
+			try:
+				body = await stream.read()
+			finally:
+				stream.close()
+			return Response(stream.url, stream.status, stream.reason, stream.headers, body)
+		return await asyncio.wait_for(fetch_all(), timeout)
+	
+	
+	# Like open_stream(), but without blocking the event loop. Returns an AsyncStreamingResponse, which must be closed.
+	# The timeout in seconds applies to receiving the response header and to each read of the body.
+	async def open_stream_async(self, url, timeout, headers=()):
+		for _ in range(MAX_REDIRECTS + 1):
+			stream = await asyncio.wait_for(self._open_once_async(url, headers, timeout), timeout)
+			try:
+				location = _check_response(url, stream)
+			except BaseException:
+				stream.close()
+				raise
+			if location is None:
+				return stream
+			try:
+				await stream.read()  # So that the connection can be reused
+			finally:
+				stream.close()
+			url = location
+		raise urllib.error.URLError("Too many redirects")
+	
+	
+	async def _open_once_async(self, url, extraheaders, timeout):
+		key, target = _split_url(url)
+		slots = self._async_slots.get(key)
+		if slots is None:
+			slots = self._async_slots[key] = asyncio.Semaphore(self.maxperhost)
+		await slots.acquire()
+		try:
+			while True:
+				reader, writer, reused = await self._async_checkout(key)
+				try:
+					stream = await self._send_request(reader, writer, url, key, target, extraheaders, timeout)
+				except (asyncio.IncompleteReadError, ConnectionError) as e:
+					writer.close()
+					if reused:
+						continue  # The server closed the idle connection just as it was reused
+					raise urllib.error.URLError(f"Invalid response: {e}")
+				except (asyncio.LimitOverrunError, ValueError) as e:
+					writer.close()
+					raise urllib.error.URLError(f"Invalid response: {e}")
+				except BaseException:
+					writer.close()
+					raise
+				stream._release = lambda: self._async_release(key, reader, writer, stream, slots)
+				return stream
+		except BaseException:
+			slots.release()
+			raise
+	
+	
+	def _async_release(self, key, reader, writer, stream, slots):
+		if stream._done and stream._keepalive:
+			with self._lock:
+				self._async_idle[key].append((reader, writer, time.monotonic()))
+		else:
+			writer.close()  # The rest of the body was not read, or the server will close
+		slots.release()
+	
+	
+	# Returns (reader, writer, whether the connection was used before).
+	async def _async_checkout(self, key):
+		now = time.monotonic()
+		with self._lock:
+			for (k, idle) in list(self._async_idle.items()):
+				for item in [item for item in idle if now - item[2] >= self.idletimeout]:
+					idle.remove(item)
+					item[1].close()
+				if len(idle) == 0:
+					del self._async_idle[k]
+			idle = self._async_idle.get(key)
+			while idle:
+				reader, writer, _ = idle.pop()
+				if reader.at_eof() or writer.is_closing():
+					writer.close()
+					continue
+				return (reader, writer, True)
+		scheme, host, port = key
+		reader, writer = await asyncio.open_connection(host, port,
+			ssl=(self.ssl_context if (scheme == "https") else None), limit=MAX_HEADER_BYTES)
+		return (reader, writer, False)
+	
+	
+	# Sends the request and reads the response header.
+	async def _send_request(self, reader, writer, url, key, target, extraheaders, timeout):
+		host = key[1] if (key[2] == (443 if (key[0] == "https") else 80)) else f"{key[1]}:{key[2]}"
+		request = [f"GET {target} HTTP/1.1", f"Host: {host}", f"User-Agent: {USER_AGENT}", "Accept-Encoding: identity"]
+		request.extend(f"{k}: {v}" for (k, v) in extraheaders)
+		writer.write(("\r\n".join(request) + "\r\n\r\n").encode("ISO-8859-1"))
+		await writer.drain()
+		
+		head = (await reader.readuntil(b"\r\n\r\n")).decode("ISO-8859-1")
+		statusline, *headerlines = head.split("\r\n")[ : -2]
+		version, status, reason = (statusline.split(" ", 2) + [""])[ : 3]
+		headers = []
+		for line in headerlines:
+			k, _, v = line.partition(":")
+			headers.append((k.strip(), v.strip()))
+		return AsyncStreamingResponse(url, version, int(status), reason, headers, reader, timeout)
+
+
+# A response whose body is read incrementally from a pooled connection on the current thread.
+# Closing it returns the connection to the pool if the whole body was read.
+class StreamingResponse(Response):
+	
+	def __init__(self, url, resp, release):
+		super().__init__(url, resp.status, resp.reason, resp.getheaders(), None)
+		self._resp = resp
+		self._release = release
+	
+	
+	# Returns up to 'size' bytes of the body (all the rest if negative), or b"" at the end.
+	def read(self, size=-1):
+		try:
+			return self._resp.read(None if (size < 0) else size)
+		except (OSError, http.client.HTTPException) as e:
+			self.close()
+			raise urllib.error.URLError(e)
+	
+	
+	# Returns up to 'size' bytes of the body, with at most one read from the socket, or b"" at the end.
+	def read1(self, size=-1):
+		try:
+			return self._resp.read1(size)
+		except (OSError, http.client.HTTPException) as e:
+			self.close()
+			raise urllib.error.URLError(e)
+	
+	
+	def close(self):
+		if self._release is not None:
+			release, self._release = self._release, None
+			release()
+
+
+# A response whose body is read incrementally from a pooled connection by coroutines.
+# Closing it returns the connection to the pool if the whole body was read.
+class AsyncStreamingResponse(Response):
+	
+	def __init__(self, url, version, status, reason, headers, reader, timeout):
+		super().__init__(url, status, reason, headers, None)
+		self._reader = reader
+		self._timeout = timeout
+		self._release = None
+		self._keepalive = version == "HTTP/1.1" and "close" not in (self.getheader("Connection") or "").lower()
+		length = self.getheader("Content-Length")
+		self._chunked = "chunked" in (self.getheader("Transfer-Encoding") or "").lower()
+		self._remaining = None  # Bytes left in the body (or in the current chunk if chunked), or None until end of stream
+		if status in (204, 304) or 100 <= status < 200:
+			self._remaining = 0
+		elif self._chunked:
+			self._remaining = 0
+		elif length is not None:
+			self._remaining = int(length)
+		else:
+			self._keepalive = False
+		self._done = self._remaining == 0 and not self._chunked
+	
+	
+	# Returns up to 'size' bytes of the body (all the rest if negative), or b"" at the end.
+	async def read(self, size=-1):
+		if size >= 0:
+			try:
+				return await asyncio.wait_for(self._read_some(size), self._timeout)
+			except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError) as e:
+				self.close()
+				raise urllib.error.URLError(f"Invalid response: {e}")
+		chunks = []
+		while True:
+			chunk = await self.read(65536)
+			if len(chunk) == 0:
+				return b"".join(chunks)
+			chunks.append(chunk)
+	
+	
+	async def _read_some(self, size):
+		if self._done or size == 0:
+			return b""
+		reader = self._reader
+		if self._chunked and self._remaining == 0:
+			self._remaining = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+			if self._remaining == 0:
+				while (await reader.readuntil(b"\r\n")) != b"\r\n":
+					pass  # Skip trailer fields
+				self._done = True
+				return b""
+		if self._remaining is None:
+			result = await reader.read(size)
+			self._done = len(result) == 0
+			return result
+		result = await reader.read(min(size, self._remaining))  # Whatever has arrived, so that the body streams
+		if len(result) == 0:
+			raise asyncio.IncompleteReadError(result, self._remaining)
+		self._remaining -= len(result)
+		if self._remaining == 0:
+			if self._chunked:
+				await reader.readexactly(2)
+			else:
+				self._done = True
+		return result
+	
+	
+	def close(self):
+		if self._release is not None:
+			release, self._release = self._release, None
+			release()
+
+
+# An HTTPS connection that resumes the pool's last TLS session with the same host, if any.
+class _PooledHTTPSConnection(http.client.HTTPConnection):
+	
+	default_port = 443
+	
+	
+	def __init__(self, pool, host, port, timeout):
+		super().__init__(host, port, timeout=timeout)
+		self._pool = pool
+	
+	
+	def connect(self):
+		super().connect()
+		session = self._pool._tls_sessions.get((self.host, self.port))
+		self.sock = self._pool.ssl_context.wrap_socket(self.sock, server_hostname=self.host, session=session)
+
+
+# The pool shared by all outbound requests.
+default_pool = ConnectionPool()
+
+def get(url, timeout, headers=()):
+	return default_pool.get(url, timeout, headers)
+
+
+def open_stream(url, timeout, headers=()):
+	return default_pool.open_stream(url, timeout, headers)
+
+
+async def fetch(url, timeout, headers=()):
+	return await default_pool.fetch(url, timeout, headers)
+
+
+async def open_stream_async(url, timeout, headers=()):
+	return await default_pool.open_stream_async(url, timeout, headers)
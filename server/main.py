@@ -15,7 +15,7 @@
 import sys
 if sys.version_info[ : 3] < (3, 0, 0):
 	raise RuntimeError("Requires Python 3+")
-import bottle, json, modules, os, socketserver, threading, urllib.error, urllib.request, wsgiref.simple_server
+import asyncio, bottle, engine, httpclient, io, json, modules, os, proxycache, staticfiles, tempfile, threading, time, urllib.error
 
 
 
@@ -27,66 +27,419 @@ MEDIA_TYPES = {
 	"html": "application/xhtml+xml",
 	"svg" : "image/svg+xml",
 	"ttf" : "application/x-font-ttf",
+	"woff": "font/woff",
 }
 
+# The characters that the clock can display in each font (see clock.scss and clock.ts), for making subset fonts.
+# Weather condition words are assumed to be plain English text, so the thin font keeps all of printable ASCII.
+FONT_SUBSET_TEXTS = {
+	"font/swiss-721-bt-bold-round.ttf": "0123456789:",  # Time
+	"font/swiss-721-bt-normal.ttf": "0123456789\u00A0\u2013SunMonTueWedThuFriSat",  # Local date
+	"font/swiss-721-bt-medium.ttf": "0123456789 -\u00B0\u2212C",  # Temperature
+	"font/swiss-721-bt-thin.ttf": "".join(map(chr, range(0x20, 0x7F))) + "\u00A0\u2002",  # UTC date/time, weather
+}
+FONT_SUBSET_DEFAULT_TEXT = "".join(map(chr, range(0x20, 0x7F))) + "\u00A0\u00B0\u2002\u2013\u2212"
+
+# Read config file, which is shared with the web client
+with open(os.path.join(WEB_ROOT_DIR, "config.json"), "rt", encoding="UTF-8") as fin:
+	configuration = json.load(fin)
+httpclient.default_pool.configure(configuration)
+
 
 
 # ---- Special routes ----
 
-# Simple redirect for the root path.
+# Serves the clock page as a single self-contained document if enabled,
+# otherwise redirects to the plain page.
 @bottle.route("/")
 def index():
+	if configuration.get("first-paint-bundle", False):
+		entry = static_bundle.get()
+		if entry is not None:
+			return staticfiles.cached_response(entry, MEDIA_TYPES["html"], "no-cache")
 	bottle.redirect("/file/clock.html", 301)
 
 
-# For bypassing CORS.
+# For bypassing CORS. Cacheable upstream responses are kept in the proxy cache and revalidated when stale.
 @bottle.route("/proxy/<path:path>")
+@engine.route_class("proxy")
 def proxy(path):
+	environ = bottle.request.environ
+	now = time.time()
+	response, entry = _proxy_lookup(path, environ, now)
+	if response is not None:
+		if entry is not None:
+			threading.Thread(target=_proxy_revalidate, args=(path, entry), daemon=True).start()
+		return response
 	try:
-		with urllib.request.urlopen(path, timeout=30) as fin:
-			data = fin.read()
-			temp = [val for (key, val) in fin.getheaders() if key == "Content-Type"]
-			if len(temp) == 1:
-				bottle.response.content_type = temp[0]
-			return data
+		upstream = httpclient.open_stream(path, 30, _proxy_request_headers(environ, entry))
 	except urllib.error.URLError:
 		bottle.abort(500)
+	try:
+		if entry is not None and upstream.status == 304:
+			upstream.close()
+			return _proxy_revalidated(entry, upstream, environ, now) or proxy(path)
+		length = _proxy_content_length(upstream)
+		bottle.response.status = upstream.status
+		for (key, val) in _proxy_response_headers(upstream.headers):
+			bottle.response.set_header(key, val)
+		writer = _proxy_cache_writer(path, environ, upstream, length, now)
+		if length is None:
+			body, length = _proxy_spool(upstream)
+			_proxy_cache_spooled(writer, body, length)
+		else:
+			body = _proxy_stream(upstream, length, writer)
+	except:
+		upstream.close()
+		raise
+	bottle.response.set_header("Content-Length", str(length))
+	return body
+
+
+@engine.async_version(proxy)
+async def proxy_async(path):
+	environ = engine.request_environ.get()
+	now = time.time()
+	response, entry = _proxy_lookup(path, environ, now)
+	if response is not None:
+		if entry is not None:
+			task = asyncio.get_running_loop().create_task(_proxy_revalidate_async(path, entry))
+			_proxy_revalidation_tasks.add(task)  # Keeps the task from being garbage-collected while it runs
+			task.add_done_callback(_proxy_revalidation_tasks.discard)
+		return response
+	try:
+		upstream = await httpclient.open_stream_async(path, 30, _proxy_request_headers(environ, entry))
+	except (urllib.error.URLError, OSError, asyncio.TimeoutError):
+		bottle.abort(500)
+	try:
+		if entry is not None and upstream.status == 304:
+			upstream.close()
+			return _proxy_revalidated(entry, upstream, environ, now) or await proxy_async(path)
+		length = _proxy_content_length(upstream)
+		headers = dict(_proxy_response_headers(upstream.headers))
+		writer = _proxy_cache_writer(path, environ, upstream, length, now)
+		if length is None:
+			body, length = await _proxy_spool_async(upstream)
+			_proxy_cache_spooled(writer, body, length)
+		else:
+			body = _proxy_stream_async(upstream, length, writer)
+	except:
+		upstream.close()
+		raise
+	headers["Content-Length"] = str(length)
+	return bottle.HTTPResponse(body, upstream.status, **headers)
+
+
+PROXY_CHUNK_BYTES = 64 * 2**10
+PROXY_SPOOL_MEMORY_BYTES = 2**20  # Bodies of unknown length beyond this are spooled to a temporary file
+PROXY_REQUEST_HEADERS = ("Range", "If-Range", "If-None-Match", "If-Modified-Since")
+PROXY_RESPONSE_HEADERS = ("Content-Type", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified", "Cache-Control", "Expires")
+
+proxy_cache = proxycache.ProxyCache(
+	configuration.get("proxy-cache-memory-bytes", 8 * 2**20), "proxy-cache",
+	configuration.get("proxy-cache-disk-bytes", 64 * 2**20), configuration.get("proxy-cache-max-entry-bytes", 2**20))
+_proxy_revalidation_tasks = set()
+
+
+# Returns (response or None, entry or None). If there is a response, it came from the cache, and the entry
+# (if any) is stale and must be revalidated in the background. Otherwise the request must go upstream, and
+# the entry (if any) is stale and its validators must be sent instead of the client's.
+def _proxy_lookup(path, environ, now):
+	if "HTTP_RANGE" in environ:
+		proxy_cache.count("bypasses")
+		return (None, None)
+	entry = proxy_cache.get(path)
+	if entry is None:
+		proxy_cache.count("misses")
+		return (None, None)
+	if not entry.can_serve_stale(now):
+		return (None, entry)
+	response = _proxy_cached_response(entry, environ, now)
+	if response is None:
+		proxy_cache.count("misses")
+		return (None, None)
+	if entry.is_fresh(now):
+		proxy_cache.count("hits")
+		return (response, None)
+	proxy_cache.count("stale-hits")
+	return (response, entry if proxy_cache.begin_revalidation(path) else None)
+
+
+# Returns a response from the given cache entry, answering the client's conditional request if possible,
+# or returns None if the body was evicted just now.
+def _proxy_cached_response(entry, environ, now):
+	headers = dict(_proxy_response_headers(entry.headers))
+	headers["Age"] = str(int(entry.age(now)))
+	if entry.is_not_modified(environ):
+		return bottle.HTTPResponse(b"", 304, **headers)
+	body = entry.open_body()
+	if body is None:
+		return None
+	headers["Content-Length"] = str(entry.size)
+	return bottle.HTTPResponse(body, 200, **headers)
+
+
+# Handles a 304 (Not Modified) response to the given stale entry's validators.
+def _proxy_revalidated(entry, upstream, environ, now):
+	proxy_cache.freshen(entry, upstream.headers, now)
+	proxy_cache.count("revalidated")
+	return _proxy_cached_response(entry, environ, now)
+
+
+# Revalidates a stale entry that was served to a client, replacing it if the upstream resource changed.
+def _proxy_revalidate(path, entry):
+	try:
+		upstream = httpclient.open_stream(path, 30, entry.validators())
+		try:
+			if upstream.status == 304:
+				proxy_cache.freshen(entry, upstream.headers, time.time())
+				proxy_cache.count("revalidated")
+			elif proxycache.is_cacheable(upstream.status, upstream.headers):
+				proxy_cache.put(path, upstream.headers, upstream.read(proxy_cache.maxentrybytes + 1), time.time())
+		finally:
+			upstream.close()
+	except urllib.error.URLError:
+		pass  # The entry stays stale, so the next request after the stale-while-revalidate window goes upstream
+	finally:
+		proxy_cache.end_revalidation(path)
+
+
+async def _proxy_revalidate_async(path, entry):
+	try:
+		upstream = await httpclient.open_stream_async(path, 30, entry.validators())
+		try:
+			if upstream.status == 304:
+				proxy_cache.freshen(entry, upstream.headers, time.time())
+				proxy_cache.count("revalidated")
+			elif proxycache.is_cacheable(upstream.status, upstream.headers):
+				chunks = []
+				size = 0
+				while size <= proxy_cache.maxentrybytes:
+					chunk = await upstream.read(PROXY_CHUNK_BYTES)
+					if len(chunk) == 0:
+						break
+					chunks.append(chunk)
+					size += len(chunk)
+				proxy_cache.put(path, upstream.headers, b"".join(chunks), time.time())
+		finally:
+			upstream.close()
+	except (urllib.error.URLError, OSError, asyncio.TimeoutError):
+		pass
+	finally:
+		proxy_cache.end_revalidation(path)
+
+
+# Returns a function that stores the whole upstream body in the cache, or None if the response must not be stored.
+def _proxy_cache_writer(path, environ, upstream, length, now):
+	if "HTTP_RANGE" in environ or (length is not None and length > proxy_cache.maxentrybytes) \
+			or not proxycache.is_cacheable(upstream.status, upstream.headers):
+		return None
+	headers = upstream.headers
+	return lambda body: proxy_cache.put(path, headers, body, now)
+
+
+def _proxy_cache_spooled(writer, body, length):
+	if writer is None or length > proxy_cache.maxentrybytes:
+		return
+	if isinstance(body, bytes):
+		writer(body)
+	else:
+		writer(body.read())
+		body.seek(0)
+
+
+def _proxy_request_headers(environ, entry):
+	if entry is not None:
+		return entry.validators()
+	result = []
+	for key in PROXY_REQUEST_HEADERS:
+		val = environ.get("HTTP_" + key.upper().replace("-", "_"))
+		if val is not None:
+			result.append((key, val))
+	return result
+
+
+def _proxy_response_headers(headers):
+	return [(key, val) for (key, val) in headers if key.title() in PROXY_RESPONSE_HEADERS]
+
+
+# Returns the upstream body's declared length, or None if unknown, after checking it against the size limit.
+def _proxy_content_length(upstream):
+	length = upstream.getheader("Content-Length")
+	if length is None or not length.isdigit() or "chunked" in (upstream.getheader("Transfer-Encoding") or "").lower():
+		return None
+	length = int(length)
+	if length > configuration.get("proxy-max-bytes", 64 * 2**20):
+		bottle.abort(502, "Upstream response too large")
+	return length
+
+
+# Passes the body through as it arrives, and gives the whole body to the cache writer (if any) at the end.
+# Failing midway makes the server close the connection, so the client sees a truncated response instead of a wrong one.
+def _proxy_stream(upstream, length, writer=None):
+	chunks = []
+	try:
+		while length > 0:
+			chunk = upstream.read1(min(length, PROXY_CHUNK_BYTES))  # Forwards whatever has arrived
+			if len(chunk) == 0:
+				raise urllib.error.URLError("Upstream response ended early")
+			length -= len(chunk)
+			if writer is not None:
+				chunks.append(chunk)
+			yield chunk
+	finally:
+		upstream.close()
+	if writer is not None:
+		writer(b"".join(chunks))
+
+
+async def _proxy_stream_async(upstream, length, writer=None):
+	chunks = []
+	try:
+		while length > 0:
+			chunk = await upstream.read(min(length, PROXY_CHUNK_BYTES))
+			if len(chunk) == 0:
+				raise urllib.error.URLError("Upstream response ended early")
+			length -= len(chunk)
+			if writer is not None:
+				chunks.append(chunk)
+			yield chunk
+	finally:
+		upstream.close()
+	if writer is not None:
+		writer(b"".join(chunks))
+
+
+# Reads a body of unknown length up to the size limit, so that the client response can have a Content-Length.
+# Returns (bytes or temporary file positioned at the start, length).
+def _proxy_spool(upstream):
+	spool = _ProxySpool()
+	try:
+		while True:
+			chunk = upstream.read(PROXY_CHUNK_BYTES)
+			if len(chunk) == 0:
+				return spool.finish()
+			spool.write(chunk)
+	except:
+		spool.discard()
+		raise
+	finally:
+		upstream.close()
+
+
+async def _proxy_spool_async(upstream):
+	spool = _ProxySpool()
+	try:
+		while True:
+			chunk = await upstream.read(PROXY_CHUNK_BYTES)
+			if len(chunk) == 0:
+				return spool.finish()
+			spool.write(chunk)
+	except:
+		spool.discard()
+		raise
+	finally:
+		upstream.close()
+
+
+class _ProxySpool:
+	
+	def __init__(self):
+		self.buffer = io.BytesIO()
+		self.file = None
+		self.length = 0
+	
+	
+	def write(self, chunk):
+		self.length += len(chunk)
+		if self.length > configuration.get("proxy-max-bytes", 64 * 2**20):
+			bottle.abort(502, "Upstream response too large")
+		if self.file is None and self.length > PROXY_SPOOL_MEMORY_BYTES:
+			self.file = tempfile.TemporaryFile()
+			self.file.write(self.buffer.getvalue())
+			self.buffer = None
+		(self.buffer if (self.file is None) else self.file).write(chunk)
+	
+	
+	def finish(self):
+		if self.file is None:
+			return (self.buffer.getvalue(), self.length)
+		self.file.seek(0)
+		return (self.file, self.length)
+	
+	
+	def discard(self):
+		if self.file is not None:
+			self.file.close()
 
 
 
 # ---- Static files ----
 
-authorized_static_files = set()  # Automatically populated with data
-authorized_static_files_lock = threading.RLock()
+static_index = staticfiles.StaticFileIndex(WEB_ROOT_DIR)
+static_cache = staticfiles.StaticFileCache(WEB_ROOT_DIR, configuration.get("static-cache-bytes", 8 * 2**20))
+static_manifest = staticfiles.AssetManifest(WEB_ROOT_DIR, static_index, static_cache)
+static_bundle = staticfiles.FirstPaintBundle(static_index, static_cache, static_manifest, "clock.html", "config.json", "/file/")
+font_subsetter = staticfiles.FontSubsetter(static_cache, "font-cache", FONT_SUBSET_TEXTS, FONT_SUBSET_DEFAULT_TEXT)
+
+# Serves a subset of the font "font/<name>.ttf" with just the characters that the clock displays.
+# The style sheet lists these first, so clients fall back to the full font if this fails. Without fontTools,
+# the style sheet is served without them (see FontSubsetter.rewrite_css()).
+@bottle.route("/file/font/subset/<name>.woff")
+def font_subset(name):
+	srcpath = f"font/{name}.ttf"
+	if not static_index.lookup(srcpath):
+		bottle.abort(404)  # Also rejects names that would escape the web root
+	entry = font_subsetter.get(srcpath)
+	if entry is None:
+		bottle.abort(404)
+	return staticfiles.cached_response(entry, MEDIA_TYPES["woff"])
+
 
 # Serves all static files, such as HTML, CSS, JavaScript, images, fonts.
+# Content-hashed paths (see the asset manifest) can be cached forever.
 @bottle.route("/file/<path:path>")
 def static_file(path):
-	
-	# Recursively scans the given local file/directory, and populates the set 'authorized_static_files'.
-	def scan_files(fspath, webpath):
-		if os.path.isfile(fspath):
-			authorized_static_files.add(webpath)
-		elif os.path.isdir(fspath):
-			if webpath != "":
-				webpath += "/"
-			for name in os.listdir(fspath):
-				scan_files(os.path.join(fspath, name), webpath + name)
-	
-	with authorized_static_files_lock:
-		if path not in authorized_static_files:
-			authorized_static_files.clear()
-			scan_files(WEB_ROOT_DIR, "")
-		found = path in authorized_static_files
-	
-	if found:
-		mime = "auto"
-		for (ext, type) in MEDIA_TYPES.items():
-			if path.endswith("." + ext):
-				mime = type
-		return bottle.static_file(path, root=WEB_ROOT_DIR, mimetype=mime)
-	else:
+	cachecontrol = None
+	original = static_manifest.unhash(path)
+	if original is not None:
+		path = original
+		cachecontrol = "public, max-age=31536000, immutable"
+	elif not static_index.lookup(path):
 		bottle.abort(404)
+	
+	mime = "auto"
+	for (ext, type) in MEDIA_TYPES.items():
+		if path.endswith("." + ext):
+			mime = type
+	entry = static_cache.get(path)
+	if entry is not None and path.endswith(".html"):
+		entry = static_manifest.rewrite_html(path, entry)
+		cachecontrol = "no-cache"
+	elif entry is not None and path.endswith(".css"):
+		entry = font_subsetter.rewrite_css(path, static_manifest.rewrite_css(path, entry))
+	if entry is not None:
+		return staticfiles.cached_response(entry, mime, cachecontrol)
+	return staticfiles.file_response(WEB_ROOT_DIR, path, mime, cachecontrol)
+
+
+# Maps every static file to its content-hashed path.
+@bottle.route("/asset-manifest.json")
+def asset_manifest():
+	return json_response(static_manifest.to_dict())
+
+
+
+# ---- Server statistics ----
+
+# Reports the worker pool size, how many workers are busy, how many requests are queued for one,
+# the proxy cache's hit and miss counters, and the NTP servers that the time sampler uses.
+@bottle.route("/server-stats.json")
+def server_stats():
+	result = engine.server_stats()
+	result["proxy-cache"] = proxy_cache.stats()
+	result["time-sampler"] = modules.time_sampler_stats()
+	return json_response(result)
 
 
 
@@ -98,15 +451,14 @@ def json_response(data):
 	return json.dumps(data)
 
 
+# Like json_response(), but for async route versions, which cannot use Bottle's thread-local response object.
+def json_http_response(data):
+	return bottle.HTTPResponse(json.dumps(data), Content_Type="application/json", Cache_Control="no-cache")
+
+
 
 # ---- Initialization ----
 
-# Read config file and launch web server app
+# Launch web server app
 if __name__ == "__main__":
-	with open(os.path.join(WEB_ROOT_DIR, "config.json"), "rt", encoding="UTF-8") as fin:
-		configuration = json.load(fin)
-	class ThreadingWSGIServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
-		daemon_threads = True
-	server = wsgiref.simple_server.make_server(
-		"0.0.0.0", configuration["web-server-port"], bottle.default_app(), ThreadingWSGIServer)
-	server.serve_forever()
+	engine.serve_forever("0.0.0.0", configuration["web-server-port"], bottle.default_app(), configuration)
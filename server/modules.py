@@ -9,77 +9,390 @@
 
 # ---- Prelude ----
 
-import re, urllib.request
-import bottle, main
+import asyncio, json, re
+import bottle, engine, httpclient, main, sharedcache
 
 if __name__ == "__main__":
 	raise AssertionError()
 
 
 
+# ---- Shared results ----
+
+# Upstream query results, written once and then read by every server process.
+shared_results = sharedcache.SharedCache("shared-results.bin")
+
+# Upstream queries in progress in this process, so that identical concurrent requests make only one.
+upstream_calls = sharedcache.SingleFlight()
+
+def get_shared_json(key):
+	data = shared_results.get(key)
+	return json.loads(data) if (data is not None) else None
+
+
+def put_shared_json(key, value, ttl):
+	shared_results.put(key, json.dumps(value).encode("UTF-8"), ttl)
+
+
+
 # ---- Time ----
 
-import contextlib, socket, struct, time
+import collections, contextlib, math, os, random, socket, threading, time
+import ntp
 
+# Returns the current time in Unix milliseconds (with microsecond resolution), from the background sampler's
+# offset estimate if the server is the configured one, otherwise by querying the server right now.
 @bottle.route("/time/<protocol>/<host>/<port:int>")
+@engine.route_class("time")
 def get_time(protocol, host, port):
+	offset = _get_offset(protocol, host, port)
+	return main.json_response(_time_from_offset(offset))
+
+
+@engine.async_version(get_time)
+async def get_time_async(protocol, host, port):
+	offset = await _get_offset_async(protocol, host, port)
+	return main.json_http_response(_time_from_offset(offset))
+
+
+# A four-timestamp exchange for clients that measure their offset and the round-trip delay like an NTP client.
+# Echoes the client's send time (query parameter "t1") along with the server's receive and transmit times
+# "t2" and "t3", all in Unix milliseconds. The offset is looked up first, so that it never counts as server time,
+# but only after "t1" is checked, so that an invalid request does not cause a query to the time server.
+@bottle.route("/time-sync/<protocol>/<host>/<port:int>")
+@engine.route_class("time")
+def time_sync(protocol, host, port):
+	t1 = _parse_t1(bottle.request.query.get("t1"))
+	offset = _get_offset(protocol, host, port)
+	return main.json_response(_time_sync_result(t1, offset))
+
+
+@engine.async_version(time_sync)
+async def time_sync_async(protocol, host, port):
+	t1 = _parse_t1(bottle.BaseRequest(engine.request_environ.get()).query.get("t1"))
+	offset = await _get_offset_async(protocol, host, port)
+	return main.json_http_response(_time_sync_result(t1, offset))
+
+
+# Returns the given server's offset from the local clock in microseconds.
+def _get_offset(protocol, host, port):
 	if protocol != "ntp":
 		raise ValueError()
+	offset = _sampled_offset(host, port)
+	if offset is None:
+		key = f"time/{host}/{port}"
+		offset = get_shared_json(key)
+		if offset is None:
+			offset = upstream_calls.do(key, lambda: _query_ntp(host, port))
+	return offset
+
+
+async def _get_offset_async(protocol, host, port):
+	if protocol != "ntp":
+		raise ValueError()
+	offset = _sampled_offset(host, port)
+	if offset is None:
+		key = f"time/{host}/{port}"
+		offset = get_shared_json(key)
+		if offset is None:
+			offset = await upstream_calls.do_async(key, lambda: _query_ntp_async(host, port))
+	return offset
+
+
+def _parse_t1(text):
+	try:
+		result = float(text)
+	except (TypeError, ValueError):
+		result = math.nan
+	if not math.isfinite(result):
+		bottle.abort(400, "Invalid t1")
+	return result
+
+
+def _time_sync_result(t1, offset):
+	received = _time_from_offset(offset)
+	return {"t1": t1, "t2": received, "t3": _time_from_offset(offset)}
+
+
+TIME_SHARE_SECONDS = 60  # The offset from the local clock is shared, not the time itself
+
+
+# Queries the given NTP server, and returns and shares its offset from the local clock in microseconds.
+def _query_ntp(host, port):
+	offset = ntp.exchange(socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_DGRAM)[0][4])[0]
+	put_shared_json(f"time/{host}/{port}", offset, TIME_SHARE_SECONDS)
+	return offset
+
+
+async def _query_ntp_async(host, port):
+	loop = asyncio.get_running_loop()
+	target = (await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM))[0][4]
+	with contextlib.closing(ntp.open_socket()) as sock:
+		received = loop.create_future()
+		def on_readable():
+			if not received.done():
+				try:
+					result = reply.receive()
+				except OSError as e:
+					received.set_exception(e)
+					return
+				if result is not None:
+					received.set_result(result)
+		
+		try:
+			loop.add_reader(sock.fileno(), on_readable)
+		except NotImplementedError:  # The proactor event loop on Windows cannot watch sockets
+			return await loop.run_in_executor(None, _query_ntp, host, port)
+		localstart = time.time_ns()
+		request = ntp.make_request(localstart)
+		try:
+			sock.sendto(request, target)
+			reply = ntp.Reply(sock, localstart)
+			packet, localstart, localend = await asyncio.wait_for(received, ntp.TIMEOUT)
+		finally:
+			loop.remove_reader(sock.fileno())
+	offset = ntp.reply_sample(request, packet, localstart, localend)[0]
+	put_shared_json(f"time/{host}/{port}", offset, TIME_SHARE_SECONDS)
+	return offset
+
+
+def _time_from_offset(offset):
+	return (time.time_ns() // 1000 + offset) / 1000
+
+
+# Returns the sampler's current offset estimate in microseconds if the given server is the configured
+# time server, starting the sampler in this process on first use, or None if there is no estimate yet.
+def _sampled_offset(host, port):
+	global _time_sampler
+	if main.configuration.get("time-server") != ["ntp", host, str(port)]:
+		return None
+	with _time_sampler_lock:
+		if _time_sampler is None or _time_sampler.pid != os.getpid():
+			_time_sampler = NtpSampler(host, port)
+			_time_sampler.start()
+		sampler = _time_sampler
+	return sampler.offset()
+
+
+def time_sampler_stats():
+	sampler = _time_sampler
+	return None if (sampler is None or sampler.pid != os.getpid()) else sampler.stats()
+
+
+_time_sampler = None  # Of this process
+_time_sampler_lock = threading.Lock()
+
+
+# Polls several servers of an NTP pool in the background, on an interval that grows while their combined
+# estimate is stable and shrinks when it jumps. Each server's samples pass through a clock filter (the
+# lowest-delay one of its recent samples wins), then an intersection (Marzullo) step keeps the majority of
+# servers whose correctness intervals overlap, and their offsets are averaged weighted by root distance.
+# Estimates are shared with other server processes, which adopt them instead of polling themselves.
+class NtpSampler:
 	
-	with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as sock:
-		sock.bind(("0.0.0.0", 0))
-		sock.settimeout(1.0)
-		target = socket.getaddrinfo(host, port)[0][4]
+	MAX_SERVERS = 4
+	FILTER_SAMPLES = 8
+	BURST_SAMPLES = 4  # Sent to each server in the first round, to fill the clock filter quickly
+	MIN_POLL_SECONDS = 16
+	MAX_POLL_SECONDS = 1024
+	MAX_ESTIMATE_AGE = 3 * MAX_POLL_SECONDS  # Beyond this, requests fall back to querying directly
+	FREQUENCY_TOLERANCE = 15e-6  # Assumed worst-case local clock frequency error, in seconds per second
+	PRECISION = 1000  # Microseconds added to every root distance for timestamp resolution
+	
+	
+	def __init__(self, host, port):
+		self.host = host
+		self.port = port
+		self.pid = os.getpid()
+		self.interval = self.MIN_POLL_SECONDS
+		self._samples = {}  # Server socket address -> deque of samples from ntp.reply_sample(), each with the monotonic time appended
+		self._report = []  # Per-server statistics from the latest poll
+		self._estimate = None  # (offset, root distance, Unix time) in microseconds and seconds
+		self._sharekey = f"time-estimate/{host}/{port}"
+	
+	
+	def start(self):
+		threading.Thread(target=self._run, name=f"ntp-sampler-{self.host}", daemon=True).start()
+	
+	
+	def stats(self):
+		estimate = self._estimate
+		return {
+			"poll-interval": self.interval,
+			"offset-us": None if (estimate is None) else estimate[0],
+			"root-distance-us": None if (estimate is None) else estimate[1],
+			"servers": self._report,  # Empty in processes that adopt another process's estimates
+		}
+	
+	
+	# Returns the current offset estimate in microseconds, or None if there is none or it is too old.
+	def offset(self):
+		estimate = self._estimate
+		if estimate is None or time.time() - estimate[2] > self.MAX_ESTIMATE_AGE:
+			return None
+		return estimate[0]
+	
+	
+	def _run(self):
+		first = True
+		while True:
+			try:  # Any failure must not end the thread, or the estimate would silently go stale
+				shared = get_shared_json(self._sharekey)
+				if shared is not None and (self._estimate is None or shared[2] > self._estimate[2]):
+					# Another process polled recently, so adopt its estimate and wait until after its next poll
+					offset, distance, updated, self.interval = shared
+					self._estimate = (offset, distance, updated)
+					time.sleep(max(updated + self.interval - time.time(), 0) + random.uniform(1, self.MIN_POLL_SECONDS))
+					continue
+				self._poll(self.BURST_SAMPLES if first else 1)
+				first = False
+			except Exception:
+				self.interval = self.MIN_POLL_SECONDS
+			time.sleep(self.interval)
+	
+	
+	def _poll(self, count):
+		addrs = [info[4] for info in socket.getaddrinfo(self.host, self.port, socket.AF_INET, socket.SOCK_DGRAM)]
+		servers = list(self._samples)
+		for addr in addrs:
+			if len(servers) >= self.MAX_SERVERS:
+				break
+			if addr not in servers:
+				servers.append(addr)
 		
-		localstart = time.time()
-		sock.sendto(bytes([0x1B] + [0] * 47), target)
-		packet = sock.recv(100)
-		localend = time.time()
+		for i in range(count):
+			if i > 0:
+				time.sleep(1)
+			for addr in servers:
+				try:
+					sample = ntp.exchange(addr)
+				except (OSError, ValueError):
+					continue
+				samples = self._samples.setdefault(addr, collections.deque(maxlen=self.FILTER_SAMPLES))
+				samples.append(sample + (time.monotonic(),))
 		
-		fields = struct.unpack(">BBBBIIIQQQQ", packet)
-		header = fields[0]
-		leap = header >> 6
-		version = (header >> 3) & 7
-		mode = header & 7
-		if leap == 3 or version != 3 or mode != 4:
-			raise ValueError("Response contains invalid data")
-		remotereceive = fields[9]
-		remotetransmit = fields[10]
-		networkdelay = ((localend - localstart) - (remotetransmit - remotereceive)) / 2.0
-		rawresult = remotetransmit + networkdelay
-		result = rawresult * 1000 // 2**32 - 2208988800000  # Convert to Unix milliseconds
-		return main.json_response(result)
-
+		# Forget servers that stopped answering, so that the pool can supply replacements
+		now = time.monotonic()
+		for addr in list(self._samples):
+			if now - self._samples[addr][-1][5] > 4 * self.interval:
+				del self._samples[addr]
+		
+		self._report = [self._report_server(addr, samples, now) for (addr, samples) in self._samples.items()]
+		candidates = [self._filter(samples, now) for samples in self._samples.values()]
+		selected = ntp.select_truechimers(candidates)
+		if selected is None:
+			self.interval = max(self.interval // 2, self.MIN_POLL_SECONDS)
+			return
+		offset, distance = selected
+		previous = self._estimate
+		if previous is not None and abs(offset - previous[0]) > 2 * max(distance, previous[1]):
+			self.interval = max(self.interval // 2, self.MIN_POLL_SECONDS)
+		else:
+			self.interval = min(self.interval * 2, self.MAX_POLL_SECONDS)
+		self._estimate = (offset, distance, time.time())
+		put_shared_json(self._sharekey, self._estimate + (self.interval,), self.interval)
+	
+	
+	# Returns (offset, root distance) in microseconds from the given server's recent samples. The root distance
+	# bounds the error from the reference clock: half the round trips to it, its dispersion, and local clock drift.
+	def _filter(self, samples, now):
+		offset, delay, _, rootdelay, rootdispersion, when = min(samples, key=lambda sample: sample[1])
+		return (offset, (delay + rootdelay) / 2 + rootdispersion + self.PRECISION
+			+ (now - when) * self.FREQUENCY_TOLERANCE * 1e6)
+	
+	
+	def _report_server(self, addr, samples, now):
+		offset, distance = self._filter(samples, now)
+		return {
+			"address": f"{addr[0]}:{addr[1]}",
+			"stratum": samples[-1][2],
+			"root-dispersion-us": samples[-1][4],
+			"offset-us": offset,
+			"root-distance-us": round(distance),
+		}
 
 
 # ---- Weather ----
 
 @bottle.route("/weather/<province>/<site>.xml")
+@engine.route_class("weather")
 def get_weather(province, site):
+	key = f"weather/{province}/{site}"
+	data = shared_results.get(key)
+	if data is None:
+		data = upstream_calls.do(key, lambda: _fetch_weather(key, province, site))
+	if data is not None:
+		bottle.response.content_type = "application/xml"
+		return data
+
+
+@engine.async_version(get_weather)
+async def get_weather_async(province, site):
+	key = f"weather/{province}/{site}"
+	data = shared_results.get(key)
+	if data is None:
+		data = await upstream_calls.do_async(key, lambda: _fetch_weather_async(key, province, site))
+	if data is None:
+		return bottle.HTTPResponse("")
+	return bottle.HTTPResponse(data, Content_Type="application/xml")
+
+
+# Returns and shares the newest citypage XML for the given site, or returns None if there is none.
+def _fetch_weather(key, province, site):
 	url0 = f"https://dd.weather.gc.ca/today/citypage_weather/{province}/"
-	with urllib.request.urlopen(url0) as inp:
-		data = inp.read()
-	text = data.decode("UTF-8")
-	for hour in reversed(re.findall(r'<a href="(\d{2}/)">\d{2}/</a>', text)):
-		url1 = url0 + hour
-		with urllib.request.urlopen(url1) as inp:
-			data = inp.read()
-		text = data.decode("UTF-8")
-		matches = re.findall(r'<a href="(\d{8}T\d{6}.\d{3}Z_MSC_CitypageWeather_s' + re.escape(site) + r'_en.xml)">', text)
-		if len(matches) > 0:
-			url2 = url1 + max(matches)
-			with urllib.request.urlopen(url2) as inp:
-				data = inp.read()
-			bottle.response.content_type = "application/xml"
+	data = httpclient.get(url0, WEATHER_FETCH_TIMEOUT).body
+	for url1 in _weather_hour_urls(url0, data):
+		data = httpclient.get(url1, WEATHER_FETCH_TIMEOUT).body
+		url2 = _weather_file_url(url1, data, site)
+		if url2 is not None:
+			data = httpclient.get(url2, WEATHER_FETCH_TIMEOUT).body
+			shared_results.put(key, data, WEATHER_SHARE_SECONDS)
+			return data
+	return None
+
+
+async def _fetch_weather_async(key, province, site):
+	url0 = f"https://dd.weather.gc.ca/today/citypage_weather/{province}/"
+	data = (await httpclient.fetch(url0, WEATHER_FETCH_TIMEOUT)).body
+	for url1 in _weather_hour_urls(url0, data):
+		data = (await httpclient.fetch(url1, WEATHER_FETCH_TIMEOUT)).body
+		url2 = _weather_file_url(url1, data, site)
+		if url2 is not None:
+			data = (await httpclient.fetch(url2, WEATHER_FETCH_TIMEOUT)).body
+			shared_results.put(key, data, WEATHER_SHARE_SECONDS)
 			return data
+	return None
+
+
+WEATHER_FETCH_TIMEOUT = 30
+WEATHER_SHARE_SECONDS = 300  # Citypage files are published about once an hour
+
+# Returns the URLs of the hourly subdirectories in the given directory listing, newest first.
+def _weather_hour_urls(url0, data):
+	text = data.decode("UTF-8")
+	return [url0 + hour for hour in reversed(re.findall(r'<a href="(\d{2}/)">\d{2}/</a>', text))]
+
+
+# Returns the URL of the newest file for the given site in the given directory listing, or None if there is none.
+def _weather_file_url(url1, data, site):
+	text = data.decode("UTF-8")
+	matches = re.findall(r'<a href="(\d{8}T\d{6}.\d{3}Z_MSC_CitypageWeather_s' + re.escape(site) + r'_en.xml)">', text)
+	return (url1 + max(matches)) if (len(matches) > 0) else None
 
 
 
 # ---- Wallpaper ----
 
-import contextlib, datetime, os, random, sqlite3
+import collections, concurrent.futures, contextlib, datetime, hashlib, math, os, random, sqlite3, threading, urllib.parse
+import staticfiles
+try:
+	import PIL.Image, PIL.ImageOps
+except ImportError:
+	PIL = None  # Wallpapers are served at their original size
 
-# Yields a file name or null, which a wallpaper that changes only once a day (history kept on the server side).
+# Yields a URL or null, which a wallpaper that changes only once a day (history kept on the server side).
+# The URL points to a copy scaled for the client's screen, given by the query parameters
+# "width" and "height" (in CSS pixels) and "dpr", or by the equivalent client hint headers.
 @bottle.route("/wallpaper-daily.json")
 def wallpaper_daily():
 	candidates = set(wallpaper_candidates())
@@ -101,7 +414,7 @@ def wallpaper_daily():
 		cur.execute("SELECT filename FROM wallpaper_history WHERE date=?", (today,))
 		data = cur.fetchone()
 		if data is not None:
-			return main.json_response(data[0])
+			return main.json_response(wallpaper_url(data[0]))
 		
 		# Get all known history of wallpapers
 		cur.execute("SELECT date, filename FROM wallpaper_history ORDER BY date DESC")
@@ -116,11 +429,38 @@ def wallpaper_daily():
 		if len(history) > maxhistory:
 			cur.execute("DELETE FROM wallpaper_history WHERE date <= ?", (history[maxhistory][0],))
 		
-		# Choose today's wallpaper and save it
-		result = random.choice(list(candidates))
-		cur.execute("INSERT INTO wallpaper_history VALUES(?, ?)", (today, result))
+		# Choose today's wallpaper and save it, unless another server process just did
+		cur.execute("INSERT OR IGNORE INTO wallpaper_history VALUES(?, ?)", (today, random.choice(list(candidates))))
 		con.commit()
-		return main.json_response(result)
+		cur.execute("SELECT filename FROM wallpaper_history WHERE date=?", (today,))
+		return main.json_response(wallpaper_url(cur.fetchone()[0]))
+
+
+def wallpaper_url(name):
+	query = bottle.request.query
+	headers = bottle.request.headers
+	try:
+		width  = float(query.get("width" ) or headers.get("Sec-CH-Viewport-Width" ) or headers.get("Viewport-Width"))
+		height = float(query.get("height") or headers.get("Sec-CH-Viewport-Height"))
+		dpr    = float(query.get("dpr"   ) or headers.get("Sec-CH-DPR") or headers.get("DPR") or 1.0)
+		width = round(width * dpr)
+		height = round(height * dpr)
+	except (TypeError, ValueError, OverflowError):
+		width = height = 0
+	if 0 < width <= WALLPAPER_MAX_SIZE and 0 < height <= WALLPAPER_MAX_SIZE:
+		width, height = wallpaper_bucket(width, height)
+		return f"/wallpaper/{width}x{height}/{urllib.parse.quote(name)}"
+	return "/file/wallpaper/" + urllib.parse.quote(name)
+
+
+# Returns the smallest derivative size that covers a screen of the given size, so that all screens share a small
+# set of derivatives: the longer side is rounded up to one of WALLPAPER_SIZE_BUCKETS, and the ratio of the shorter
+# side to the longer one is rounded up to a multiple of 1/WALLPAPER_ASPECT_STEPS.
+def wallpaper_bucket(width, height):
+	longer = max(width, height)
+	bucket = next((size for size in WALLPAPER_SIZE_BUCKETS if size >= longer), WALLPAPER_SIZE_BUCKETS[-1])
+	shorter = bucket * math.ceil(min(width, height) / longer * WALLPAPER_ASPECT_STEPS) // WALLPAPER_ASPECT_STEPS
+	return (bucket, shorter) if (width >= height) else (shorter, bucket)
 
 
 def wallpaper_candidates():
@@ -131,16 +471,203 @@ def wallpaper_candidates():
 		os.path.isfile(os.path.join(dir, name)) and name.endswith((".jpg", ".png"))]
 
 
+WALLPAPER_MAX_SIZE = 8192  # In physical pixels, for each dimension
+WALLPAPER_SIZE_BUCKETS = (640, 960, 1280, 1920, 2560, 3840, 5120, 7680, WALLPAPER_MAX_SIZE)
+WALLPAPER_ASPECT_STEPS = 8
+WALLPAPER_DERIVATIVE_DIR = "wallpaper-cache"
+WALLPAPER_UNNEEDED_MAX_ENTRIES = 1000
+
+_wallpaper_pool = None  # Created on first use
+_wallpaper_jobs = {}  # Derivative file name -> concurrent.futures.Future
+_wallpaper_unneeded = collections.OrderedDict()  # Derivative file names whose source is already small enough, or failed to process -> None
+_wallpaper_hashes = {}  # Source file path -> (stat key, content hash)
+_wallpaper_lock = threading.Lock()
+
+
+# Serves the given wallpaper scaled down and cropped to cover a screen of the given size in physical pixels,
+# like the CSS "background-size: cover" does. Derivatives are made in a process pool for the size's bucket only,
+# and cached on disk up to the configured "wallpaper-cache-bytes", beyond which the oldest ones are deleted.
+@bottle.route("/wallpaper/<width:int>x<height:int>/<name>")
+def wallpaper_derivative(width, height, name):
+	dir = os.path.join(main.WEB_ROOT_DIR, "wallpaper")
+	srcpath = os.path.join(dir, name)
+	if not name.endswith((".jpg", ".png")) or os.sep in name or not os.path.isfile(srcpath):
+		bottle.abort(404)
+	if PIL is not None and 0 < width <= WALLPAPER_MAX_SIZE and 0 < height <= WALLPAPER_MAX_SIZE:
+		dstname = get_wallpaper_derivative(srcpath, *wallpaper_bucket(width, height))
+		if dstname is not None:
+			return staticfiles.file_response(WALLPAPER_DERIVATIVE_DIR, dstname, "image/jpeg")
+	return staticfiles.file_response(dir, name, "auto")
+
+
+# Returns the name of the derivative file in WALLPAPER_DERIVATIVE_DIR, waiting for it to be made if necessary,
+# or None if the original file should be served instead.
+def get_wallpaper_derivative(srcpath, width, height):
+	hash = _wallpaper_source_hash(srcpath)
+	if hash is None:
+		return None
+	dstname = f"{hash}-{width}x{height}.jpg"
+	dstpath = os.path.join(WALLPAPER_DERIVATIVE_DIR, dstname)
+	if os.path.isfile(dstpath):
+		return dstname
+	
+	global _wallpaper_pool
+	with _wallpaper_lock:
+		if dstname in _wallpaper_unneeded:
+			return None
+		future = _wallpaper_jobs.get(dstname)
+	if future is None:
+		# Each new job holds a slot until it finishes. When the bulkhead is full, the original is served instead
+		bulkhead = engine.BULKHEADS.get("wallpaper")
+		if bulkhead is not None and not bulkhead.acquire():
+			return None
+		release = bulkhead.release if (bulkhead is not None) else None
+		try:
+			with _wallpaper_lock:
+				future = _wallpaper_jobs.get(dstname)  # Another request may have submitted it while this one waited
+				if future is None and not os.path.isfile(dstpath):
+					if _wallpaper_pool is None:
+						_wallpaper_pool = concurrent.futures.ProcessPoolExecutor(
+							main.configuration.get("wallpaper-derivative-processes", max((os.cpu_count() or 1) // 2, 1)))
+					os.makedirs(WALLPAPER_DERIVATIVE_DIR, exist_ok=True)
+					future = _wallpaper_pool.submit(_make_wallpaper_derivative, srcpath, dstpath, width, height)
+					_wallpaper_jobs[dstname] = future
+					if release is not None:
+						future.add_done_callback(lambda _: bulkhead.release())
+						release = None
+		finally:
+			if release is not None:
+				release()
+		if future is None:
+			return dstname
+	
+	try:
+		made = future.result(timeout=60)
+	except Exception:
+		made = False
+	with _wallpaper_lock:
+		if future.done() and _wallpaper_jobs.pop(dstname, None) is not None:
+			if made:
+				_trim_wallpaper_derivatives(dstname)
+			else:
+				_wallpaper_unneeded[dstname] = None
+				if len(_wallpaper_unneeded) > WALLPAPER_UNNEEDED_MAX_ENTRIES:
+					_wallpaper_unneeded.popitem(last=False)
+	return dstname if made else None
+
+
+# Deletes the oldest derivative files until the rest fit in the configured size, keeping the given newest one.
+# Must hold _wallpaper_lock.
+def _trim_wallpaper_derivatives(keepname):
+	limit = main.configuration.get("wallpaper-cache-bytes", 256 * 2**20)
+	files = []
+	total = 0
+	with os.scandir(WALLPAPER_DERIVATIVE_DIR) as entries:
+		for entry in entries:
+			if entry.name.endswith(".jpg") and entry.name != keepname:
+				try:
+					st = entry.stat()
+				except OSError:
+					continue
+				files.append((st.st_mtime_ns, st.st_size, entry.path))
+				total += st.st_size
+	try:
+		total += os.path.getsize(os.path.join(WALLPAPER_DERIVATIVE_DIR, keepname))
+	except OSError:
+		pass
+	for (_, size, path) in sorted(files):
+		if total <= limit:
+			break
+		try:
+			os.remove(path)
+			total -= size
+		except OSError:
+			pass  # In use on Windows; try again next time
+
+
+def _wallpaper_source_hash(srcpath):
+	try:
+		with open(srcpath, "rb") as fin:
+			st = os.fstat(fin.fileno())
+			key = (st.st_ino, st.st_size, st.st_mtime_ns)
+			with _wallpaper_lock:
+				cached = _wallpaper_hashes.get(srcpath)
+			if cached is not None and cached[0] == key:
+				return cached[1]
+			hasher = hashlib.blake2b(digest_size=16)
+			while True:
+				block = fin.read(2**20)
+				if len(block) == 0:
+					break
+				hasher.update(block)
+	except OSError:
+		return None
+	result = hasher.hexdigest()
+	with _wallpaper_lock:
+		_wallpaper_hashes[srcpath] = (key, result)
+	return result
+
+
+# Runs in a worker process. Returns whether a derivative was written, which is not done if the source image
+# is no bigger than the target (so the original is served), and raises an exception if the image is bad.
+def _make_wallpaper_derivative(srcpath, dstpath, width, height):
+	with PIL.Image.open(srcpath) as image:
+		scale = max(width / image.width, height / image.height)
+		if scale >= 1.0:
+			return False
+		image.draft("RGB", (math.ceil(image.width * scale), math.ceil(image.height * scale)))  # Fast JPEG downscaled decoding
+		result = PIL.ImageOps.fit(image.convert("RGB"), (width, height), PIL.Image.LANCZOS)
+	temppath = f"{dstpath}.{os.getpid()}.tmp"
+	result.save(temppath, "JPEG", quality=85, optimize=True, progressive=True)
+	os.replace(temppath, dstpath)
+	return True
+
+
 
 # ---- Network ----
 
 import socket
 
 @bottle.route("/tcping/<host>/<port:int>")
+@engine.route_class("network")
 def tcping(host, port):
+	key = f"tcping/{host}/{port}"
+	result = get_shared_json(key)
+	if result is None:
+		result = upstream_calls.do(key, lambda: _tcping(key, host, port))
+	return main.json_response(result)
+
+
+@engine.async_version(tcping)
+async def tcping_async(host, port):
+	key = f"tcping/{host}/{port}"
+	result = get_shared_json(key)
+	if result is None:
+		result = await upstream_calls.do_async(key, lambda: _tcping_async(key, host, port))
+	return main.json_http_response(result)
+
+
+# Returns and shares whether a TCP connection to the given host and port succeeds within a second.
+def _tcping(key, host, port):
 	try:
 		sock = socket.create_connection((host, port), timeout=1.0)
 		sock.close()
-		return main.json_response(True)
+		result = True
 	except:
-		return main.json_response(False)
+		result = False
+	put_shared_json(key, result, TCPING_SHARE_SECONDS)
+	return result
+
+
+async def _tcping_async(key, host, port):
+	try:
+		_, writer = await asyncio.wait_for(asyncio.open_connection(host, port), 1.0)
+		writer.close()
+		result = True
+	except Exception:
+		result = False
+	put_shared_json(key, result, TCPING_SHARE_SECONDS)
+	return result
+
+
+TCPING_SHARE_SECONDS = 5
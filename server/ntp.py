@@ -0,0 +1,193 @@
+# 
+# Tablet desk clock web server
+# 
+# Copyright (c) Project Nayuki
+# All rights reserved. Contact Nayuki for licensing.
+# https://www.nayuki.io/page/tablet-desk-clock
+# 
+
+
+# ---- Prelude ----
+
+import contextlib, select, socket, struct, sys, time
+
+if __name__ == "__main__":
+	raise AssertionError()
+
+
+
+# ---- NTP client ----
+
+REQUEST_HEADER = (0 << 6) | (4 << 3) | 3  # No leap second warning, version 4, client mode
+PACKET = struct.Struct(">BBbbIIIQQQQ")
+EPOCH_OFFSET = 2208988800  # Seconds from 1900 (the NTP epoch) to 1970 (the Unix epoch)
+TIMEOUT = 1.0
+
+
+# Sends one query to the NTP server at the given socket address, and returns the sample from reply_sample().
+def exchange(target):
+	with contextlib.closing(open_socket()) as sock:
+		deadline = time.monotonic() + TIMEOUT
+		localstart = time.time_ns()
+		request = make_request(localstart)
+		sock.sendto(request, target)
+		reply = Reply(sock, localstart)
+		while True:
+			result = reply.receive()
+			if result is not None:
+				break
+			remaining = deadline - time.monotonic()
+			if remaining <= 0 or len(select.select([sock], [], [], remaining)[0]) == 0:
+				raise TimeoutError("NTP server did not reply")
+	packet, localstart, localend = result
+	return reply_sample(request, packet, localstart, localend)
+
+
+# On Linux, the kernel can timestamp datagrams as they leave and arrive, so that the exchange's local times
+# do not include scheduling delays and waiting for the GIL, which grow with the number of busy request threads.
+# Python's socket module does not define all of these constants.
+KERNEL_TIMESTAMPS = sys.platform.startswith("linux") and hasattr(socket.socket, "recvmsg")
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)  # Receive timestamps as struct timespec
+SO_TIMESTAMPING = getattr(socket, "SO_TIMESTAMPING", 37)
+SOF_TIMESTAMPING_TX_SOFTWARE = 1 << 1
+SOF_TIMESTAMPING_SOFTWARE = 1 << 4
+SOF_TIMESTAMPING_OPT_TSONLY = 1 << 11  # Transmit timestamps come without a copy of the datagram
+TIMESPEC = struct.Struct("@ll")
+
+
+# Returns a non-blocking UDP socket with kernel timestamps enabled where supported.
+def open_socket():
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	try:
+		sock.setblocking(False)
+		sock.bind(("0.0.0.0", 0))
+		if KERNEL_TIMESTAMPS:
+			try:
+				sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+				sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPING,
+					SOF_TIMESTAMPING_TX_SOFTWARE | SOF_TIMESTAMPING_SOFTWARE | SOF_TIMESTAMPING_OPT_TSONLY)
+			except OSError:
+				pass  # Whatever is unsupported falls back to the times read around the system calls
+		return sock
+	except:
+		sock.close()
+		raise
+
+
+# Receives the reply to a request just sent on the given socket, without blocking. A pending transmit timestamp
+# also makes the socket look readable, so every attempt first takes it from the socket's error queue.
+class Reply:
+	
+	def __init__(self, sock, localstart):
+		self.sock = sock
+		self.localstart = localstart  # Unix nanoseconds, read just before sending
+	
+	
+	# Returns (packet, local send time, local receive time) in Unix nanoseconds, or None if nothing arrived yet.
+	def receive(self):
+		if not KERNEL_TIMESTAMPS:
+			try:
+				packet = self.sock.recv(100)
+			except BlockingIOError:
+				return None
+			return (packet, self.localstart, time.time_ns())
+		
+		self._take_transmit_timestamp()
+		try:
+			packet, ancdata, _, _ = self.sock.recvmsg(100, socket.CMSG_SPACE(TIMESPEC.size))
+		except BlockingIOError:
+			return None
+		localend = _cmsg_timestamp(ancdata, SO_TIMESTAMPNS)
+		if localend is None:
+			localend = time.time_ns()
+		self._take_transmit_timestamp()
+		return (packet, self.localstart, localend)
+	
+	
+	def _take_transmit_timestamp(self):
+		while True:
+			try:
+				_, ancdata, _, _ = self.sock.recvmsg(1, 1024, socket.MSG_ERRQUEUE)
+			except OSError:
+				return  # Queue empty
+			timestamp = _cmsg_timestamp(ancdata, SO_TIMESTAMPING)
+			if timestamp is not None:
+				self.localstart = timestamp
+
+
+# Returns the first timespec of the given type in the ancillary data as Unix nanoseconds, or None.
+def _cmsg_timestamp(ancdata, type):
+	for (level, kind, data) in ancdata:
+		if level == socket.SOL_SOCKET and kind == type and len(data) >= TIMESPEC.size:
+			seconds, nanoseconds = TIMESPEC.unpack_from(data)
+			if seconds != 0 or nanoseconds != 0:
+				return seconds * 10**9 + nanoseconds
+	return None
+
+
+# Returns an SNTPv4 client request whose transmit timestamp is the given Unix time in nanoseconds.
+# The server copies it to the originate timestamp of its reply.
+def make_request(unixns):
+	return PACKET.pack(REQUEST_HEADER, 0, 0, 0, 0, 0, 0, 0, 0, 0, to_timestamp(unixns))
+
+
+# Checks the given server reply to the given request, and returns a sample (offset, delay, stratum, root delay,
+# root dispersion): the server's offset from the local clock, the network round-trip delay, and the server's
+# own distance from its reference clock, all in microseconds. The local send and receive times T1 and T4 are
+# in Unix nanoseconds.
+def reply_sample(request, packet, localstart, localend):
+	if len(packet) < PACKET.size:
+		raise ValueError("Response too short")
+	header, stratum, _, _, rootdelay, rootdispersion, _, _, originate, receive, transmit = PACKET.unpack_from(packet)
+	leap = header >> 6
+	version = (header >> 3) & 7
+	mode = header & 7
+	if leap == 3 or version not in (3, 4) or mode != 4 or not (1 <= stratum <= 15) or receive == 0 or transmit == 0:
+		raise ValueError("Response contains invalid data")  # Includes unsynchronized servers and kiss-o'-death packets
+	if originate != PACKET.unpack(request)[10]:
+		raise ValueError("Response does not match the request")
+	
+	# All in units of 2^-32 seconds
+	t1 = to_timestamp(localstart)
+	t2 = receive
+	t3 = transmit
+	t4 = to_timestamp(localend)
+	offset = (difference(t2, t1) + difference(t3, t4)) / 2
+	delay = difference(t4, t1) - difference(t3, t2)
+	return (round(offset * 10**6 / 2**32), round(max(delay, 0) * 10**6 / 2**32),
+		stratum, round(rootdelay * 10**6 / 2**16), round(rootdispersion * 10**6 / 2**16))
+
+
+# Converts Unix nanoseconds to a 64-bit NTP timestamp (32-bit seconds since 1900, 32-bit fraction).
+def to_timestamp(unixns):
+	return ((unixns + EPOCH_OFFSET * 10**9) * 2**32 // 10**9) % 2**64
+
+
+# Returns a - b for NTP timestamps, correct across era boundaries as long as they are within 68 years.
+def difference(a, b):
+	return (a - b + 2**63) % 2**64 - 2**63
+
+
+
+# ---- Server selection ----
+
+# Given a list of (offset, root distance) from different servers, returns the combined (offset, root distance)
+# of the largest group whose correctness intervals [offset - distance, offset + distance] all overlap,
+# or None if that group is not a majority.
+def select_truechimers(candidates):
+	edges = sorted([(offset - distance, -1) for (offset, distance) in candidates]
+		+ [(offset + distance, +1) for (offset, distance) in candidates])  # Lower edges sort first at ties
+	best = 0
+	count = 0
+	for (i, (position, kind)) in enumerate(edges):
+		count -= kind
+		if count > best:
+			best = count
+			low, high = position, edges[i + 1][0]
+	if best == 0 or best * 2 <= len(candidates):
+		return None
+	survivors = [(offset, distance) for (offset, distance) in candidates
+		if offset - distance <= high and offset + distance >= low]
+	weight = sum(1 / distance for (_, distance) in survivors)
+	offset = sum(offset / distance for (offset, distance) in survivors) / weight
+	return (round(offset), round(min(distance for (_, distance) in survivors)))
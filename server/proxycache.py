@@ -0,0 +1,340 @@
+# 
+# Tablet desk clock web server
+# 
+# Copyright (c) Project Nayuki
+# All rights reserved. Contact Nayuki for licensing.
+# https://www.nayuki.io/page/tablet-desk-clock
+# 
+
+
+# ---- Prelude ----
+
+import collections, email.utils, itertools, os, shutil, tempfile, threading
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+try:
+	import msvcrt
+except ImportError:
+	msvcrt = None
+
+if __name__ == "__main__":
+	raise AssertionError()
+
+
+
+# ---- Proxy cache ----
+
+# An HTTP cache for proxied GET responses, following the freshness and validation rules of a shared cache
+# (RFC 9111). Bodies are kept in memory up to 'memorybytes' in total; the least recently used ones beyond that
+# move to files in 'diskdir' up to 'diskbytes', and the least recently used files beyond that are deleted.
+# Responses bigger than 'maxentrybytes' are not cached.
+class ProxyCache:
+	
+	def __init__(self, memorybytes, diskdir, diskbytes, maxentrybytes):
+		self.memorybytes = memorybytes
+		self.diskdir = diskdir
+		self.diskbytes = diskbytes
+		self.maxentrybytes = maxentrybytes
+		self.counters = collections.Counter()  # Event name -> count
+		self._memory = collections.OrderedDict()  # URL -> CacheEntry with its body in memory, least recently used first
+		self._disk = collections.OrderedDict()  # URL -> CacheEntry with its body in a file, least recently used first
+		self._memorysize = 0
+		self._disksize = 0
+		self._filenames = itertools.count()
+		self._processdir = None  # This process's subdirectory of diskdir, created on first use
+		self._lockfile = None  # Held open and locked for the life of the process
+		self._revalidating = set()  # URLs
+		self._lock = threading.Lock()
+	
+	
+	# Returns the entry for the given URL, or None.
+	def get(self, url):
+		with self._lock:
+			for entries in (self._memory, self._disk):
+				entry = entries.get(url)
+				if entry is not None:
+					entries.move_to_end(url)
+					return entry
+		return None
+	
+	
+	# Stores a response with the given upstream header list and body, and returns the entry,
+	# or returns None if the response is too big.
+	def put(self, url, headers, body, now):
+		if len(body) > self.maxentrybytes:
+			return None
+		entry = CacheEntry(url, headers, body, now)
+		with self._lock:
+			self._remove(url)
+			self._memory[url] = entry
+			self._memorysize += entry.size
+			while self._memorysize > self.memorybytes:
+				_, victim = self._memory.popitem(last=False)
+				self._memorysize -= victim.size
+				self._spill(victim)
+			self.counters["stores"] += 1
+		return entry
+	
+	
+	# Updates the given entry with the header fields of a 304 (Not Modified) response.
+	def freshen(self, entry, headers, now):
+		with self._lock:
+			entry.freshen(headers, now)
+	
+	
+	# Returns True if the caller should revalidate the given URL in the background, or False
+	# if that is already in progress. The caller must call end_revalidation() when done.
+	def begin_revalidation(self, url):
+		with self._lock:
+			if url in self._revalidating:
+				return False
+			self._revalidating.add(url)
+			return True
+	
+	
+	def end_revalidation(self, url):
+		with self._lock:
+			self._revalidating.discard(url)
+	
+	
+	def count(self, name):
+		with self._lock:
+			self.counters[name] += 1
+	
+	
+	def stats(self):
+		with self._lock:
+			result = dict(self.counters)
+			result.update({
+				"memory-entries": len(self._memory),
+				"memory-bytes": self._memorysize,
+				"disk-entries": len(self._disk),
+				"disk-bytes": self._disksize,
+			})
+			return result
+	
+	
+	# Must hold the lock.
+	def _remove(self, url):
+		entry = self._memory.pop(url, None)
+		if entry is not None:
+			self._memorysize -= entry.size
+		entry = self._disk.pop(url, None)
+		if entry is not None:
+			self._disksize -= entry.size
+			_remove_file(entry.path)
+	
+	
+	# Moves the given entry's body to a file. Must hold the lock.
+	def _spill(self, entry):
+		if entry.size > self.diskbytes:
+			return
+		if self._processdir is None:
+			os.makedirs(self.diskdir, exist_ok=True)
+			_remove_orphan_dirs(self.diskdir)
+			self._processdir, self._lockfile = _make_process_dir(self.diskdir)
+		path = os.path.join(self._processdir, f"{next(self._filenames)}.body")
+		try:
+			with open(path, "wb") as fout:
+				fout.write(entry.body)
+		except OSError:
+			_remove_file(path)
+			return
+		entry.path = path
+		entry.body = None  # After setting the path, so that readers always find one of them
+		self._disk[entry.url] = entry
+		self._disksize += entry.size
+		self.counters["disk-writes"] += 1
+		while self._disksize > self.diskbytes:
+			_, victim = self._disk.popitem(last=False)
+			self._disksize -= victim.size
+			_remove_file(victim.path)
+
+
+class CacheEntry:
+	
+	HEURISTIC_FRACTION = 0.1  # Of the time since Last-Modified, when the response has no explicit lifetime
+	MAX_HEURISTIC_SECONDS = 86400
+	
+	
+	def __init__(self, url, headers, body, now):
+		self.url = url
+		self.body = body  # Bytes while in memory, otherwise None
+		self.path = None  # The file holding the body while on disk
+		self.size = len(body)
+		self.headers = list(headers)
+		self.freshen([], now)
+	
+	
+	# Merges the given header fields into the stored ones and recomputes the freshness lifetime.
+	def freshen(self, headers, now):
+		names = {key.lower() for (key, _) in headers}
+		self.headers = [(key, val) for (key, val) in self.headers if key.lower() not in names] + list(headers)
+		directives = cache_directives(self.getheader("Cache-Control"))
+		date = _parse_date(self.getheader("Date"))
+		agefield = _parse_seconds(self.getheader("Age")) or 0
+		self.stored = now - max(agefield, now - date if (date is not None) else 0)
+		
+		expires = _parse_date(self.getheader("Expires"))
+		lastmodified = _parse_date(self.getheader("Last-Modified"))
+		if "s-maxage" in directives or "max-age" in directives:
+			self.lifetime = _parse_seconds(directives.get("s-maxage", directives.get("max-age"))) or 0
+		elif expires is not None:
+			self.lifetime = max(expires - (date if (date is not None) else now), 0)
+		elif lastmodified is not None:
+			self.lifetime = min(((date if (date is not None) else now) - lastmodified) * self.HEURISTIC_FRACTION, self.MAX_HEURISTIC_SECONDS)
+		else:
+			self.lifetime = 0
+		if "no-cache" in directives:
+			self.lifetime = 0
+		if "must-revalidate" in directives or "proxy-revalidate" in directives or "no-cache" in directives:
+			self.stale_while_revalidate = 0
+		else:
+			self.stale_while_revalidate = _parse_seconds(directives.get("stale-while-revalidate")) or 0
+		self.etag = self.getheader("ETag")
+		self.lastmodified = self.getheader("Last-Modified")
+	
+	
+	def getheader(self, name, default=None):
+		name = name.lower()
+		for (key, val) in self.headers:
+			if key.lower() == name:
+				return val
+		return default
+	
+	
+	def age(self, now):
+		return max(now - self.stored, 0)
+	
+	
+	def is_fresh(self, now):
+		return self.age(now) < self.lifetime
+	
+	
+	# Tests whether the entry is stale but may still be served while it is revalidated in the background.
+	def can_serve_stale(self, now):
+		return self.age(now) < self.lifetime + self.stale_while_revalidate
+	
+	
+	# Returns the request header fields that ask the origin whether this entry is still current.
+	def validators(self):
+		result = []
+		if self.etag is not None:
+			result.append(("If-None-Match", self.etag))
+		if self.lastmodified is not None:
+			result.append(("If-Modified-Since", self.lastmodified))
+		return result
+	
+	
+	# Returns the body as bytes or as a binary file opened at the start, or None if it was just evicted.
+	def open_body(self):
+		body = self.body
+		if body is not None:
+			return body
+		try:
+			return open(self.path, "rb")
+		except OSError:
+			return None
+	
+	
+	# Evaluates the conditional header fields in the given WSGI environ against this entry.
+	def is_not_modified(self, environ):
+		inm = environ.get("HTTP_IF_NONE_MATCH")
+		ims = _parse_date(environ.get("HTTP_IF_MODIFIED_SINCE"))
+		if inm is not None:
+			if self.etag is None:
+				return False
+			tags = [(tag[2 : ] if tag.startswith("W/") else tag) for tag in (tag.strip() for tag in inm.split(","))]
+			etag = self.etag[2 : ] if self.etag.startswith("W/") else self.etag
+			return "*" in tags or etag in tags
+		lastmodified = _parse_date(self.lastmodified)
+		return ims is not None and lastmodified is not None and lastmodified <= ims
+
+
+# Tests whether a response with the given status and upstream header list may be stored.
+def is_cacheable(status, headers):
+	fields = {key.lower(): val for (key, val) in headers}
+	directives = cache_directives(fields.get("cache-control"))
+	if status != 200 or "no-store" in directives or "private" in directives or fields.get("vary", "").strip() == "*":
+		return False
+	return any(key in directives for key in ("max-age", "s-maxage", "public")) \
+		or any(key in fields for key in ("expires", "etag", "last-modified"))
+
+
+# Parses a Cache-Control field value into a dictionary of lowercase directive names to values (None if absent).
+def cache_directives(value):
+	result = {}
+	if value is not None:
+		for item in value.split(","):
+			key, sep, val = item.partition("=")
+			key = key.strip().lower()
+			if key != "":
+				result[key] = val.strip().strip('"') if (sep != "") else None
+	return result
+
+
+def _parse_seconds(value):
+	return int(value) if (value is not None and value.strip().isdigit()) else None
+
+
+# Returns the given HTTP date as Unix seconds, or None if absent or invalid.
+def _parse_date(value):
+	if value is None:
+		return None
+	try:
+		return email.utils.parsedate_to_datetime(value).timestamp()
+	except (TypeError, ValueError, IndexError, OverflowError):
+		return None
+
+
+def _remove_file(path):
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+
+
+# Each process keeps its body files in its own subdirectory, which holds a lock file that stays locked until
+# the process exits. So a subdirectory whose lock can be taken was left behind by a process that no longer exists.
+LOCK_FILE_NAME = "lock"
+
+
+# Returns (directory path, locked lock file) for a new subdirectory of the given directory.
+def _make_process_dir(diskdir):
+	path = tempfile.mkdtemp(dir=diskdir)
+	lockfile = open(os.path.join(path, LOCK_FILE_NAME), "wb")
+	if not _try_lock(lockfile):
+		lockfile.close()
+		shutil.rmtree(path, ignore_errors=True)
+		raise OSError("Cannot lock proxy cache directory")
+	return (path, lockfile)
+
+
+# Deletes subdirectories left behind by processes that no longer exist.
+def _remove_orphan_dirs(diskdir):
+	if fcntl is None and msvcrt is None:
+		return  # No way to tell which directories are still in use
+	for name in os.listdir(diskdir):
+		path = os.path.join(diskdir, name)
+		try:
+			lockfile = open(os.path.join(path, LOCK_FILE_NAME), "rb")
+		except OSError:
+			continue  # Not a process directory, or its owner has not created the lock file yet
+		with lockfile:
+			if not _try_lock(lockfile):
+				continue  # Still in use
+		shutil.rmtree(path, ignore_errors=True)
+
+
+# Takes an exclusive lock on the given open file without waiting, and returns whether that succeeded.
+def _try_lock(file):
+	try:
+		if fcntl is not None:
+			fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+		elif msvcrt is not None:
+			msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+		return True
+	except OSError:
+		return False
@@ -0,0 +1,193 @@
+# 
+# Tablet desk clock web server
+# 
+# Copyright (c) Project Nayuki
+# All rights reserved. Contact Nayuki for licensing.
+# https://www.nayuki.io/page/tablet-desk-clock
+# 
+
+
+# ---- Prelude ----
+
+import asyncio, concurrent.futures, hashlib, mmap, os, struct, threading, time
+try:
+	import fcntl
+except ImportError:
+	fcntl = None  # Only one process can use the cache file safely
+
+if __name__ == "__main__":
+	raise AssertionError()
+
+
+
+# ---- Shared result cache ----
+
+# A small key-value cache with expiry in a memory-mapped file, shared by every server process that maps the same
+# file. The file is a header followed by a fixed number of equally sized slots, and each key hashes to one slot
+# (a newer entry simply evicts an older one). Writers take an exclusive file lock; readers take no lock and instead
+# follow the seqlock protocol: a slot's sequence number is odd while it is being written, so a reader retries if it
+# sees an odd number or if the number changed while it copied the entry.
+class SharedCache:
+	
+	MAGIC = b"TDCSHC01"
+	FILE_HEADER = struct.Struct("<8sII")  # Magic, slot count, slot size
+	FILE_HEADER_SIZE = 64
+	SLOT_HEADER = struct.Struct("<Q16sdI")  # Sequence number, key hash, expiry in Unix seconds, value length
+	SEQUENCE = struct.Struct("<Q")
+	READ_ATTEMPTS = 100
+	
+	
+	def __init__(self, path, slots=32, slotsize=128 * 1024):
+		self.path = path
+		self.slots = slots
+		self.slotsize = slotsize
+		self.maxvaluesize = slotsize - self.SLOT_HEADER.size
+		self._fd = None
+		self._map = None
+		self._pid = None  # A forked child must reopen the file, because flock() locks are shared with the parent's descriptor
+		self._lock = threading.Lock()  # Serializes writers within this process, and opening
+	
+	
+	# Returns the bytes stored under the given string key, or None if absent or expired.
+	def get(self, key):
+		mm = self._open()
+		keyhash = _hash_key(key)
+		base = self._slot_offset(keyhash)
+		start = base + self.SLOT_HEADER.size
+		for _ in range(self.READ_ATTEMPTS):
+			seq, slothash, expiry, length = self.SLOT_HEADER.unpack_from(mm, base)
+			if seq % 2 == 1:
+				time.sleep(0)  # A writer is in the middle of this slot
+				continue
+			if slothash != keyhash or expiry < time.time() or length > self.maxvaluesize:
+				result = None
+			else:
+				result = mm[start : start + length]
+			if self.SEQUENCE.unpack_from(mm, base)[0] == seq:
+				return result
+		return None
+	
+	
+	# Stores the given bytes under the given string key for the given number of seconds.
+	# Values that do not fit in a slot are not stored.
+	def put(self, key, value, ttl):
+		if len(value) > self.maxvaluesize:
+			return
+		mm = self._open()
+		keyhash = _hash_key(key)
+		base = self._slot_offset(keyhash)
+		start = base + self.SLOT_HEADER.size
+		with self._lock:
+			self._lock_file(True)
+			try:
+				seq = self.SEQUENCE.unpack_from(mm, base)[0] | 1  # Odd while writing, even if a killed writer left it odd
+				self.SEQUENCE.pack_into(mm, base, seq)
+				mm[start : start + len(value)] = value
+				self.SLOT_HEADER.pack_into(mm, base, seq, keyhash, time.time() + ttl, len(value))
+				self.SEQUENCE.pack_into(mm, base, seq + 1)
+			finally:
+				self._lock_file(False)
+	
+	
+	def _slot_offset(self, keyhash):
+		return self.FILE_HEADER_SIZE + int.from_bytes(keyhash[ : 8], "little") % self.slots * self.slotsize
+	
+	
+	# Maps the file on first use in this process, (re)initializing it if its layout does not match.
+	def _open(self):
+		mm = self._map
+		if mm is not None and self._pid == os.getpid():
+			return mm
+		with self._lock:
+			if self._map is None or self._pid != os.getpid():
+				self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+				size = self.FILE_HEADER_SIZE + self.slots * self.slotsize
+				header = self.FILE_HEADER.pack(self.MAGIC, self.slots, self.slotsize)
+				self._lock_file(True)
+				try:
+					if os.fstat(self._fd).st_size != size or _read_at(self._fd, len(header), 0) != header:
+						os.ftruncate(self._fd, 0)  # Discard all old slots
+						os.ftruncate(self._fd, size)
+						os.lseek(self._fd, 0, os.SEEK_SET)
+						os.write(self._fd, header)
+				finally:
+					self._lock_file(False)
+				self._map = mmap.mmap(self._fd, size)
+				self._pid = os.getpid()
+			return self._map
+	
+	
+	def _lock_file(self, exclusive):
+		if fcntl is not None:
+			fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_UN)
+
+
+# Like os.pread(), which is not available on Windows. Only called with the cache's lock held.
+def _read_at(fd, length, offset):
+	os.lseek(fd, offset, os.SEEK_SET)
+	return os.read(fd, length)
+
+
+def _hash_key(key):
+	return hashlib.blake2b(key.encode("UTF-8"), digest_size=16).digest()
+
+
+
+# ---- Single flight ----
+
+# Runs at most one upstream call per key at a time within this process. Callers that arrive while a call with
+# the same key is in progress wait for it and share its result or exception, whether they are threads or coroutines.
+class SingleFlight:
+	
+	def __init__(self):
+		self._calls = {}  # Key -> concurrent.futures.Future of the call in progress
+		self._lock = threading.Lock()
+	
+	
+	# Returns func(), or the result of the call with the same key that is already in progress.
+	def do(self, key, func):
+		future, leader = self._join(key)
+		if not leader:
+			return future.result()
+		try:
+			result = func()
+		except BaseException as e:
+			self._finish(key, future, exception=e)
+			raise
+		self._finish(key, future, result=result)
+		return result
+	
+	
+	# Like do(), but awaits the coroutine returned by func().
+	async def do_async(self, key, func):
+		future, leader = self._join(key)
+		if not leader:
+			# Shielded, so that a cancelled follower does not cancel the shared future
+			return await asyncio.shield(asyncio.wrap_future(future))
+		try:
+			result = await func()
+		except BaseException as e:
+			self._finish(key, future, exception=e)
+			raise
+		self._finish(key, future, result=result)
+		return result
+	
+	
+	# Returns the future for the given key, and whether the caller is the one that must make the call.
+	def _join(self, key):
+		with self._lock:
+			future = self._calls.get(key)
+			if future is not None:
+				return (future, False)
+			future = concurrent.futures.Future()
+			self._calls[key] = future
+			return (future, True)
+	
+	
+	def _finish(self, key, future, result=None, exception=None):
+		with self._lock:
+			del self._calls[key]
+		if exception is not None:
+			future.set_exception(exception)
+		else:
+			future.set_result(result)
@@ -0,0 +1,891 @@
+# 
+# Tablet desk clock web server
+# 
+# Copyright (c) Project Nayuki
+# All rights reserved. Contact Nayuki for licensing.
+# https://www.nayuki.io/page/tablet-desk-clock
+# 
+
+
+# ---- Prelude ----
+
+import base64, collections, ctypes, ctypes.util, gzip, hashlib, io, json, mimetypes, os, posixpath, re, stat, struct, sys, threading, time
+import bottle
+try:
+	import fontTools.subset, fontTools.ttLib
+except ImportError:
+	fontTools = None  # Font subsets are unavailable, so style sheets are served without them
+
+if __name__ == "__main__":
+	raise AssertionError()
+
+
+
+# ---- File index ----
+
+# A persistent set of the web paths of all regular files under a root directory. Reads are
+# lock-free because the set is an immutable snapshot that gets replaced wholesale by writers.
+# On Linux the index is kept up to date by inotify events; elsewhere, lookup misses trigger
+# a poll that only rescans the directories whose modification time has changed, and paths
+# that are still missing afterward are remembered for a while so that repeated misses are cheap.
+class StaticFileIndex:
+	
+	MISSING_TTL_SECONDS = 10.0
+	MISSING_MAX_ENTRIES = 1000
+	
+	
+	def __init__(self, rootdir):
+		self.rootdir = rootdir
+		self.files = frozenset()  # Web paths like "icon/no-internet.svg"
+		self.generation = 0  # Incremented whenever the set of files changes
+		self._dirs = {}  # Web directory path -> (st_mtime_ns, file names, subdirectory names)
+		self._lock = threading.Lock()  # Serializes writers only
+		self._watcher = None
+		self._started = False
+		self._missing = collections.OrderedDict()  # Web path -> expiry in time.monotonic() seconds
+		self._missing_lock = threading.Lock()
+	
+	
+	# Tests whether the given web path names a regular file, without taking any lock in the common case.
+	def lookup(self, path):
+		if not self._started:
+			self._start()
+		if path in self.files:
+			return True
+		if self._watcher is not None:
+			return False
+		missing = self._missing  # Replaced (not cleared) whenever the set of files changes
+		expiry = missing.get(path)
+		if expiry is not None and time.monotonic() < expiry:
+			return False
+		self.refresh()
+		if path in self.files:
+			return True
+		with self._missing_lock:
+			missing[path] = time.monotonic() + self.MISSING_TTL_SECONDS
+			missing.move_to_end(path)
+			if len(missing) > self.MISSING_MAX_ENTRIES:
+				missing.popitem(last=False)
+		return False
+	
+	
+	# Re-stats every known directory and rescans only those that have changed.
+	def refresh(self):
+		with self._lock:
+			added, removed = set(), set()
+			if "" not in self._dirs:
+				self._scan_dir("", added, removed)
+			for (webdir, (mtime, _, _)) in list(self._dirs.items()):
+				if webdir not in self._dirs:
+					continue  # Dropped while rescanning an ancestor
+				try:
+					changed = os.stat(self._fspath(webdir)).st_mtime_ns != mtime
+				except OSError:
+					changed = True
+				if changed:
+					self._scan_dir(webdir, added, removed)
+			self._apply(added, removed)
+	
+	
+	def _start(self):
+		with self._lock:
+			if self._started:
+				return
+			if sys.platform.startswith("linux"):
+				try:
+					self._watcher = _InotifyWatcher(self._on_events)
+				except OSError:
+					self._watcher = None
+			added, removed = set(), set()
+			self._scan_dir("", added, removed)
+			self._apply(added, removed)
+			if self._watcher is not None:
+				self._watcher.start()
+			self._started = True
+	
+	
+	# Lists the given directory and reconciles it against the previous listing. New subdirectories
+	# are scanned recursively and vanished ones are dropped along with their whole subtree.
+	def _scan_dir(self, webdir, added, removed):
+		fspath = self._fspath(webdir)
+		try:
+			if self._watcher is not None:
+				self._watcher.watch(fspath, webdir)  # Before listing, so no event is missed
+			mtime = os.stat(fspath).st_mtime_ns  # Before listing, so a concurrent change looks stale
+			with os.scandir(fspath) as entries:
+				entries = list(entries)
+		except OSError:
+			self._drop_dir(webdir, removed)
+			return
+		files = frozenset(entry.name for entry in entries if entry.is_file())
+		subdirs = frozenset(entry.name for entry in entries if entry.is_dir())
+		_, oldfiles, oldsubdirs = self._dirs.get(webdir, (None, frozenset(), frozenset()))
+		self._dirs[webdir] = (mtime, files, subdirs)
+		prefix = _join(webdir, "")
+		added.update(prefix + name for name in files - oldfiles)
+		removed.update(prefix + name for name in oldfiles - files)
+		for name in oldsubdirs - subdirs:
+			self._drop_dir(prefix + name, removed)
+		for name in subdirs - oldsubdirs:
+			self._scan_dir(prefix + name, added, removed)
+	
+	
+	def _drop_dir(self, webdir, removed):
+		state = self._dirs.pop(webdir, None)
+		if self._watcher is not None:
+			self._watcher.unwatch(webdir)
+		if state is None:
+			return
+		_, files, subdirs = state
+		prefix = _join(webdir, "")
+		removed.update(prefix + name for name in files)
+		for name in subdirs:
+			self._drop_dir(prefix + name, removed)
+	
+	
+	# Called on the watcher thread with a list of (web directory, entry name, is directory, exists) tuples,
+	# or with None if the kernel's event queue overflowed and everything must be rescanned.
+	def _on_events(self, events):
+		with self._lock:
+			added, removed = set(), set()
+			if events is None:
+				for webdir in sorted(self._dirs, key=len):
+					if webdir in self._dirs:
+						self._scan_dir(webdir, added, removed)
+			else:
+				for (webdir, name, isdir, exists) in events:
+					if webdir not in self._dirs:
+						continue
+					mtime, files, subdirs = self._dirs[webdir]
+					path = _join(webdir, name)
+					if exists and not isdir and os.path.isdir(self._fspath(path)):
+						isdir = True  # Symbolic link to a directory
+					if isdir:
+						if exists and name not in subdirs:
+							self._dirs[webdir] = (mtime, files, subdirs | {name})
+							self._scan_dir(path, added, removed)
+						elif not exists and name in subdirs:
+							self._dirs[webdir] = (mtime, files, subdirs - {name})
+							self._drop_dir(path, removed)
+					else:
+						if exists and os.path.isfile(self._fspath(path)):
+							self._dirs[webdir] = (mtime, files | {name}, subdirs)
+							removed.discard(path)
+							added.add(path)
+						elif not exists and name in files:
+							self._dirs[webdir] = (mtime, files - {name}, subdirs)
+							added.discard(path)
+							removed.add(path)
+			self._apply(added, removed)
+	
+	
+	def _apply(self, added, removed):
+		if len(added) > 0 or len(removed) > 0:
+			self.files = (self.files - removed) | added
+			self.generation += 1
+			self._missing = collections.OrderedDict()
+	
+	
+	def _fspath(self, webpath):
+		return os.path.join(self.rootdir, *webpath.split("/")) if webpath != "" else self.rootdir
+
+
+def _join(webdir, name):
+	return webdir + "/" + name if webdir != "" else name
+
+
+
+# ---- Inotify ----
+
+# Watches a set of directories (non-recursively) using the Linux inotify API through ctypes,
+# and delivers batches of changes to a callback on a background daemon thread.
+class _InotifyWatcher:
+	
+	_IN_ATTRIB      = 0x00000004
+	_IN_MOVED_FROM  = 0x00000040
+	_IN_MOVED_TO    = 0x00000080
+	_IN_CREATE      = 0x00000100
+	_IN_DELETE      = 0x00000200
+	_IN_Q_OVERFLOW  = 0x00004000
+	_IN_IGNORED     = 0x00008000
+	_IN_ONLYDIR     = 0x01000000
+	_IN_ISDIR       = 0x40000000
+	
+	_WATCH_MASK = _IN_ATTRIB | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_ONLYDIR
+	_EVENT_HEADER = struct.Struct("=iIII")
+	
+	
+	def __init__(self, callback):
+		self._callback = callback
+		self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+		if self._fd == -1:
+			raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+		self._wd_to_dir = {}
+		self._dir_to_wd = {}
+		self._lock = threading.Lock()
+	
+	
+	def start(self):
+		threading.Thread(target=self._run, name="static-file-inotify", daemon=True).start()
+	
+	
+	def watch(self, fspath, webdir):
+		wd = self._libc.inotify_add_watch(self._fd, os.fsencode(fspath), self._WATCH_MASK)
+		if wd == -1:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno), fspath)
+		with self._lock:
+			self._wd_to_dir[wd] = webdir
+			self._dir_to_wd[webdir] = wd
+	
+	
+	def unwatch(self, webdir):
+		with self._lock:
+			wd = self._dir_to_wd.pop(webdir, None)
+			if wd is None or self._wd_to_dir.get(wd) != webdir:
+				return
+			del self._wd_to_dir[wd]
+		self._libc.inotify_rm_watch(self._fd, wd)
+	
+	
+	def _run(self):
+		while True:
+			data = os.read(self._fd, 65536)
+			events = []
+			overflow = False
+			offset = 0
+			while offset < len(data):
+				wd, mask, _, namelen = self._EVENT_HEADER.unpack_from(data, offset)
+				offset += self._EVENT_HEADER.size
+				name = os.fsdecode(data[offset : offset + namelen].rstrip(b"\0"))
+				offset += namelen
+				if mask & self._IN_Q_OVERFLOW != 0:
+					overflow = True
+					continue
+				with self._lock:
+					webdir = self._wd_to_dir.get(wd)
+					if mask & self._IN_IGNORED != 0 and webdir is not None:
+						del self._wd_to_dir[wd]
+						if self._dir_to_wd.get(webdir) == wd:
+							del self._dir_to_wd[webdir]
+				if webdir is None or name == "":
+					continue
+				isdir = mask & self._IN_ISDIR != 0
+				exists = mask & (self._IN_DELETE | self._IN_MOVED_FROM) == 0
+				events.append((webdir, name, isdir, exists))
+			if overflow:
+				self._callback(None)
+			elif len(events) > 0:
+				self._callback(events)
+
+
+
+# ---- Memory cache ----
+
+# Keeps the contents of small static files in memory, evicting the least recently used
+# entries to stay under a byte budget. An entry is valid for the (inode, size, mtime) of
+# the file it was read from, and that key is re-checked at most once per REVALIDATE_SECONDS.
+# Text and font files also get a gzip-compressed variant, which counts against the budget.
+class StaticFileCache:
+	
+	REVALIDATE_SECONDS = 1.0
+	
+	# Formats that are not already compressed internally
+	COMPRESSIBLE_EXTENSIONS = {"css", "html", "js", "json", "svg", "ttf", "txt", "xml"}
+	
+	
+	def __init__(self, rootdir, maxbytes, maxentrybytes=None):
+		self.rootdir = rootdir
+		self.maxbytes = maxbytes
+		self.maxentrybytes = maxentrybytes if (maxentrybytes is not None) else maxbytes // 8
+		self.totalbytes = 0
+		self._entries = collections.OrderedDict()  # Web path -> _CacheEntry, least recently used first
+		self._lock = threading.Lock()
+	
+	
+	# Returns a _CacheEntry with the current contents of the given file,
+	# or None if the file is missing or too big to be cached.
+	def get(self, path):
+		now = time.monotonic()
+		with self._lock:
+			entry = self._entries.get(path)
+			if entry is not None:
+				self._entries.move_to_end(path)
+				if now - entry.checked < self.REVALIDATE_SECONDS:
+					return entry
+		
+		fspath = os.path.join(self.rootdir, *path.split("/"))
+		try:
+			st = os.stat(fspath)
+			if entry is not None and entry.key == _stat_key(st):
+				entry.checked = now
+				return entry
+			if not stat.S_ISREG(st.st_mode) or st.st_size > self.maxentrybytes:
+				self._discard(path)
+				return None
+			with open(fspath, "rb") as fin:
+				st = os.fstat(fin.fileno())
+				data = fin.read(self.maxentrybytes + 1)
+		except OSError:
+			self._discard(path)
+			return None
+		if len(data) != st.st_size:  # File is being written or was swapped
+			self._discard(path)
+			return None
+		
+		compress = path.rpartition(".")[2].lower() in self.COMPRESSIBLE_EXTENSIONS
+		entry = _CacheEntry(_stat_key(st), data, st.st_mtime, now, compress)
+		with self._lock:
+			old = self._entries.pop(path, None)
+			if old is not None:
+				self.totalbytes -= old.size
+			self._entries[path] = entry
+			self.totalbytes += entry.size
+			while self.totalbytes > self.maxbytes:
+				_, victim = self._entries.popitem(last=False)
+				self.totalbytes -= victim.size
+		return entry
+	
+	
+	def _discard(self, path):
+		with self._lock:
+			old = self._entries.pop(path, None)
+			if old is not None:
+				self.totalbytes -= old.size
+
+
+class _CacheEntry:
+	
+	def __init__(self, key, data, mtime, checked, compress):
+		self.key = key
+		self.data = data
+		self.mtime = mtime
+		self.checked = checked  # In time.monotonic() seconds
+		self.hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+		self.etag = '"' + self.hash + '"'
+		self.gzipdata = None
+		if compress:
+			temp = gzip.compress(data, compresslevel=9, mtime=0)
+			if len(temp) < len(data):
+				self.gzipdata = temp
+				self.gzipetag = '"' + self.hash + '-gz"'
+		self.size = len(data) + (len(self.gzipdata) if (self.gzipdata is not None) else 0)
+
+
+def _stat_key(st):
+	return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+# Returns an HTTP response for the given cache entry, honoring Accept-Encoding,
+# If-None-Match, If-Modified-Since and Range in the current request.
+def cached_response(entry, mimetype, cachecontrol=None):
+	environ = bottle.request.environ
+	headers = {
+		"Last-Modified": bottle.http_date(entry.mtime),
+		"Accept-Ranges": "bytes",
+	}
+	if cachecontrol is not None:
+		headers["Cache-Control"] = cachecontrol
+	
+	# Ranges always refer to the identity encoding, so they are served uncompressed
+	data = entry.data
+	etag = entry.etag
+	if entry.gzipdata is not None:
+		headers["Vary"] = "Accept-Encoding"
+		if "HTTP_RANGE" not in environ and _accepts_gzip(environ.get("HTTP_ACCEPT_ENCODING", "")):
+			data = entry.gzipdata
+			etag = entry.gzipetag
+			headers["Content-Encoding"] = "gzip"
+	headers["ETag"] = etag
+	
+	if _is_not_modified(etag, entry.mtime):
+		headers.pop("Content-Encoding", None)
+		return bottle.HTTPResponse(status=304, **headers)
+	_set_content_type(headers, mimetype)
+	
+	if "HTTP_RANGE" in environ:
+		ranges = list(bottle.parse_range_header(environ["HTTP_RANGE"], len(data)))
+		if len(ranges) == 0:
+			return bottle.HTTPError(416, "Requested Range Not Satisfiable")
+		start, end = ranges[0]
+		headers["Content-Range"] = f"bytes {start}-{end - 1}/{len(data)}"
+		headers["Content-Length"] = str(end - start)
+		return bottle.HTTPResponse(data[start : end], status=206, **headers)
+	headers["Content-Length"] = str(len(data))
+	return bottle.HTTPResponse(data, **headers)
+
+
+# Returns an HTTP response that reads the given file from disk, honoring If-Modified-Since and Range.
+# The body is a FileRange, which servers that provide a sendfile()-based wsgi.file_wrapper
+# (see the engine module) transmit without copying the data through Python.
+def file_response(rootdir, path, mimetype, cachecontrol=None):
+	try:
+		fin = open(os.path.join(rootdir, *path.split("/")), "rb")
+	except OSError:
+		return bottle.HTTPError(404, "File does not exist.")
+	try:
+		st = os.fstat(fin.fileno())
+		if not stat.S_ISREG(st.st_mode):
+			fin.close()
+			return bottle.HTTPError(404, "File does not exist.")
+		headers = {
+			"Last-Modified": bottle.http_date(st.st_mtime),
+			"Accept-Ranges": "bytes",
+		}
+		if cachecontrol is not None:
+			headers["Cache-Control"] = cachecontrol
+		if _is_not_modified(None, st.st_mtime):
+			fin.close()
+			return bottle.HTTPResponse(status=304, **headers)
+		_set_content_type(headers, mimetype)
+		
+		size = st.st_size
+		environ = bottle.request.environ
+		if "HTTP_RANGE" in environ:
+			ranges = list(bottle.parse_range_header(environ["HTTP_RANGE"], size))
+			if len(ranges) == 0:
+				fin.close()
+				return bottle.HTTPError(416, "Requested Range Not Satisfiable")
+			start, end = ranges[0]
+			headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+			status = 206
+		else:
+			start, end = 0, size
+			status = 200
+		headers["Content-Length"] = str(end - start)
+		if bottle.request.method == "HEAD":
+			fin.close()
+			return bottle.HTTPResponse(status=status, **headers)
+		return bottle.HTTPResponse(FileRange(fin, start, end - start), status=status, **headers)
+	except:
+		fin.close()
+		raise
+
+
+# A read-only file-like view of a byte range of an open binary file. Closing it closes the file.
+class FileRange:
+	
+	def __init__(self, file, offset, length):
+		self.file = file
+		self.offset = offset
+		self.length = length
+		self._remaining = length
+		file.seek(offset)
+	
+	
+	def read(self, size=-1):
+		if size < 0 or size > self._remaining:
+			size = self._remaining
+		result = self.file.read(size)
+		self._remaining -= len(result)
+		return result
+	
+	
+	def close(self):
+		self.file.close()
+
+
+# Evaluates If-None-Match (if etag is not None) or If-Modified-Since in the current request.
+def _is_not_modified(etag, mtime):
+	environ = bottle.request.environ
+	inm = environ.get("HTTP_IF_NONE_MATCH")
+	ims = environ.get("HTTP_IF_MODIFIED_SINCE")
+	if inm is not None and etag is not None:
+		tags = [tag.strip() for tag in inm.split(",")]
+		return "*" in tags or any((tag[2 : ] if tag.startswith("W/") else tag) == etag for tag in tags)
+	elif ims is not None:
+		ims = bottle.parse_date(ims.split(";")[0].strip())
+		return ims is not None and ims >= int(mtime)
+	else:
+		return False
+
+
+def _set_content_type(headers, mimetype):
+	if mimetype == "auto":
+		mimetype, encoding = mimetypes.guess_type(bottle.request.path)
+		if encoding is not None and "Content-Encoding" not in headers:
+			headers["Content-Encoding"] = encoding
+	if mimetype is not None:
+		if mimetype.startswith("text/") and "charset" not in mimetype:
+			mimetype += "; charset=UTF-8"
+		headers["Content-Type"] = mimetype
+
+
+# Tests whether the given Accept-Encoding header value allows a gzip-encoded response.
+def _accepts_gzip(header):
+	qualities = {}
+	for item in header.split(","):
+		coding, _, params = item.partition(";")
+		coding = coding.strip().lower()
+		quality = 1.0
+		for param in params.split(";"):
+			key, _, val = param.partition("=")
+			if key.strip().lower() == "q":
+				try:
+					quality = float(val)
+				except ValueError:
+					quality = 0.0
+		if coding != "":
+			qualities[coding] = quality
+	return qualities.get("gzip", qualities.get("x-gzip", qualities.get("*", 0.0))) > 0.0
+
+
+
+
+# ---- Asset manifest ----
+
+# Maps static files to content-hashed names like "icon/no-internet.0123456789abcdef.svg", which can be
+# cached by browsers forever because a changed file gets a new name. HTML pages and style sheets are rewritten
+# at serve time so that their relative href/src/url() references point to the current hashed names.
+class AssetManifest:
+	
+	_HASHED_PATH = re.compile(r"(.+)\.([0-9a-f]{16})(\.[^./]+)")
+	_HTML_REFERENCE = re.compile(r'(\s(?:href|src)=")([^"#?:]+)(")')
+	_CSS_REFERENCE = re.compile(r'(url\(\s*")([^"#?:]+)("\s*\))')
+	
+	
+	def __init__(self, rootdir, index, cache):
+		self.rootdir = rootdir
+		self.index = index
+		self.cache = cache
+		self._hashes = {}  # Web path -> (stat key, hash) for files that are not in the memory cache
+		self._pages = {}  # Web path of HTML or CSS -> (source hash, hashed references, rewritten _CacheEntry)
+		self._lock = threading.Lock()
+	
+	
+	# Returns a dictionary mapping the web path of every static file to its hashed path.
+	def to_dict(self):
+		self.index.lookup("")  # Ensure the index is started
+		result = {}
+		for path in sorted(self.index.files):
+			temp = self.hashed_path(path)
+			if temp is not None:
+				result[path] = temp
+		return result
+	
+	
+	# Returns the content-hashed form of the given web path, or None if the file is unavailable.
+	def hashed_path(self, path):
+		base, dot, ext = path.rpartition(".")
+		if dot == "" or "/" in ext:
+			return None  # No extension to put the hash in front of
+		hash = self._file_hash(path)
+		return None if (hash is None) else f"{base}.{hash}.{ext}"
+	
+	
+	# Returns the original web path if the given path is a hashed path whose hash matches
+	# the current contents of the file, otherwise None.
+	def unhash(self, path):
+		match = self._HASHED_PATH.fullmatch(path)
+		if match is None:
+			return None
+		original = match.group(1) + match.group(3)
+		if not self.index.lookup(original) or self._file_hash(original) != match.group(2):
+			return None
+		return original
+	
+	
+	# Returns a cache entry for the given HTML page whose references to other static files
+	# have been replaced by their current hashed paths.
+	def rewrite_html(self, path, entry):
+		return self._rewrite(path, entry, self._HTML_REFERENCE)
+	
+	
+	# Returns a cache entry for the given style sheet whose url() references (such as fonts) have been replaced
+	# by their current hashed paths. References to other style sheets are left alone, so that hashes never depend
+	# on each other in a cycle. The hashed path of a style sheet is based on this rewritten text.
+	def rewrite_css(self, path, entry):
+		return self._rewrite(path, entry, self._CSS_REFERENCE)
+	
+	
+	def _rewrite(self, path, entry, regex):
+		dir = posixpath.dirname(path)
+		text = entry.data.decode("UTF-8")
+		refs = {}
+		for match in regex.finditer(text):
+			ref = match.group(2)
+			target = posixpath.normpath(posixpath.join(dir, ref))
+			if ref.startswith("/") or target not in self.index.files:
+				continue
+			if regex is self._CSS_REFERENCE and target.endswith(".css"):
+				continue
+			hashed = self.hashed_path(target)
+			if hashed is not None:
+				refs[ref] = posixpath.relpath(hashed, dir or ".")
+		refs = tuple(sorted(refs.items()))
+		
+		with self._lock:
+			cached = self._pages.get(path)
+		if cached is not None and cached[0] == entry.hash and cached[1] == refs:
+			return cached[2]
+		mapping = dict(refs)
+		text = regex.sub(lambda m: m.group(1) + mapping.get(m.group(2), m.group(2)) + m.group(3), text)
+		result = _CacheEntry(entry.key, text.encode("UTF-8"), entry.mtime, entry.checked, entry.gzipdata is not None)
+		with self._lock:
+			self._pages[path] = (entry.hash, refs, result)
+		return result
+	
+	
+	def _file_hash(self, path):
+		entry = self.cache.get(path)
+		if entry is not None and path.endswith(".css"):
+			entry = self.rewrite_css(path, entry)
+		if entry is not None:
+			return entry.hash[ : 16]
+		fspath = os.path.join(self.rootdir, *path.split("/"))
+		try:
+			with open(fspath, "rb") as fin:
+				key = _stat_key(os.fstat(fin.fileno()))
+				with self._lock:
+					cached = self._hashes.get(path)
+				if cached is not None and cached[0] == key:
+					return cached[1]
+				hasher = hashlib.blake2b(digest_size=16)
+				while True:
+					block = fin.read(2**20)
+					if len(block) == 0:
+						break
+					hasher.update(block)
+		except OSError:
+			return None
+		hash = hasher.hexdigest()[ : 16]
+		with self._lock:
+			self._hashes[path] = (key, hash)
+		return hash
+
+
+
+# ---- First-paint bundle ----
+
+# Builds a single self-contained page from an HTML file, so that the first paint needs only one request:
+# style sheets and scripts are inlined (with whitespace and comments removed), the configuration is embedded
+# as a JSON script element, images are inlined as data URIs, and preload hints are added for the fonts that
+# the style sheets actually use. A <base> element keeps the remaining relative URLs pointing to the files.
+class FirstPaintBundle:
+	
+	_STYLESHEET = re.compile(r'<link\s+rel="stylesheet"\s+href="([^"#?:]+)"[^>]*/>')
+	_SCRIPT = re.compile(r'<script\s+type="application/javascript"\s+src="([^"#?:]+)"\s*>\s*</script>')
+	_IMAGE = re.compile(r'(<img\s[^>]*\bsrc=")([^"#?:]+\.svg)(")')
+	_CSS_URL = re.compile(r'(url\(\s*")([^"#?:]+)("\s*\))')
+	
+	
+	def __init__(self, index, cache, manifest, pagepath, configpath, baseurl):
+		self.index = index
+		self.cache = cache
+		self.manifest = manifest
+		self.pagepath = pagepath  # Like "clock.html"
+		self.configpath = configpath  # Like "config.json"
+		self.baseurl = baseurl  # Like "/file/"
+		self._built = None  # (hashes of all inputs, _CacheEntry)
+		self._lock = threading.Lock()
+	
+	
+	# Returns a cache entry with the current bundle, or None if the page is unavailable.
+	def get(self):
+		if not self.index.lookup(self.pagepath):
+			return None
+		page = self.cache.get(self.pagepath)
+		if page is None:
+			return None
+		inputs = {self.pagepath: page}
+		dir = posixpath.dirname(self.pagepath)
+		html = page.data.decode("UTF-8")
+		for (regex, group) in ((self._STYLESHEET, 1), (self._SCRIPT, 1), (self._IMAGE, 2)):
+			for match in regex.finditer(html):
+				path = posixpath.normpath(posixpath.join(dir, match.group(group)))
+				inputs[path] = self.cache.get(path) if (path in self.index.files) else None
+		inputs[self.configpath] = self.cache.get(self.configpath)
+		
+		# Fonts are only referenced by URL, but their hashed names appear in the bundle
+		for (path, entry) in list(inputs.items()):
+			if entry is not None and path.endswith(".css"):
+				for match in self._CSS_URL.finditer(entry.data.decode("UTF-8")):
+					fontpath = posixpath.normpath(posixpath.join(posixpath.dirname(path), match.group(2)))
+					inputs[fontpath] = self.manifest.hashed_path(fontpath) if (fontpath in self.index.files) else None
+		
+		key = tuple(sorted((path, getattr(val, "hash", val)) for (path, val) in inputs.items()))
+		with self._lock:
+			if self._built is not None and self._built[0] == key:
+				return self._built[1]
+		data = self._build(html, dir, inputs).encode("UTF-8")
+		mtime = max(val.mtime for val in inputs.values() if isinstance(val, _CacheEntry))
+		result = _CacheEntry(None, data, mtime, time.monotonic(), True)
+		with self._lock:
+			self._built = (key, result)
+		return result
+	
+	
+	def _build(self, html, dir, inputs):
+		def text_of(path):
+			entry = inputs.get(path)
+			return entry.data.decode("UTF-8") if isinstance(entry, _CacheEntry) else None
+		
+		def resolve(base, ref):
+			return posixpath.normpath(posixpath.join(base, ref))
+		
+		def inline_stylesheet(match):
+			path = resolve(dir, match.group(1))
+			css = text_of(path)
+			if css is None:
+				return match.group(0)
+			css = strip_subset_fonts(css)
+			cssdir = posixpath.dirname(path)
+			def rewrite_url(m):
+				hashed = inputs.get(resolve(cssdir, m.group(2)))
+				if not isinstance(hashed, str):
+					return m.group(0)
+				return m.group(1) + posixpath.relpath(hashed, dir or ".") + m.group(3)
+			css = self._CSS_URL.sub(rewrite_url, _minify_css(css))
+			preloads = "".join(
+				f'<link rel="preload" href="{url}" as="font" crossorigin="anonymous"/>\n\t\t'
+				for url in _used_font_urls(css))
+			return preloads + '<style type="text/css">/*<![CDATA[*/' + _cdata_escape(css) + "/*]]>*/</style>"
+		
+		def inline_script(match):
+			js = text_of(resolve(dir, match.group(1)))
+			if js is None:
+				return match.group(0)
+			return '<script type="application/javascript">//<![CDATA[\n' + _cdata_escape(_minify_js(js)) + "\n//]]></script>"
+		
+		def inline_image(match):
+			entry = inputs.get(resolve(dir, match.group(2)))
+			if not isinstance(entry, _CacheEntry):
+				return match.group(0)
+			return match.group(1) + "data:image/svg+xml;base64," + base64.b64encode(entry.data).decode("ASCII") + match.group(3)
+		
+		html = self._STYLESHEET.sub(inline_stylesheet, html)
+		html = self._IMAGE.sub(inline_image, html)
+		config = text_of(self.configpath)
+		if config is not None:
+			config = json.dumps(json.loads(config), separators=(",", ":"))
+			html = self._SCRIPT.sub(lambda m: '<script type="application/json" id="clock-config"><![CDATA['
+				+ _cdata_escape(config) + "]]></script>\n\t\t" + m.group(0), html, count=1)
+		html = self._SCRIPT.sub(inline_script, html)
+		return html.replace("<head>", f'<head>\n\t\t<base href="{self.baseurl}{dir + "/" if dir != "" else ""}"/>', 1)
+
+
+def _minify_css(css):
+	css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+	return "\n".join(line.strip() for line in css.splitlines() if line.strip() != "")
+
+
+# Removes indentation, blank lines, and lines that contain only a comment. This is deliberately
+# conservative (no tokenization), and relies on the script having no multi-line template literals.
+def _minify_js(js):
+	js = re.sub(r"^\s*/\*(?:(?!\*/).)*\*/\s*$", "", js, flags=re.DOTALL | re.MULTILINE)  # The comment cannot span code
+	lines = (line.strip() for line in js.splitlines())
+	return "\n".join(line for line in lines if line != "" and not line.startswith("//"))
+
+
+def _cdata_escape(text):
+	return text.replace("]]>", "]]]]><![CDATA[>")
+
+
+# Returns the URLs of the @font-face rules whose family and weight are used by some other rule in the given
+# flat (compiled) style sheet. Rules that set only one of the two inherit the other from the "html" rule.
+def _used_font_urls(css):
+	faces = []
+	def add_face(match):
+		body = match.group(1)
+		family = re.search(r'font-family:\s*"([^"]+)"', body)
+		weight = re.search(r"font-weight:\s*(\d+)", body)
+		url = re.search(r'url\(\s*"?([^")]+?)"?\s*\)', body)
+		if family is not None and url is not None:
+			faces.append((family.group(1), int(weight.group(1)) if (weight is not None) else 400, url.group(1)))
+		return ""
+	css = re.sub(r"@font-face\s*\{([^}]*)\}", add_face, css)
+	
+	def parse(decls):
+		family = re.search(r"font-family:\s*([^;}]+)", decls)
+		weight = re.search(r"font-weight:\s*(\d+|normal|bold)", decls)
+		if family is not None:
+			family = family.group(1).split(",")[0].strip().strip("\"'")
+		if weight is not None:
+			weight = {"normal": 400, "bold": 700}.get(weight.group(1)) or int(weight.group(1))
+		return (family, weight)
+	
+	rules = [(sel.strip(), parse(decls)) for (sel, decls) in re.findall(r"([^{}]+)\{([^{}]*)\}", css)]
+	deffamily, defweight = None, 400
+	for (sel, (family, weight)) in rules:
+		if "html" in (s.strip() for s in sel.split(",")):
+			deffamily = family or deffamily
+			defweight = weight or defweight
+	used = {(deffamily, defweight)}
+	used.update((family or deffamily, weight or defweight)
+		for (_, (family, weight)) in rules if (family, weight) != (None, None))
+	return [url for (family, weight, url) in faces if (family, weight) in used]
+
+
+
+
+# ---- Font subsets ----
+
+_SUBSET_FONT_SOURCE = re.compile(r'url\(\s*"[^"]*\bsubset/[^"]+\.woff"\s*\)\s*format\(\s*"woff"\s*\)\s*,\s*')
+
+
+# Removes the subset fonts (the "font/subset/*.woff" sources) from the @font-face rules of the given style sheet
+# when fontTools is unavailable, so that clients request the full fonts directly instead of trying a 404 first.
+def strip_subset_fonts(css):
+	return css if (fontTools is not None) else _SUBSET_FONT_SOURCE.sub("", css)
+
+
+# Makes WOFF fonts that contain only the glyphs for the given text, from the TrueType fonts in the web root.
+# Subsets are written to a cache directory, named by the hash of the source file and of the text.
+class FontSubsetter:
+	
+	def __init__(self, cache, cachedir, texts, defaulttext):
+		self.cache = cache  # For the web root, where the source fonts are
+		self.cachedir = cachedir
+		self.texts = texts  # Web path of source font -> string of characters to keep
+		self.defaulttext = defaulttext  # For fonts not in 'texts'
+		self._subsetcache = StaticFileCache(cachedir, 2**22)
+		self._stylesheets = {}  # Web path -> (hash of original cache entry, rewritten cache entry)
+		self._lock = threading.Lock()
+	
+	
+	# Returns a cache entry for the given style sheet that lists subset fonts only if they can be made.
+	def rewrite_css(self, path, entry):
+		if fontTools is not None:
+			return entry
+		with self._lock:
+			cached = self._stylesheets.get(path)
+		if cached is not None and cached[0] == entry.hash:
+			return cached[1]
+		data = strip_subset_fonts(entry.data.decode("UTF-8")).encode("UTF-8")
+		result = _CacheEntry(entry.key, data, entry.mtime, entry.checked, entry.gzipdata is not None)
+		with self._lock:
+			self._stylesheets[path] = (entry.hash, result)
+		return result
+	
+	
+	# Returns a cache entry with the subset WOFF of the given source TrueType font's web path, or None if unavailable.
+	def get(self, srcpath):
+		if fontTools is None:
+			return None
+		source = self.cache.get(srcpath)
+		if source is None:
+			return None
+		text = self.texts.get(srcpath, self.defaulttext)
+		name = f"{source.hash[ : 16]}-{hashlib.blake2b(text.encode('UTF-8'), digest_size=4).hexdigest()}.woff"
+		result = self._subsetcache.get(name)
+		if result is not None:
+			return result
+		
+		with self._lock:  # Subsetting takes a while, so do it once even if requested concurrently
+			result = self._subsetcache.get(name)
+			if result is not None:
+				return result
+			try:
+				font = fontTools.ttLib.TTFont(io.BytesIO(source.data))
+				subsetter = fontTools.subset.Subsetter()
+				subsetter.populate(text=text)
+				subsetter.subset(font)
+				font.flavor = "woff"
+				os.makedirs(self.cachedir, exist_ok=True)
+				temppath = os.path.join(self.cachedir, f"{name}.{os.getpid()}.tmp")
+				font.save(temppath)
+				os.replace(temppath, os.path.join(self.cachedir, name))
+			except Exception:
+				return None
+		return self._subsetcache.get(name)
@@ -0,0 +1,231 @@
+# 
+# Tablet desk clock web server
+# 
+# Copyright (c) Project Nayuki
+# All rights reserved. Contact Nayuki for licensing.
+# https://www.nayuki.io/page/tablet-desk-clock
+# 
+
+import asyncio, io, socket, threading, time, unittest
+try:
+	import bottle, engine
+except ImportError:
+	engine = None  # The bundled Bottle does not import on this Python version
+
+
+@unittest.skipIf(engine is None, "Bottle is unavailable")
+class RequestBodyTest(unittest.TestCase):
+	
+	def body(self, data, **environ):
+		rfile = io.BytesIO(data)
+		return (engine._RequestBody(rfile, environ), rfile)
+	
+	
+	def test_read_limited_to_content_length(self):
+		body, rfile = self.body(b"hello worldGET /", CONTENT_LENGTH="11")
+		self.assertEqual(body.read(), b"hello world")
+		self.assertEqual(body.read(), b"")
+		self.assertEqual(rfile.read(), b"GET /")
+	
+	
+	def test_readline_limited(self):
+		body, _ = self.body(b"ab\ncdGET /", CONTENT_LENGTH="5")
+		self.assertEqual(list(body), [b"ab\n", b"cd"])
+	
+	
+	def test_drain(self):
+		body, rfile = self.body(b"hello worldGET /", CONTENT_LENGTH="11")
+		body.read(3)
+		self.assertTrue(body.drain())
+		self.assertEqual(rfile.read(), b"GET /")
+	
+	
+	def test_drain_truncated(self):
+		body, _ = self.body(b"hello", CONTENT_LENGTH="11")
+		self.assertFalse(body.drain())
+	
+	
+	def test_drain_too_big_or_chunked(self):
+		body, _ = self.body(b"", CONTENT_LENGTH=str(engine._RequestBody.MAX_DRAIN_BYTES + 1))
+		self.assertFalse(body.drain())
+		body, _ = self.body(b"5\r\nhello\r\n0\r\n\r\n", HTTP_TRANSFER_ENCODING="chunked")
+		self.assertFalse(body.drain())
+	
+	
+	def test_invalid_length(self):
+		body, _ = self.body(b"hello", CONTENT_LENGTH="x")
+		self.assertEqual(body.read(), b"")
+		self.assertTrue(body.drain())
+
+
+@unittest.skipIf(engine is None, "Bottle is unavailable")
+class BulkheadTest(unittest.TestCase):
+	
+	def test_limit_queue_and_reject(self):
+		bulkhead = engine.Bulkhead("test", 1, 1)
+		self.assertTrue(bulkhead.acquire())
+		results = []
+		waiter = threading.Thread(target=lambda: results.append(bulkhead.acquire()))
+		waiter.start()
+		while bulkhead.stats()["queue-depth"] == 0:
+			time.sleep(0.001)
+		self.assertFalse(bulkhead.acquire())  # The queue is full
+		self.assertEqual(results, [])
+		bulkhead.release()  # Hands the slot to the waiter
+		waiter.join()
+		self.assertEqual(results, [True])
+		self.assertEqual(bulkhead.stats()["active"], 1)
+		self.assertEqual(bulkhead.stats()["rejected"], 1)
+		bulkhead.release()
+		self.assertEqual(bulkhead.stats()["active"], 0)
+	
+	
+	def test_async(self):
+		bulkhead = engine.Bulkhead("test", 1, 2)
+		async def main():
+			self.assertTrue(await bulkhead.acquire_async())
+			second = asyncio.ensure_future(bulkhead.acquire_async())
+			third = asyncio.ensure_future(bulkhead.acquire_async())
+			await asyncio.sleep(0.01)
+			third.cancel()  # Leaves the queue without taking a slot
+			await asyncio.sleep(0.01)
+			self.assertEqual(bulkhead.stats()["queue-depth"], 1)
+			bulkhead.release()
+			self.assertTrue(await second)
+			bulkhead.release()
+		asyncio.run(main())
+		self.assertEqual(bulkhead.stats()["active"], 0)
+	
+	
+	def test_streamed_body_holds_slot(self):
+		bulkhead = engine.Bulkhead("test", 1, 0)
+		bulkhead.acquire()
+		body = engine._BulkheadBody((chunk for chunk in [b"a", b"b"]), bulkhead.release)
+		self.assertEqual(next(body), b"a")
+		self.assertEqual(bulkhead.stats()["active"], 1)
+		self.assertEqual(list(body), [b"b"])
+		self.assertEqual(bulkhead.stats()["active"], 0)
+		body.close()  # Releases only once
+		self.assertEqual(bulkhead.stats()["active"], 0)
+
+
+@unittest.skipIf(engine is None, "Bottle is unavailable")
+class PriorityQueueTest(unittest.TestCase):
+	
+	def test_order(self):
+		queue = engine._PriorityQueue()
+		for (item, priority) in (("a", 1), ("b", 0), ("c", 1), ("d", 0)):
+			queue.put(item, priority)
+		self.assertEqual([queue.get()[0] for _ in range(4)], ["b", "d", "a", "c"])
+	
+	
+	def test_oldest(self):
+		queue = engine._PriorityQueue()
+		self.assertIsNone(queue.oldest())
+		before = time.monotonic()
+		queue.put("a", 1)
+		queue.put("b", 0)
+		self.assertGreaterEqual(queue.oldest(), before)
+		queue.get()  # Takes "b", but "a" is still the oldest
+		self.assertLessEqual(queue.oldest(), time.monotonic())
+		queue.get()
+		self.assertIsNone(queue.oldest())
+	
+	
+	def test_bounded(self):
+		queue = engine._PriorityQueue(1)
+		queue.put("a")
+		threading.Timer(0.05, queue.get).start()
+		start = time.monotonic()
+		queue.put("b")
+		self.assertGreaterEqual(time.monotonic() - start, 0.04)
+		self.assertEqual(queue.qsize(), 1)
+		self.assertFalse(queue.put("c", block=False))
+		self.assertEqual(queue.get()[0], "b")
+		self.assertTrue(queue.put("c", block=False))
+
+
+@unittest.skipIf(engine is None, "Bottle is unavailable")
+class LoadShedderTest(unittest.TestCase):
+	
+	def test_sheds_while_stalled(self):
+		oldest = [None]
+		shedder = engine.LoadShedder(0.1, lambda: oldest[0])
+		self.assertIsNone(shedder.check("proxy"))
+		oldest[0] = time.monotonic() - 0.25  # Nothing has been dequeued, but the queue head is waiting
+		self.assertIsNotNone(shedder.check("proxy"))
+		self.assertIsNotNone(shedder.check("network"))
+		self.assertIsNone(shedder.check("weather"))
+		self.assertIsNone(shedder.check("time"))
+		self.assertEqual(shedder.stats()["shedding"], ["proxy", "network"])
+	
+	
+	def test_average(self):
+		shedder = engine.LoadShedder(0.1)
+		for _ in range(20):
+			shedder.record(0.5)
+		self.assertEqual(shedder.check("weather"), engine.RETRY_AFTER_SECONDS * len(engine.SHED_ORDER))
+		self.assertIsNone(shedder.check("static"))
+
+
+@unittest.skipIf(engine is None, "Bottle is unavailable")
+class PooledServerTest(unittest.TestCase):
+	
+	def setUp(self):
+		app = bottle.Bottle()
+		app.route("/", callback=lambda: "hello")
+		self.server = engine.PooledWSGIServer(("127.0.0.1", 0), engine.KeepAliveRequestHandler, 1, 4, 16)
+		self.server.set_app(app)
+		self.server.header_timeout = 0.5
+		threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+		self.addCleanup(self.server.server_close)
+		self.addCleanup(self.server.shutdown)
+	
+	
+	def connect(self):
+		sock = socket.create_connection(self.server.server_address, timeout=5)
+		self.addCleanup(sock.close)
+		return sock
+	
+	
+	def test_partial_head_does_not_hold_worker(self):
+		slow = self.connect()
+		slow.sendall(b"GET / HTTP/1.1\r\nHost: x\r\n")
+		time.sleep(0.1)
+		fast = self.connect()
+		start = time.monotonic()
+		fast.sendall(b"GET / HTTP/1.1\r\nHost: x\r\n\r\n")
+		self.assertTrue(fast.recv(4096).startswith(b"HTTP/1.1 200 "))
+		self.assertLess(time.monotonic() - start, 0.3)  # The only worker was free
+		
+		slow.sendall(b"\r\n")
+		data = b""
+		while not data.endswith(b"hello"):
+			temp = slow.recv(4096)
+			self.assertNotEqual(temp, b"")
+			data += temp
+		self.assertTrue(data.startswith(b"HTTP/1.1 200 "))
+	
+	
+	def test_header_timeout(self):
+		sock = self.connect()
+		sock.sendall(b"GET / HT")
+		start = time.monotonic()
+		self.assertEqual(sock.recv(4096), b"")
+		self.assertLess(time.monotonic() - start, 2.0)
+	
+	
+	def test_pipelined(self):
+		sock = self.connect()
+		sock.sendall(b"GET / HTTP/1.1\r\nHost: x\r\n\r\nGET / HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+		data = b""
+		while True:
+			temp = sock.recv(4096)
+			if len(temp) == 0:
+				break
+			data += temp
+		self.assertEqual(data.count(b"HTTP/1.1 200 "), 2)
+
+
+if __name__ == "__main__":
+	unittest.main()
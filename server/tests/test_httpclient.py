@@ -0,0 +1,131 @@
+# 
+# Tablet desk clock web server
+# 
+# Copyright (c) Project Nayuki
+# All rights reserved. Contact Nayuki for licensing.
+# https://www.nayuki.io/page/tablet-desk-clock
+# 
+
+import asyncio, http.server, threading, time, unittest, urllib.error
+import httpclient
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+	
+	protocol_version = "HTTP/1.1"
+	
+	
+	def do_GET(self):
+		if self.path == "/hello":
+			self.reply(b"hello")
+		elif self.path == "/redirect":
+			self.send_response(302)
+			self.send_header("Location", "/hello")
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+		elif self.path == "/chunked":
+			self.send_response(200)
+			self.send_header("Transfer-Encoding", "chunked")
+			self.end_headers()
+			self.wfile.write(b"3\r\nabc\r\n2;x=y\r\nde\r\n0\r\nTrailer: z\r\n\r\n")
+		elif self.path == "/slow":
+			self.send_response(200)
+			self.send_header("Content-Length", "6")
+			self.end_headers()
+			self.wfile.write(b"abc")
+			self.wfile.flush()
+			time.sleep(0.5)
+			self.wfile.write(b"def")
+		elif self.path == "/truncated":
+			self.send_response(200)
+			self.send_header("Content-Length", "10")
+			self.send_header("Connection", "close")
+			self.end_headers()
+			self.wfile.write(b"abc")
+			self.close_connection = True
+		else:
+			self.send_error(404)
+	
+	
+	def reply(self, body):
+		self.send_response(200)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	
+	
+	def log_message(self, *args):
+		pass
+
+
+class HttpClientTest(unittest.TestCase):
+	
+	@classmethod
+	def setUpClass(cls):
+		cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+		cls.server.daemon_threads = True
+		threading.Thread(target=cls.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+		cls.base = f"http://127.0.0.1:{cls.server.server_address[1]}"
+	
+	
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+		cls.server.server_close()
+	
+	
+	def setUp(self):
+		self.pool = httpclient.ConnectionPool()
+	
+	
+	def test_get_reuses_connection(self):
+		for _ in range(2):
+			resp = self.pool.get(self.base + "/hello", 5)
+			self.assertEqual((resp.status, resp.body), (200, b"hello"))
+		self.assertEqual(sum(len(conns) for conns in self.pool._idle.values()), 1)
+	
+	
+	def test_redirect_and_error(self):
+		resp = self.pool.get(self.base + "/redirect", 5)
+		self.assertEqual((resp.url, resp.body), (self.base + "/hello", b"hello"))
+		with self.assertRaises(urllib.error.HTTPError) as cm:
+			self.pool.get(self.base + "/missing", 5)
+		self.assertEqual(cm.exception.code, 404)
+	
+	
+	def test_fetch(self):
+		async def run():
+			return (await self.pool.fetch(self.base + "/hello", 5), await self.pool.fetch(self.base + "/chunked", 5))
+		hello, chunked = asyncio.run(run())
+		self.assertEqual(hello.body, b"hello")
+		self.assertEqual(chunked.body, b"abcde")
+	
+	
+	def test_async_stream_returns_partial_body(self):
+		async def run():
+			stream = await self.pool.open_stream_async(self.base + "/slow", 5)
+			try:
+				start = time.monotonic()
+				first = await stream.read(65536)
+				elapsed = time.monotonic() - start
+				return (first, elapsed, await stream.read())
+			finally:
+				stream.close()
+		first, elapsed, rest = asyncio.run(run())
+		self.assertEqual((first, rest), (b"abc", b"def"))
+		self.assertLess(elapsed, 0.3)  # Did not wait for the rest of the body
+	
+	
+	def test_async_stream_truncated(self):
+		async def run():
+			stream = await self.pool.open_stream_async(self.base + "/truncated", 5)
+			try:
+				return await stream.read()
+			finally:
+				stream.close()
+		with self.assertRaises(urllib.error.URLError):
+			asyncio.run(run())
+
+
+if __name__ == "__main__":
+	unittest.main()
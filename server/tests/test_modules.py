@@ -0,0 +1,40 @@
+# 
+# Tablet desk clock web server
+# 
+# Copyright (c) Project Nayuki
+# All rights reserved. Contact Nayuki for licensing.
+# https://www.nayuki.io/page/tablet-desk-clock
+# 
+
+import unittest
+try:
+	import modules
+except ImportError:
+	modules = None  # The bundled Bottle does not import on this Python version
+
+
+@unittest.skipIf(modules is None, "Bottle is unavailable")
+class WallpaperBucketTest(unittest.TestCase):
+	
+	def test_examples(self):
+		self.assertEqual(modules.wallpaper_bucket(1920, 1080), (1920, 1200))
+		self.assertEqual(modules.wallpaper_bucket(1080, 1920), (1200, 1920))
+		self.assertEqual(modules.wallpaper_bucket(1280, 800), (1280, 800))
+		self.assertEqual(modules.wallpaper_bucket(100, 100), (640, 640))
+		self.assertEqual(modules.wallpaper_bucket(2000, 2000), (2560, 2560))
+	
+	
+	def test_covers_screen(self):
+		buckets = set()
+		for width in range(1, modules.WALLPAPER_MAX_SIZE + 1, 37):
+			for height in range(1, modules.WALLPAPER_MAX_SIZE + 1, 41):
+				bucket = modules.wallpaper_bucket(width, height)
+				self.assertLessEqual(width, bucket[0])
+				self.assertLessEqual(height, bucket[1])
+				self.assertIn(max(bucket), modules.WALLPAPER_SIZE_BUCKETS)
+				buckets.add(bucket)
+		self.assertLessEqual(len(buckets), len(modules.WALLPAPER_SIZE_BUCKETS) * (2 * modules.WALLPAPER_ASPECT_STEPS - 1))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,151 @@
+# 
+# Tablet desk clock web server
+# 
+# Copyright (c) Project Nayuki
+# All rights reserved. Contact Nayuki for licensing.
+# https://www.nayuki.io/page/tablet-desk-clock
+# 
+
+import unittest
+import ntp
+
+
+ERA_END_NS = (2**32 - ntp.EPOCH_OFFSET) * 10**9  # Unix time at which NTP era 0 ends, in February 2036
+
+
+# Returns a server reply to the given request, for a server whose clock is 'offset' nanoseconds ahead of the local one,
+# over a network with the given one-way delay in nanoseconds. Also returns the local receive time.
+def make_reply(request, localstart, offset=0, oneway=0, header=(0 << 6) | (4 << 3) | 4, stratum=2, originate=None):
+	if originate is None:
+		originate = ntp.PACKET.unpack(request)[10]
+	receive = ntp.to_timestamp(localstart + oneway + offset)
+	transmit = ntp.to_timestamp(localstart + oneway + 1000 + offset)
+	packet = ntp.PACKET.pack(header, stratum, 6, -20, 2**15, 2**14, 0, 0, originate, receive, transmit)
+	return (packet, localstart + 2 * oneway + 1000)
+
+
+class TimestampTest(unittest.TestCase):
+	
+	def test_unix_epoch(self):
+		self.assertEqual(ntp.to_timestamp(0), ntp.EPOCH_OFFSET << 32)
+	
+	
+	def test_fraction(self):
+		self.assertEqual(ntp.to_timestamp(500_000_000) - ntp.to_timestamp(0), 2**31)
+	
+	
+	def test_era_wrap(self):
+		before = ntp.to_timestamp(ERA_END_NS - 10**9)
+		after = ntp.to_timestamp(ERA_END_NS + 10**9)
+		self.assertEqual(after, 2**32)  # One second into era 1
+		self.assertEqual(ntp.difference(after, before), 2 * 2**32)
+		self.assertEqual(ntp.difference(before, after), -2 * 2**32)
+	
+	
+	def test_request(self):
+		request = ntp.make_request(123 * 10**9)
+		fields = ntp.PACKET.unpack(request)
+		self.assertEqual(fields[0], ntp.REQUEST_HEADER)
+		self.assertEqual(fields[10], ntp.to_timestamp(123 * 10**9))
+
+
+class ReplySampleTest(unittest.TestCase):
+	
+	LOCAL_START = 1_700_000_000 * 10**9
+	
+	
+	def sample(self, localstart=LOCAL_START, **kwargs):
+		request = ntp.make_request(localstart)
+		packet, localend = make_reply(request, localstart, **kwargs)
+		return ntp.reply_sample(request, packet, localstart, localend)
+	
+	
+	def test_offset_and_delay(self):
+		offset, delay, stratum, rootdelay, rootdispersion = self.sample(offset=1_500_000_000, oneway=20_000_000)
+		self.assertAlmostEqual(offset, 1_500_000, delta=1)
+		self.assertAlmostEqual(delay, 40_000, delta=1)
+		self.assertEqual(stratum, 2)
+		self.assertEqual(rootdelay, 500_000)
+		self.assertEqual(rootdispersion, 250_000)
+	
+	
+	def test_negative_offset(self):
+		self.assertAlmostEqual(self.sample(offset=-250_000_000, oneway=1_000_000)[0], -250_000, delta=1)
+	
+	
+	def test_across_era_wrap(self):
+		offset, delay = self.sample(localstart=ERA_END_NS - 5_000_000, offset=3_000_000_000, oneway=10_000_000)[ : 2]
+		self.assertAlmostEqual(offset, 3_000_000, delta=1)
+		self.assertAlmostEqual(delay, 20_000, delta=1)
+	
+	
+	def test_versions(self):
+		for version in (3, 4):
+			self.sample(header=(version << 3) | 4)
+		for version in (1, 2, 5):
+			with self.assertRaises(ValueError):
+				self.sample(header=(version << 3) | 4)
+	
+	
+	def test_not_server_mode(self):
+		with self.assertRaises(ValueError):
+			self.sample(header=(4 << 3) | 3)
+	
+	
+	def test_unsynchronized(self):
+		with self.assertRaises(ValueError):
+			self.sample(header=(3 << 6) | (4 << 3) | 4)
+	
+	
+	def test_kiss_of_death(self):
+		with self.assertRaises(ValueError):
+			self.sample(stratum=0)
+		with self.assertRaises(ValueError):
+			self.sample(stratum=16)
+	
+	
+	def test_originate_mismatch(self):
+		with self.assertRaises(ValueError):
+			self.sample(originate=ntp.to_timestamp(self.LOCAL_START - 10**9))
+	
+	
+	def test_short_packet(self):
+		request = ntp.make_request(self.LOCAL_START)
+		packet, localend = make_reply(request, self.LOCAL_START)
+		with self.assertRaises(ValueError):
+			ntp.reply_sample(request, packet[ : 47], self.LOCAL_START, localend)
+
+
+class SelectTruechimersTest(unittest.TestCase):
+	
+	def test_all_agree(self):
+		offset, distance = ntp.select_truechimers([(1000, 100), (1050, 100), (1100, 200)])
+		self.assertTrue(1000 <= offset <= 1100)
+		self.assertEqual(distance, 100)
+	
+	
+	def test_falseticker_excluded(self):
+		offset, _ = ntp.select_truechimers([(1000, 100), (1020, 100), (90_000, 100)])
+		self.assertEqual(offset, 1010)
+	
+	
+	def test_no_majority(self):
+		self.assertIsNone(ntp.select_truechimers([(0, 100), (10_000, 100)]))
+		self.assertIsNone(ntp.select_truechimers([(0, 10), (1000, 10), (2000, 10), (2005, 10)]))
+	
+	
+	def test_single_server(self):
+		self.assertEqual(ntp.select_truechimers([(1234, 500)]), (1234, 500))
+	
+	
+	def test_empty(self):
+		self.assertIsNone(ntp.select_truechimers([]))
+	
+	
+	def test_weighted_by_distance(self):
+		offset, _ = ntp.select_truechimers([(0, 100), (300, 300)])
+		self.assertEqual(offset, 75)  # Weights 1/100 and 1/300
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,186 @@
+# 
+# Tablet desk clock web server
+# 
+# Copyright (c) Project Nayuki
+# All rights reserved. Contact Nayuki for licensing.
+# https://www.nayuki.io/page/tablet-desk-clock
+# 
+
+import email.utils, os, shutil, tempfile, unittest
+import proxycache
+
+
+NOW = 1_700_000_000.0
+
+
+def http_date(unixtime):
+	return email.utils.formatdate(unixtime, usegmt=True)
+
+
+class IsCacheableTest(unittest.TestCase):
+	
+	def test_explicit_lifetime(self):
+		self.assertTrue(proxycache.is_cacheable(200, [("Cache-Control", "max-age=60")]))
+		self.assertTrue(proxycache.is_cacheable(200, [("Cache-Control", "s-maxage=60")]))
+		self.assertTrue(proxycache.is_cacheable(200, [("Cache-Control", "public")]))
+		self.assertTrue(proxycache.is_cacheable(200, [("Expires", http_date(NOW))]))
+	
+	
+	def test_validators(self):
+		self.assertTrue(proxycache.is_cacheable(200, [("ETag", '"abc"')]))
+		self.assertTrue(proxycache.is_cacheable(200, [("Last-Modified", http_date(NOW))]))
+	
+	
+	def test_not_cacheable(self):
+		self.assertFalse(proxycache.is_cacheable(200, []))
+		self.assertFalse(proxycache.is_cacheable(404, [("Cache-Control", "max-age=60")]))
+		self.assertFalse(proxycache.is_cacheable(200, [("Cache-Control", "max-age=60, no-store")]))
+		self.assertFalse(proxycache.is_cacheable(200, [("Cache-Control", "private, max-age=60")]))
+		self.assertFalse(proxycache.is_cacheable(200, [("Cache-Control", "max-age=60"), ("Vary", "*")]))
+	
+	
+	def test_header_names_case_insensitive(self):
+		self.assertTrue(proxycache.is_cacheable(200, [("cache-control", "MAX-AGE=60")]))
+	
+	
+	def test_cache_directives(self):
+		self.assertEqual(proxycache.cache_directives('max-age="60", No-Cache, , s-maxage=10'),
+			{"max-age": "60", "no-cache": None, "s-maxage": "10"})
+		self.assertEqual(proxycache.cache_directives(None), {})
+
+
+class FreshnessTest(unittest.TestCase):
+	
+	def entry(self, *headers):
+		return proxycache.CacheEntry("http://example.com/", list(headers), b"body", NOW)
+	
+	
+	def test_max_age(self):
+		entry = self.entry(("Cache-Control", "max-age=60"))
+		self.assertEqual(entry.lifetime, 60)
+		self.assertTrue(entry.is_fresh(NOW + 59))
+		self.assertFalse(entry.is_fresh(NOW + 60))
+	
+	
+	def test_s_maxage_wins(self):
+		self.assertEqual(self.entry(("Cache-Control", "max-age=60, s-maxage=10")).lifetime, 10)
+	
+	
+	def test_age_and_date(self):
+		entry = self.entry(("Cache-Control", "max-age=60"), ("Age", "15"))
+		self.assertEqual(entry.age(NOW), 15)
+		entry = self.entry(("Cache-Control", "max-age=60"), ("Date", http_date(NOW - 20)), ("Age", "5"))
+		self.assertEqual(entry.age(NOW), 20)  # The larger of Age and the apparent age
+	
+	
+	def test_expires(self):
+		entry = self.entry(("Date", http_date(NOW - 100)), ("Expires", http_date(NOW + 200)))
+		self.assertEqual(entry.lifetime, 300)
+		self.assertEqual(self.entry(("Expires", "0")).lifetime, 0)  # Invalid dates mean already expired
+	
+	
+	def test_heuristic(self):
+		entry = self.entry(("Date", http_date(NOW)), ("Last-Modified", http_date(NOW - 1000)))
+		self.assertEqual(entry.lifetime, 100)
+		entry = self.entry(("Date", http_date(NOW)), ("Last-Modified", http_date(NOW - 10**8)))
+		self.assertEqual(entry.lifetime, proxycache.CacheEntry.MAX_HEURISTIC_SECONDS)
+	
+	
+	def test_no_cache(self):
+		entry = self.entry(("Cache-Control", "max-age=60, no-cache, stale-while-revalidate=30"), ("ETag", '"x"'))
+		self.assertEqual(entry.lifetime, 0)
+		self.assertFalse(entry.can_serve_stale(NOW + 1))
+	
+	
+	def test_stale_while_revalidate(self):
+		entry = self.entry(("Cache-Control", "max-age=60, stale-while-revalidate=30"))
+		self.assertFalse(entry.is_fresh(NOW + 70))
+		self.assertTrue(entry.can_serve_stale(NOW + 70))
+		self.assertFalse(entry.can_serve_stale(NOW + 90))
+		for directive in ("must-revalidate", "proxy-revalidate"):
+			entry = self.entry(("Cache-Control", f"max-age=60, stale-while-revalidate=30, {directive}"))
+			self.assertFalse(entry.can_serve_stale(NOW + 70))
+	
+	
+	def test_freshen_merges_headers(self):
+		entry = self.entry(("Cache-Control", "max-age=60"), ("ETag", '"v1"'), ("Content-Type", "text/plain"))
+		entry.freshen([("Cache-Control", "max-age=600"), ("ETag", '"v2"')], NOW + 100)
+		self.assertEqual(entry.lifetime, 600)
+		self.assertTrue(entry.is_fresh(NOW + 150))
+		self.assertEqual(entry.etag, '"v2"')
+		self.assertEqual(entry.getheader("content-type"), "text/plain")
+		self.assertEqual(entry.validators(), [("If-None-Match", '"v2"')])
+	
+	
+	def test_is_not_modified(self):
+		entry = self.entry(("ETag", 'W/"abc"'), ("Last-Modified", http_date(NOW - 100)))
+		self.assertTrue(entry.is_not_modified({"HTTP_IF_NONE_MATCH": '"xyz", "abc"'}))
+		self.assertFalse(entry.is_not_modified({"HTTP_IF_NONE_MATCH": '"xyz"', "HTTP_IF_MODIFIED_SINCE": http_date(NOW)}))
+		self.assertTrue(entry.is_not_modified({"HTTP_IF_MODIFIED_SINCE": http_date(NOW)}))
+		self.assertFalse(entry.is_not_modified({"HTTP_IF_MODIFIED_SINCE": http_date(NOW - 200)}))
+
+
+class ProxyCacheTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.diskdir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.diskdir, True)
+	
+	
+	# Returns a new cache in the test's directory, whose lock file is closed when the test ends.
+	def make_cache(self, memorybytes, diskbytes, maxentrybytes):
+		cache = proxycache.ProxyCache(memorybytes, self.diskdir, diskbytes, maxentrybytes)
+		self.addCleanup(lambda: cache._lockfile is not None and cache._lockfile.close())
+		return cache
+	
+	
+	def test_spill_to_disk(self):
+		cache = self.make_cache(150, 10**6, 1000)
+		for name in "abc":
+			cache.put(name, [], name.encode() * 100, NOW)
+		stats = cache.stats()
+		self.assertEqual((stats["memory-entries"], stats["disk-entries"]), (1, 2))
+		with cache.get("a").open_body() as body:
+			self.assertEqual(body.read(), b"a" * 100)
+		self.assertEqual(cache.get("c").open_body(), b"c" * 100)
+		self.assertIsNone(cache.get("d"))
+	
+	
+	def test_disk_limit(self):
+		cache = self.make_cache(0, 250, 1000)
+		for name in "abc":
+			cache.put(name, [], name.encode() * 100, NOW)
+		self.assertIsNone(cache.get("a"))
+		self.assertEqual(cache.stats()["disk-bytes"], 200)
+	
+	
+	def test_too_big(self):
+		cache = self.make_cache(10**6, 10**6, 10)
+		self.assertIsNone(cache.put("a", [], b"x" * 11, NOW))
+		self.assertIsNone(cache.get("a"))
+	
+	
+	def test_revalidation_once(self):
+		cache = self.make_cache(10**6, 10**6, 10)
+		self.assertTrue(cache.begin_revalidation("a"))
+		self.assertFalse(cache.begin_revalidation("a"))
+		cache.end_revalidation("a")
+		self.assertTrue(cache.begin_revalidation("a"))
+	
+	
+	@unittest.skipIf(proxycache.fcntl is None and proxycache.msvcrt is None, "No file locking")
+	def test_orphaned_dirs_removed(self):
+		orphan = os.path.join(self.diskdir, "orphan")
+		os.mkdir(orphan)
+		open(os.path.join(orphan, proxycache.LOCK_FILE_NAME), "wb").close()
+		other = self.make_cache(0, 10**6, 1000)
+		other.put("a", [], b"x", NOW)  # Its directory stays locked while the object is alive
+		cache = self.make_cache(0, 10**6, 1000)
+		cache.put("b", [], b"y", NOW)
+		self.assertFalse(os.path.exists(orphan))
+		self.assertTrue(os.path.isdir(other._processdir))
+		self.assertEqual(len(os.listdir(self.diskdir)), 2)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,143 @@
+# 
+# Tablet desk clock web server
+# 
+# Copyright (c) Project Nayuki
+# All rights reserved. Contact Nayuki for licensing.
+# https://www.nayuki.io/page/tablet-desk-clock
+# 
+
+import asyncio, os, shutil, tempfile, threading, time, unittest
+import sharedcache
+
+
+class SharedCacheTest(unittest.TestCase):
+	
+	def setUp(self):
+		dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, dir, True)
+		self.path = os.path.join(dir, "shared.bin")
+	
+	
+	def test_put_get(self):
+		cache = sharedcache.SharedCache(self.path, 4, 256)
+		self.assertIsNone(cache.get("a"))
+		cache.put("a", b"hello", 60)
+		self.assertEqual(cache.get("a"), b"hello")
+		cache.put("a", b"bye", 60)
+		self.assertEqual(cache.get("a"), b"bye")
+	
+	
+	def test_shared_between_instances(self):
+		sharedcache.SharedCache(self.path, 4, 256).put("a", b"hello", 60)
+		self.assertEqual(sharedcache.SharedCache(self.path, 4, 256).get("a"), b"hello")
+	
+	
+	def test_expiry(self):
+		cache = sharedcache.SharedCache(self.path, 4, 256)
+		cache.put("a", b"hello", -1)
+		self.assertIsNone(cache.get("a"))
+	
+	
+	def test_too_big(self):
+		cache = sharedcache.SharedCache(self.path, 4, 256)
+		cache.put("a", b"x" * (cache.maxvaluesize + 1), 60)
+		self.assertIsNone(cache.get("a"))
+		cache.put("a", b"x" * cache.maxvaluesize, 60)
+		self.assertEqual(len(cache.get("a")), cache.maxvaluesize)
+	
+	
+	def test_eviction_by_colliding_key(self):
+		cache = sharedcache.SharedCache(self.path, 1, 256)
+		cache.put("a", b"1", 60)
+		cache.put("b", b"2", 60)
+		self.assertIsNone(cache.get("a"))
+		self.assertEqual(cache.get("b"), b"2")
+	
+	
+	def test_recovers_from_killed_writer(self):
+		cache = sharedcache.SharedCache(self.path, 1, 256)
+		cache.put("a", b"hello", 60)
+		mm = cache._open()
+		base = cache.FILE_HEADER_SIZE
+		cache.SEQUENCE.pack_into(mm, base, cache.SEQUENCE.unpack_from(mm, base)[0] + 1)  # Stopped midway
+		self.assertIsNone(cache.get("a"))
+		cache.put("a", b"bye", 60)
+		self.assertEqual(cache.SEQUENCE.unpack_from(mm, base)[0] % 2, 0)
+		self.assertEqual(cache.get("a"), b"bye")
+	
+	
+	def test_layout_change_resets(self):
+		sharedcache.SharedCache(self.path, 4, 256).put("a", b"hello", 60)
+		cache = sharedcache.SharedCache(self.path, 8, 256)
+		self.assertIsNone(cache.get("a"))
+		self.assertEqual(os.path.getsize(self.path), cache.FILE_HEADER_SIZE + 8 * 256)
+
+
+class SingleFlightTest(unittest.TestCase):
+	
+	def test_concurrent_callers_share_one_call(self):
+		flight = sharedcache.SingleFlight()
+		started = threading.Event()
+		release = threading.Event()
+		calls = []
+		def func():
+			calls.append(None)
+			started.set()
+			release.wait()
+			return 42
+		results = []
+		leader = threading.Thread(target=lambda: results.append(flight.do("k", func)))
+		leader.start()
+		started.wait()
+		followers = [threading.Thread(target=lambda: results.append(flight.do("k", func))) for _ in range(3)]
+		for thread in followers:
+			thread.start()
+		time.sleep(0.1)  # Let the followers join the call in progress
+		release.set()
+		for thread in [leader] + followers:
+			thread.join()
+		self.assertEqual(results, [42] * 4)
+		self.assertEqual(len(calls), 1)
+		self.assertEqual(flight.do("k", lambda: 7), 7)  # A finished call is not reused
+	
+	
+	def test_exception_shared(self):
+		flight = sharedcache.SingleFlight()
+		started = threading.Event()
+		release = threading.Event()
+		def fail():
+			started.set()
+			release.wait()
+			raise ValueError()
+		errors = []
+		def call():
+			try:
+				flight.do("k", fail)
+			except ValueError as e:
+				errors.append(e)
+		threads = [threading.Thread(target=call)]
+		threads[0].start()
+		started.wait()
+		threads.append(threading.Thread(target=call))
+		threads[1].start()
+		release.set()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(len(errors), 2)
+	
+	
+	def test_async(self):
+		flight = sharedcache.SingleFlight()
+		calls = []
+		async def func():
+			calls.append(None)
+			await asyncio.sleep(0.01)
+			return "x"
+		async def main():
+			return await asyncio.gather(*(flight.do_async("k", func) for _ in range(5)))
+		self.assertEqual(asyncio.run(main()), ["x"] * 5)
+		self.assertEqual(len(calls), 1)
+
+
+if __name__ == "__main__":
+	unittest.main()
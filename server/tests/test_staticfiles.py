@@ -0,0 +1,241 @@
+# 
+# Tablet desk clock web server
+# 
+# Copyright (c) Project Nayuki
+# All rights reserved. Contact Nayuki for licensing.
+# https://www.nayuki.io/page/tablet-desk-clock
+# 
+
+import os, posixpath, shutil, tempfile, unittest
+try:
+	import staticfiles
+except ImportError:
+	staticfiles = None  # The bundled Bottle does not import on this Python version
+
+
+@unittest.skipIf(staticfiles is None, "Bottle is unavailable")
+class AcceptsGzipTest(unittest.TestCase):
+	
+	def test_accepted(self):
+		for header in ("gzip", "deflate, gzip", "GZIP;q=0.5", "x-gzip", "*", "br;q=1.0, gzip;q=0.8, *;q=0.1"):
+			self.assertTrue(staticfiles._accepts_gzip(header), header)
+	
+	
+	def test_refused(self):
+		for header in ("", "identity", "br", "gzip;q=0", "gzip;q=0.0, *", "*;q=0", "gzip;q=bad", "deflate, *;q=0"):
+			self.assertFalse(staticfiles._accepts_gzip(header), header)
+
+
+@unittest.skipIf(staticfiles is None, "Bottle is unavailable")
+class StripSubsetFontsTest(unittest.TestCase):
+	
+	CSS = '@font-face { font-family: "A"; src: url("font/subset/a.woff") format("woff"), url("font/a.ttf") format("truetype"); }'
+	
+	
+	def test_without_fonttools(self):
+		saved = staticfiles.fontTools
+		staticfiles.fontTools = None
+		try:
+			self.assertEqual(staticfiles.strip_subset_fonts(self.CSS),
+				'@font-face { font-family: "A"; src: url("font/a.ttf") format("truetype"); }')
+		finally:
+			staticfiles.fontTools = saved
+	
+	
+	@unittest.skipIf(staticfiles is None or staticfiles.fontTools is None, "fontTools is unavailable")
+	def test_with_fonttools(self):
+		self.assertEqual(staticfiles.strip_subset_fonts(self.CSS), self.CSS)
+
+
+@unittest.skipIf(staticfiles is None, "Bottle is unavailable")
+class MinifyTest(unittest.TestCase):
+	
+	def test_js_comment_lines(self):
+		js = "/* Header\n * text\n */\n\n\tvar x = 1;  \n\t// Note\n\tvar y = 2;\n"
+		self.assertEqual(staticfiles._minify_js(js), "var x = 1;\nvar y = 2;")
+	
+	
+	def test_js_comment_next_to_code_kept(self):
+		js = "/* a */ x = 1;\ny = 2; /* b */\nz = 3;\n"
+		self.assertEqual(staticfiles._minify_js(js), "/* a */ x = 1;\ny = 2; /* b */\nz = 3;")
+	
+	
+	def test_css(self):
+		css = "/* Header */\nhtml {\n\tcolor: red; /* inline */\n}\n\n"
+		self.assertEqual(staticfiles._minify_css(css), "html {\ncolor: red;\n}")
+
+
+@unittest.skipIf(staticfiles is None, "Bottle is unavailable")
+class StaticFileIndexTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.root)
+		_write(self.root, "a.txt", b"a")
+		_write(self.root, "sub/b.css", b"b")
+		self.index = staticfiles.StaticFileIndex(self.root)
+	
+	
+	def test_lookup(self):
+		self.assertTrue(self.index.lookup("a.txt"))
+		self.assertTrue(self.index.lookup("sub/b.css"))
+		self.assertFalse(self.index.lookup("sub"))
+		self.assertFalse(self.index.lookup("c.txt"))
+		self.assertEqual(self.index.files, {"a.txt", "sub/b.css"})
+	
+	
+	def test_refresh(self):
+		self.index.lookup("")
+		_write(self.root, "sub/c.txt", b"c")
+		shutil.rmtree(os.path.join(self.root, "sub"))
+		_write(self.root, "d.txt", b"d")
+		self.index.refresh()
+		self.assertTrue(self.index.lookup("d.txt"))
+		self.assertEqual(self.index.files, {"a.txt", "d.txt"})
+
+
+@unittest.skipIf(staticfiles is None, "Bottle is unavailable")
+class StaticFileCacheTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.root)
+	
+	
+	def test_get_and_revalidate(self):
+		cache = staticfiles.StaticFileCache(self.root, 1000)
+		cache.REVALIDATE_SECONDS = 0.0
+		_write(self.root, "a.bin", b"hello")
+		entry = cache.get("a.bin")
+		self.assertEqual(entry.data, b"hello")
+		self.assertIs(cache.get("a.bin"), entry)
+		_write(self.root, "a.bin", b"changed")
+		self.assertEqual(cache.get("a.bin").data, b"changed")
+		self.assertIsNone(cache.get("missing.bin"))
+		self.assertEqual(cache.totalbytes, len(b"changed"))
+	
+	
+	def test_limits(self):
+		cache = staticfiles.StaticFileCache(self.root, 100, 60)
+		_write(self.root, "big.bin", bytes(61))
+		self.assertIsNone(cache.get("big.bin"))
+		for name in ("a.bin", "b.bin", "c.bin"):
+			_write(self.root, name, bytes(40))
+			self.assertIsNotNone(cache.get(name))
+		self.assertEqual(cache.totalbytes, 80)
+		self.assertEqual(list(cache._entries), ["b.bin", "c.bin"])
+	
+	
+	def test_gzip(self):
+		cache = staticfiles.StaticFileCache(self.root, 10000)
+		_write(self.root, "a.txt", b"x" * 1000)
+		_write(self.root, "a.woff", b"x" * 1000)
+		self.assertIsNotNone(cache.get("a.txt").gzipdata)
+		self.assertIsNone(cache.get("a.woff").gzipdata)
+
+
+@unittest.skipIf(staticfiles is None, "Bottle is unavailable")
+class AssetManifestTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.root)
+		_write(self.root, "top.js", b"var x;")
+		_write(self.root, "sub/x.css", b'@import url("y.css");\n@font-face { src: url("font/a.ttf"); }\n')
+		_write(self.root, "sub/y.css", b"html { }")
+		_write(self.root, "sub/font/a.ttf", b"font")
+		_write(self.root, "sub/page.html", b'<link href="x.css"/><link href="./x.css"/><script src="../top.js"></script>'
+			+ b'<img src="/abs.svg"/><img src="missing.svg"/><a href="https://example.com/x.css">')
+		index = staticfiles.StaticFileIndex(self.root)
+		index.lookup("")  # The server looks up every requested path before rewriting
+		self.manifest = staticfiles.AssetManifest(self.root, index, staticfiles.StaticFileCache(self.root, 10000))
+	
+	
+	def test_hashed_path(self):
+		hashed = self.manifest.hashed_path("top.js")
+		self.assertRegex(hashed, r"\Atop\.[0-9a-f]{16}\.js\Z")
+		self.assertEqual(self.manifest.unhash(hashed), "top.js")
+		self.assertIsNone(self.manifest.unhash("top.0123456789abcdef.js"))
+		self.assertIsNone(self.manifest.unhash("top.js"))
+		self.assertIsNone(self.manifest.hashed_path("missing.js"))
+		self.assertEqual(set(self.manifest.to_dict()), {"top.js", "sub/x.css", "sub/y.css", "sub/font/a.ttf", "sub/page.html"})
+	
+	
+	def test_rewrite_html(self):
+		entry = self.manifest.cache.get("sub/page.html")
+		html = self.manifest.rewrite_html("sub/page.html", entry).data.decode("UTF-8")
+		css = posixpath.basename(self.manifest.hashed_path("sub/x.css"))
+		js = self.manifest.hashed_path("top.js")
+		self.assertEqual(html, f'<link href="{css}"/><link href="{css}"/><script src="../{js}"></script>'
+			+ '<img src="/abs.svg"/><img src="missing.svg"/><a href="https://example.com/x.css">')
+		self.assertIs(self.manifest.rewrite_html("sub/page.html", entry), self.manifest.rewrite_html("sub/page.html", entry))
+	
+	
+	def test_rewrite_css(self):
+		entry = self.manifest.cache.get("sub/x.css")
+		font = posixpath.relpath(self.manifest.hashed_path("sub/font/a.ttf"), "sub")
+		self.assertEqual(self.manifest.rewrite_css("sub/x.css", entry).data.decode("UTF-8"),
+			f'@import url("y.css");\n@font-face {{ src: url("{font}"); }}\n')
+		
+		# The hashed name of the style sheet changes along with the font that it references
+		before = self.manifest.hashed_path("sub/x.css")
+		_write(self.root, "sub/font/a.ttf", b"new font")
+		self.manifest.cache.REVALIDATE_SECONDS = 0.0
+		self.assertNotEqual(self.manifest.hashed_path("sub/x.css"), before)
+
+
+@unittest.skipIf(staticfiles is None, "Bottle is unavailable")
+class FirstPaintBundleTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.root)
+		_write(self.root, "page.html", b'<html><head>\n<link rel="stylesheet" href="style.css"/>\n'
+			+ b'<script type="application/javascript" src="script.js"></script>\n</head><body><img src="icon.svg"/></body></html>')
+		_write(self.root, "style.css", b'/* Comment */\n@font-face { font-family: "A"; src: url("font/a.ttf"); }\nhtml { font-family: "A"; }\n')
+		_write(self.root, "script.js", b"// Comment\nvar x = 1;\n")
+		_write(self.root, "icon.svg", b"<svg/>")
+		_write(self.root, "font/a.ttf", b"font")
+		_write(self.root, "config.json", b'{ "a": 1 }')
+		index = staticfiles.StaticFileIndex(self.root)
+		self.cache = staticfiles.StaticFileCache(self.root, 10000)
+		self.cache.REVALIDATE_SECONDS = 0.0
+		self.manifest = staticfiles.AssetManifest(self.root, index, self.cache)
+		self.bundle = staticfiles.FirstPaintBundle(index, self.cache, self.manifest, "page.html", "config.json", "/file/")
+	
+	
+	def test_inlined(self):
+		html = self.bundle.get().data.decode("UTF-8")
+		font = self.manifest.hashed_path("font/a.ttf")
+		self.assertIn('<base href="/file/"/>', html)
+		self.assertIn(f'<link rel="preload" href="{font}" as="font" crossorigin="anonymous"/>', html)
+		self.assertIn(f'<style type="text/css">/*<![CDATA[*/@font-face {{ font-family: "A"; src: url("{font}"); }}', html)
+		self.assertIn('<script type="application/json" id="clock-config"><![CDATA[{"a":1}]]></script>', html)
+		self.assertIn('<script type="application/javascript">//<![CDATA[\nvar x = 1;\n//]]></script>', html)
+		self.assertIn('<img src="data:image/svg+xml;base64,PHN2Zy8+"/>', html)
+		self.assertNotIn("Comment", html)
+	
+	
+	def test_rebuilt_when_input_changes(self):
+		first = self.bundle.get()
+		self.assertIs(self.bundle.get(), first)
+		_write(self.root, "script.js", b"var y = 2;\n")
+		self.assertIn(b"var y = 2;", self.bundle.get().data)
+		_write(self.root, "font/a.ttf", b"new font")
+		self.assertIn(self.manifest.hashed_path("font/a.ttf").encode("UTF-8"), self.bundle.get().data)
+	
+	
+	def test_missing_page(self):
+		os.remove(os.path.join(self.root, "page.html"))
+		self.assertIsNone(self.bundle.get())
+
+
+def _write(root, path, data):
+	fspath = os.path.join(root, *path.split("/"))
+	os.makedirs(os.path.dirname(fspath), exist_ok=True)
+	with open(fspath, "wb") as fout:
+		fout.write(data)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -22,7 +22,16 @@ namespace millis {
 
 namespace util {
 	
-	export let configPromise: Promise<XMLHttpRequest> = doXhr("config.json", "json", millis.perMinute);
+	export let configPromise: Promise<{response: any}> = getConfig();
+	
+	
+	// Uses the configuration embedded in the page by the server's first-paint bundle, if present.
+	function getConfig(): Promise<{response: any}> {
+		const elem = document.getElementById("clock-config");
+		if (elem !== null && elem.textContent !== null)
+			return Promise.resolve({response: JSON.parse(elem.textContent)});
+		return doXhr("config.json", "json", millis.perMinute);
+	}
 	
 	
 	export function doXhr(url: string, type: XMLHttpRequestResponseType, timeout: number): Promise<XMLHttpRequest> {
@@ -110,11 +119,15 @@ namespace clock {
 
 namespace time {
 	
-	let timeCorrection: number = 0;  // Milliseconds late
+	let timeCorrection: number = 0;  // Milliseconds late, as of the last sync
+	let correctionDrift: number = 0;  // Change in the correction per millisecond, due to the local clock's frequency error
+	let lastSync: number = NaN;  // Local Unix milliseconds
 	
 	
 	export function correctedDate(): Date {
-		return new Date(Date.now() + timeCorrection);
+		const now: number = Date.now();
+		const elapsed: number = isNaN(lastSync) ? 0 : now - lastSync;
+		return new Date(now + timeCorrection + correctionDrift * elapsed);
 	}
 	
 	
@@ -125,12 +138,9 @@ namespace time {
 		while (true) {
 			let sleepTime: number;
 			try {  // Update the time correction
-				const remoteTime = (await util.doXhr("/time/" + server.join("/"), "json", 3 * millis.perSecond)).response;
-				if (typeof remoteTime != "number")
-					throw "Invalid data";
-				timeCorrection = remoteTime - Date.now();
+				const offset: number = await measureOffset(server);
+				sleepTime = applyOffset(offset, Date.now());
 				imgElem.style.display = "none";
-				sleepTime = millis.perHour;
 				consecutiveFailures = 0;
 			} catch (e) {
 				imgElem.style.removeProperty("display");
@@ -143,6 +153,81 @@ namespace time {
 	}
 	
 	
+	const MIN_SYNC_INTERVAL: number = 4 * millis.perMinute;
+	const MAX_SYNC_INTERVAL: number = 8 * millis.perHour;
+	const TARGET_ERROR: number = 25;  // Milliseconds of prediction error at a sync
+	const STEP_THRESHOLD: number = millis.perSecond;  // Bigger errors mean the local clock was set, not that it drifted
+	const MIN_DRIFT_BASELINE: number = 15 * millis.perMinute;  // Shorter ones let measurement noise dominate
+	const MAX_DRIFT: number = 500e-6;  // 43 seconds per day
+	const DRIFT_WEIGHT: number = 0.5;  // Of each new drift estimate, to average out noise but follow temperature changes
+	
+	let syncInterval: number = MIN_SYNC_INTERVAL;
+	let driftAnchor: {time: number, offset: number}|null = null;  // The measurement that the next drift estimate starts from
+	let driftKnown: boolean = false;
+	
+	
+	// Updates the correction with the given measured offset, estimating the local clock's drift from the offsets
+	// measured over a long enough baseline. Returns the time until the next sync, which doubles while the predicted
+	// correction stays well within the target error and halves when it does not.
+	function applyOffset(offset: number, now: number): number {
+		const predicted: number = timeCorrection + correctionDrift * (now - lastSync);
+		const error: number = Math.abs(offset - predicted);
+		if (isNaN(lastSync) || driftAnchor === null || error > STEP_THRESHOLD) {
+			correctionDrift = 0;
+			driftAnchor = {time: now, offset: offset};
+			driftKnown = false;
+			syncInterval = MIN_SYNC_INTERVAL;
+		} else {
+			const baseline: number = now - driftAnchor.time;
+			if (baseline >= MIN_DRIFT_BASELINE) {
+				const drift: number = (offset - driftAnchor.offset) / baseline;
+				correctionDrift = driftKnown ? correctionDrift + (drift - correctionDrift) * DRIFT_WEIGHT : drift;
+				correctionDrift = Math.max(Math.min(correctionDrift, MAX_DRIFT), -MAX_DRIFT);
+				driftAnchor = {time: now, offset: offset};
+				driftKnown = true;
+			}
+			if (error < TARGET_ERROR / 2)
+				syncInterval = Math.min(syncInterval * 2, MAX_SYNC_INTERVAL);
+			else if (error > TARGET_ERROR)
+				syncInterval = Math.max(syncInterval / 2, MIN_SYNC_INTERVAL);
+		}
+		timeCorrection = offset;
+		lastSync = now;
+		return syncInterval;
+	}
+	
+	
+	const SAMPLES_PER_SYNC: number = 4;
+	const SAMPLE_SPACING: number = 200;  // Milliseconds
+	
+	
+	// Exchanges timestamps with the server a few times like an NTP client, and returns the offset from
+	// the sample with the lowest round-trip delay, which leaves the least room for asymmetric delays.
+	async function measureOffset(server: Array<string>): Promise<number> {
+		let bestOffset: number = NaN;
+		let bestDelay: number = Infinity;
+		for (let i = 0; i < SAMPLES_PER_SYNC; i++) {
+			if (i > 0)
+				await util.sleep(SAMPLE_SPACING);
+			try {
+				const t1: number = Date.now();
+				const reply = (await util.doXhr(`/time-sync/${server.join("/")}?t1=${t1}`, "json", 3 * millis.perSecond)).response;
+				const t4: number = Date.now();
+				if (reply === null || reply.t1 !== t1 || typeof reply.t2 != "number" || typeof reply.t3 != "number")
+					throw "Invalid data";
+				const delay: number = (t4 - t1) - (reply.t3 - reply.t2);
+				if (delay < bestDelay) {
+					bestOffset = ((reply.t2 - t1) + (reply.t3 - t4)) / 2;
+					bestDelay = delay;
+				}
+			} catch (e) {}
+		}
+		if (isNaN(bestOffset))
+			throw "No valid samples";
+		return bestOffset;
+	}
+	
+	
 	main();
 	
 }
@@ -152,14 +237,23 @@ namespace time {
 namespace wallpaper {
 	
 	async function main(): Promise<void> {
+		let retryDelay: number = millis.perMinute;
 		while (true) {
 			try {
-				const url = (await util.doXhr("/wallpaper-daily.json", "json", 10 * millis.perSecond)).response;
+				const root = document.documentElement;
+				const url = (await util.doXhr(`/wallpaper-daily.json?width=${root.clientWidth}&height=${root.clientHeight}&dpr=${window.devicePixelRatio}`,
+					"json", 10 * millis.perSecond)).response;
 				if (typeof url != "string")
 					throw "Invalid data";
-				document.documentElement.style.backgroundImage =
-					`url('wallpaper/${encodeURIComponent(url)}')`;
-			} catch (e) {}
+				await loadImage(url);
+				root.style.backgroundImage = `url('${url}')`;
+				retryDelay = millis.perMinute;
+			} catch (e) {
+				// Try again soon, backing off to once an hour
+				await util.sleepWithJitter(retryDelay);
+				retryDelay = Math.min(retryDelay * 2, millis.perHour);
+				continue;
+			}
 			
 			// Schedule next update at 05:00 local time
 			const now = time.correctedDate();
@@ -175,6 +269,17 @@ namespace wallpaper {
 	}
 	
 	
+	// Resolves when the image at the given URL is in the browser's cache, so that a failed download does not clear the wallpaper.
+	function loadImage(url: string): Promise<void> {
+		return new Promise((resolve, reject) => {
+			let img = new Image();
+			img.onload = () => resolve();
+			img.onerror = () => reject("Image error");
+			img.src = url;
+		});
+	}
+	
+	
 	main();
 	
 }